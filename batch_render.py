@@ -0,0 +1,178 @@
+import os
+import time
+import argparse
+import numpy as np
+import taichi as ti
+import runtime
+from camera import Camera
+from sphere import Sphere
+from render import Renderer
+from instrument import Instrumentation
+import image_io
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='render a particle scene to an image without a window')
+    parser.add_argument('--scene', default='ball_info_0.csv', help='particle file')
+    parser.add_argument('--output', default='particleRayTracing.png', help='image file, .png, .pfm, .exr or .npy')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='stream the particle file in chunks of this many rows to bound the memory')
+    parser.add_argument('--roi', type=float, nargs=6, default=None, metavar=('X0', 'Y0', 'Z0', 'X1', 'Y1', 'Z1'),
+                        help='only load the particles reaching into this box')
+    parser.add_argument('--cull-frustum', action='store_true',
+                        help='only load the particles reaching into the view, they no longer cast off-screen shadows')
+    parser.add_argument('--resolution', type=int, nargs=2, default=(480, 720), metavar=('ROWS', 'COLUMNS'))
+    parser.add_argument('--origin', type=float, nargs=3, default=(-1.35, -0.4, 0.0), metavar=('X', 'Y', 'Z'))
+    parser.add_argument('--yaw', type=float, default=0.0, help='degrees')
+    parser.add_argument('--pitch', type=float, default=-90.0, help='degrees')
+    parser.add_argument('--roll', type=float, default=0.0, help='degrees')
+    parser.add_argument('--distance', type=float, default=1.0, help='distance from the eye to the viewport')
+    parser.add_argument('--height', type=float, default=0.5, help='height of the viewport')
+    parser.add_argument('--samples', type=int, default=16, help='maximum samples per pixel')
+    parser.add_argument('--samples-per-pass', type=int, default=4)
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='stop sampling a pixel once its noise is below this level, 0 always uses all samples')
+    parser.add_argument('--min-samples', type=int, default=None,
+                        help='samples per pixel before --noise may stop it, 2 * --samples-per-pass by default')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='--samples is the average budget per pixel, spent where the image is noisiest')
+    parser.add_argument('--denoise', action='store_true',
+                        help='filter the image guided by the normal, color and depth of the first hits')
+    parser.add_argument('--tile-size', type=int, default=0,
+                        help='render tile by tile into a memory-mapped image so that the memory does not grow '
+                             'with the resolution, every pixel gets --samples samples, 0 keeps the framebuffer')
+    parser.add_argument('--depth', type=int, default=4, help='number of reflection/refraction bounces')
+    parser.add_argument('--lights', default=None, help='json light list, the default lights otherwise')
+    parser.add_argument('--shadow-map', type=int, default=0,
+                        help='texels along each edge of the directional shadow map, 0 traces the shadow rays')
+    parser.add_argument('--stats', default=None,
+                        help='count rays and time kernels, the report is appended to this json lines file')
+    parser.add_argument('--arch', choices=('cpu', 'gpu'), default='cpu')
+    parser.add_argument('--profile', choices=tuple(runtime.PROFILES), default='release')
+    parser.add_argument('--cache-dir', default=runtime.CACHE_DIR, help='offline kernel cache')
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.scene):
+        parser.error('scene file {} not found'.format(args.scene))
+    if args.min_samples is None:
+        args.min_samples = min(2 * args.samples_per_pass, args.samples)
+    if args.tile_size > 0:
+        if args.noise > 0.0 or args.adaptive or args.denoise:
+            parser.error('--tile-size renders a fixed number of samples, without --noise, --adaptive and --denoise')
+        if os.path.splitext(args.output)[1].lower() not in ('.png', '.npy'):
+            parser.error('--tile-size writes .png or .npy images')
+    return args
+
+
+def save_canvas(file_name: str, canvas: np.ndarray):
+    """
+    write the framebuffer pixel for pixel, see image_io.save_image for the formats
+    :param canvas: framebuffer in the window layout, as in Renderer.canvas
+    """
+    image_io.save_image(file_name, image_io.get_image(canvas))
+
+
+def render_tiled(renderer: Renderer, args, timing: dict):
+    """
+    the finished tiles go to a memory-mapped uint8 image on disk, a png is written from it row block by row block
+    or it is kept as the .npy output
+    """
+    time_start = time.perf_counter()
+    renderer.render_tile(np.zeros((1, 1, 3), dtype=np.float32), 0, 0, 1)
+    ti.sync()
+    timing['compile'] = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    is_png = os.path.splitext(args.output)[1].lower() == '.png'
+    image_name = args.output + '.tmp.npy' if is_png else args.output
+    image = np.lib.format.open_memmap(image_name, mode='w+', dtype=np.uint8,
+                                      shape=(args.resolution[0], args.resolution[1], 3))
+    # the top row comes first on disk, as in the other formats
+    renderer.render_tiled(image[::-1], args.tile_size, args.samples)
+    ti.sync()
+    timing['render'] = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    image.flush()
+    if is_png:
+        image_io.write_png(args.output, image, origin='upper')
+        del image
+        os.remove(image_name)
+    timing['write'] = time.perf_counter() - time_start
+
+    print('{} spheres, {} x {} pixels, {} tiles of {} pixels, {} samples per pixel'.format(
+        renderer.sphere.number, args.resolution[0], args.resolution[1],
+        -(-args.resolution[0] // args.tile_size) * -(-args.resolution[1] // args.tile_size), args.tile_size,
+        args.samples))
+    for stage, seconds in timing.items():
+        print('{:<8s}{:10.3f} s'.format(stage, seconds))
+    print('saved {}'.format(args.output))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    runtime.init(args.profile, arch=ti.cpu if args.arch == 'cpu' else ti.gpu, cache_dir=args.cache_dir)
+    timing = {}
+
+    time_start = time.perf_counter()
+    camera = Camera(origin=args.origin, resolution=args.resolution, yaw=np.radians(args.yaw),
+                    pitch=np.radians(args.pitch), roll=np.radians(args.roll), distance=args.distance,
+                    height=args.height)
+    instrumentation = Instrumentation(enabled=args.stats is not None)
+    roi = None if args.roi is None else (args.roi[:3], args.roi[3:])
+    sphere = Sphere(file_name=args.scene, chunk_size=args.chunk_size, roi=roi,
+                    frustum=camera if args.cull_frustum else None)
+    renderer = Renderer(camera=camera, sphere=sphere, max_depth=args.depth,
+                        instrumentation=instrumentation, shadow_map_size=args.shadow_map,
+                        lights=args.lights, framebuffer=args.tile_size == 0)
+    ti.sync()
+    timing['load'] = time.perf_counter() - time_start
+    if args.tile_size > 0:
+        render_tiled(renderer, args, timing)
+        return
+
+    time_start = time.perf_counter()
+    # a pass without samples compiles the kernel without touching the image
+    if args.adaptive:
+        renderer.render_adaptive_pass(0, 0.0, 0)
+        renderer.estimate_error(0)
+    else:
+        renderer.render_progressive(0, args.noise, args.min_samples, args.samples)
+    ti.sync()
+    timing['compile'] = time.perf_counter() - time_start
+    # the compile pass is not part of the frame statistics
+    instrumentation.end_frame()
+
+    time_start = time.perf_counter()
+    if args.adaptive:
+        num_sample = renderer.render_adaptive(args.samples, args.samples_per_pass, 16 * args.samples)
+        num_pass = 'adaptive, {:.2f} samples per pixel'.format(num_sample / renderer.num_pixel_render[0])
+    else:
+        num_pass = renderer.render_until_converged(args.noise, args.samples_per_pass, args.min_samples,
+                                                   args.samples)
+        num_pass = '{} passes'.format(num_pass)
+    ti.sync()
+    timing['render'] = time.perf_counter() - time_start
+
+    if args.denoise:
+        time_start = time.perf_counter()
+        renderer.denoise()
+        ti.sync()
+        timing['denoise'] = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    save_canvas(args.output, renderer.canvas.to_numpy())
+    timing['write'] = time.perf_counter() - time_start
+
+    print('{} spheres, {} x {} pixels, {}'.format(
+        renderer.sphere.number, args.resolution[0], args.resolution[1], num_pass))
+    for stage, seconds in timing.items():
+        print('{:<8s}{:10.3f} s'.format(stage, seconds))
+    print('saved {}'.format(args.output))
+    if args.stats is not None:
+        record = instrumentation.end_frame()
+        print(instrumentation.summary(record))
+        instrumentation.dump(record, args.stats)
+
+
+if __name__ == '__main__':
+    main()
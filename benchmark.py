@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import numpy as np
+import taichi as ti
+import runtime
+from camera import Camera
+from sphere import Sphere
+from render import Renderer
+from instrument import Instrumentation
+from format import np_flt_default
+
+# the packings fill this box, in front of the default camera
+BOX_CENTER = np.array([1.75, -1.2, 0.0])
+BOX_SIZE = 1.5
+# fraction of the box volume occupied by the spheres, overlaps are allowed
+VOLUME_FRACTION = 0.3
+
+
+def generate_packing(number: int, layout: str = 'uniform', seed: int = 0) -> dict:
+    """
+    synthetic sphere packing in the columns format of Sphere
+    :param layout: 'uniform' fills the box, 'clustered' gathers the spheres in a few dense blobs
+    """
+    rng = np.random.default_rng(seed)
+    if layout == 'uniform':
+        pos = rng.uniform(-0.5, 0.5, (number, 3))
+    elif layout == 'clustered':
+        num_cluster = max(1, int(round(number ** (1.0 / 3.0))))
+        centers = rng.uniform(-0.4, 0.4, (num_cluster, 3))
+        pos = centers[rng.integers(0, num_cluster, number)] + rng.normal(0.0, 0.05, (number, 3))
+        pos = np.clip(pos, -0.5, 0.5)
+    else:
+        raise ValueError("Unknown layout '{}', expected 'uniform' or 'clustered'.".format(layout))
+    pos = BOX_CENTER + pos * BOX_SIZE
+    rad_mean = (VOLUME_FRACTION * BOX_SIZE ** 3 / number * 3.0 / (4.0 * np.pi)) ** (1.0 / 3.0)
+    rad = rng.uniform(0.8, 1.2, number) * rad_mean
+    return {'rad': rad.astype(np_flt_default),
+            'pos_x': pos[:, 0].astype(np_flt_default),
+            'pos_y': pos[:, 1].astype(np_flt_default),
+            'pos_z': pos[:, 2].astype(np_flt_default)}
+
+
+def run_case(number: int, layout: str, resolution, samples: int, max_depth: int, seed: int) -> dict:
+    """
+    the timed pass runs without counters, the ray counts come from a second renderer over the same
+    spheres with the counters compiled in, so the atomic adds do not slow down the measured kernel
+    """
+    result = {'number': number, 'layout': layout}
+
+    time_start = time.perf_counter()
+    columns = generate_packing(number, layout, seed)
+    sphere = Sphere(columns=columns)
+    renderer = Renderer(camera=Camera(resolution=resolution), sphere=sphere, max_depth=max_depth)
+    ti.sync()
+    result['load_s'] = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    renderer.render_progressive(0, 0.0, samples, samples)
+    ti.sync()
+    result['compile_s'] = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    # one pass with all samples, every pixel gets exactly samples rays
+    renderer.render_progressive(samples, 0.0, samples, samples)
+    ti.sync()
+    result['render_s'] = time.perf_counter() - time_start
+    result['image_mean'] = float(renderer.canvas.to_numpy().mean())
+    del renderer
+
+    instrumentation = Instrumentation(enabled=True)
+    counting = Renderer(camera=Camera(resolution=resolution), sphere=sphere, max_depth=max_depth,
+                        instrumentation=instrumentation)
+    counting.render_progressive(samples, 0.0, samples, samples)
+    counters = instrumentation.end_frame()['counters']
+    rays = {'primary': counters['primary'],
+            'secondary': counters['reflection'] + counters['refraction'],
+            'shadow': counters['shadow']}
+    result['rays'] = rays
+    result['intersection_tests'] = counters['intersection']
+    result['rays_per_s'] = {name: count / result['render_s'] for name, count in rays.items()}
+    result['rays_per_s']['total'] = sum(rays.values()) / result['render_s']
+    return result
+
+
+def get_version() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='scene-scaling benchmark on synthetic sphere packings')
+    parser.add_argument('--numbers', type=int, nargs='+', default=(100, 1000, 10000, 100000, 1000000))
+    parser.add_argument('--layouts', nargs='+', default=('uniform', 'clustered'))
+    parser.add_argument('--resolution', type=int, nargs=2, default=(240, 360), metavar=('ROWS', 'COLUMNS'))
+    parser.add_argument('--samples', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--arch', choices=('cpu', 'gpu'), default='cpu')
+    parser.add_argument('--output', default=None, help='json file, printed to stdout by default')
+    args = parser.parse_args(argv)
+
+    runtime.init('release', arch=ti.cpu if args.arch == 'cpu' else ti.gpu, random_seed=args.seed)
+    report = {'version': get_version(),
+              'taichi': '.'.join(str(v) for v in ti.__version__),
+              'python': platform.python_version(),
+              'arch': args.arch,
+              'resolution': list(args.resolution),
+              'samples': args.samples,
+              'depth': args.depth,
+              'seed': args.seed,
+              'results': []}
+    for layout in args.layouts:
+        for number in args.numbers:
+            result = run_case(number, layout, args.resolution, args.samples, args.depth, args.seed)
+            report['results'].append(result)
+            print('{:>10s} {:>9d} spheres: load {:.3f} s, compile {:.3f} s, render {:.3f} s, '
+                  '{:.3e} rays/s'.format(layout, number, result['load_s'], result['compile_s'],
+                                         result['render_s'], result['rays_per_s']['total']), file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import numpy as np
+import taichi as ti
+from format import flt_default, INF
+from linalg import solve_quadratic_equation
+from instrument import Counters, INTERSECTION, EARLY_EXIT, NODE
+vec = ti.math.vec3
+
+# maximum number of pending nodes during traversal, enough for 2^60 leaves
+STACK_SIZE = 64
+
+
+def expand_bits(v: np.ndarray) -> np.ndarray:
+    """
+    spread the lower 10 bits of v so that there are two zero bits between each bit
+    """
+    v = v.astype(np.uint32)
+    v = (v * np.uint32(0x00010001)) & np.uint32(0xFF0000FF)
+    v = (v * np.uint32(0x00000101)) & np.uint32(0x0F00F00F)
+    v = (v * np.uint32(0x00000011)) & np.uint32(0xC30C30C3)
+    v = (v * np.uint32(0x00000005)) & np.uint32(0x49249249)
+    return v
+
+
+def morton_code(points: np.ndarray) -> np.ndarray:
+    """
+    30-bit Morton codes of the points (n, 3)
+    the quantization box ignores the outer percentile of the points so that a
+    few huge or distant spheres (e.g. the floor) do not squash the rest of the
+    scene into a handful of cells
+    """
+    lower = np.quantile(points, 0.01, axis=0)
+    upper = np.quantile(points, 0.99, axis=0)
+    extent = np.maximum(upper - lower, 1.0e-12)
+    cells = np.clip((points - lower) / extent * 1023.0, 0.0, 1023.0).astype(np.uint32)
+    return (expand_bits(cells[:, 0]) << np.uint32(2)) | (expand_bits(cells[:, 1]) << np.uint32(1)) | \
+        expand_bits(cells[:, 2])
+
+
+@ti.data_oriented
+class BVH(object):
+    """
+    bounding volume hierarchy over the spheres
+    spheres are sorted along a Morton curve and grouped into leaves of leaf_size
+    spheres, the leaves form a complete binary tree stored in heap order
+    (children of node k are 2k+1 and 2k+2), so no child pointers are stored
+    """
+    def __init__(self, sphere, leaf_size=4, counters=None):
+        """
+        :param counters: intersection test counters, None disables counting
+        """
+        self.sphere = sphere
+        self.counters = Counters() if counters is None else counters
+        self.leaf_size = leaf_size
+        number_leaf = 1
+        while number_leaf * leaf_size < sphere.number:
+            number_leaf *= 2
+        self.number_leaf = number_leaf
+        self.number_node = 2 * number_leaf - 1
+        # sphere indices in leaf order, -1 marks an empty slot
+        self.prim_index = ti.field(dtype=ti.i32, shape=(number_leaf * leaf_size,))
+        self.node_min = ti.field(dtype=flt_default, shape=(self.number_node, 3))
+        self.node_max = ti.field(dtype=flt_default, shape=(self.number_node, 3))
+        self.build()
+
+    def build(self):
+        """
+        sort the spheres along the Morton curve and compute the node bounds
+        """
+        pos = self.sphere.pos_rad.to_numpy()[:self.sphere.number, :3]
+        order = np.argsort(morton_code(pos), kind='stable').astype(np.int32)
+        prim_index = np.full(self.number_leaf * self.leaf_size, -1, dtype=np.int32)
+        prim_index[:order.shape[0]] = order
+        self.prim_index.from_numpy(prim_index)
+        self.refit()
+
+    def refit(self):
+        """
+        recompute the node bounds bottom-up while keeping the tree topology,
+        used after the spheres moved
+        """
+        self.refit_leaf()
+        first = self.number_leaf - 1
+        while first > 0:
+            first = (first - 1) // 2
+            self.refit_level(first, 2 * first + 1)
+
+    @ti.kernel
+    def refit_leaf(self):
+        for index_leaf in range(self.number_leaf):
+            node = self.number_leaf - 1 + index_leaf
+            box_min = vec(INF, INF, INF)
+            box_max = vec(-INF, -INF, -INF)
+            for k in range(self.leaf_size):
+                index_p = self.prim_index[index_leaf * self.leaf_size + k]
+                if index_p >= 0:
+                    pos = self.sphere.get_pos(index_p)
+                    rad = self.sphere.get_rad(index_p)
+                    box_min = ti.min(box_min, pos - rad)
+                    box_max = ti.max(box_max, pos + rad)
+            for d in ti.static(range(3)):
+                self.node_min[node, d] = box_min[d]
+                self.node_max[node, d] = box_max[d]
+
+    @ti.kernel
+    def refit_level(self, first: ti.i32, last: ti.i32):
+        """
+        merge the children bounds of the nodes in [first, last)
+        """
+        for node in range(first, last):
+            for d in ti.static(range(3)):
+                self.node_min[node, d] = ti.min(self.node_min[2 * node + 1, d], self.node_min[2 * node + 2, d])
+                self.node_max[node, d] = ti.max(self.node_max[2 * node + 1, d], self.node_max[2 * node + 2, d])
+
+    @ti.func
+    def intersect_box(self, node: ti.i32, origin: vec, inv_d: vec, t_min: flt_default,
+                      t_max: flt_default) -> flt_default:
+        """
+        slab test, return the entering distance or INF if the box is missed in [t_min, t_max]
+        the boxes of the padding leaves and of the subtrees holding only them are empty (min > max)
+        and never hit, the slab test alone would swap their bounds
+        """
+        box_min = vec(self.node_min[node, 0], self.node_min[node, 1], self.node_min[node, 2])
+        box_max = vec(self.node_max[node, 0], self.node_max[node, 1], self.node_max[node, 2])
+        t0 = (box_min - origin) * inv_d
+        t1 = (box_max - origin) * inv_d
+        t_near = ti.max(ti.min(t0, t1).max(), t_min)
+        t_far = ti.min(ti.max(t0, t1).min(), t_max)
+        res = INF
+        if t_near <= t_far and box_min[0] <= box_max[0]:
+            res = t_near
+        return res
+
+    @ti.func
+    def get_inv_dir(self, vec_d: vec) -> vec:
+        inv_d = vec(0.0, 0.0, 0.0)
+        for d in ti.static(range(3)):
+            # avoid division by zero for axis-aligned rays
+            inv_d[d] = 1.0 / vec_d[d] if ti.abs(vec_d[d]) > 1.0e-12 else INF
+        return inv_d
+
+    @ti.func
+    def closest_hit(self, origin: vec, vec_d: vec, t_min: flt_default, t_max: flt_default):
+        """
+        closest sphere whose front intersection lies in (t_min, t_max)
+        :return: index of the sphere (-1 if nothing is hit) and the distance
+        """
+        inv_d = self.get_inv_dir(vec_d)
+        t_closest = t_max
+        index_hit = -1
+        stack_node = ti.Vector([0] * STACK_SIZE, dt=ti.i32)
+        stack_t = ti.Vector([0.0] * STACK_SIZE, dt=flt_default)
+        stack_t[0] = self.intersect_box(0, origin, inv_d, t_min, t_closest)
+        num_test = 0
+        size = 1
+        while size > 0:
+            size -= 1
+            node = stack_node[size]
+            self.counters.add(NODE)
+            if stack_t[size] >= t_closest:
+                continue
+            if node >= self.number_leaf - 1:
+                index_leaf = node - (self.number_leaf - 1)
+                for k in range(self.leaf_size):
+                    index_p = self.prim_index[index_leaf * self.leaf_size + k]
+                    if index_p >= 0:
+                        num_test += 1
+                        pos_rad = self.sphere.pos_rad[index_p]
+                        t1, t2 = solve_quadratic_equation(vec_d, origin - pos_rad.xyz, pos_rad.w)
+                        t = ti.min(t1, t2)
+                        if t_min < t < t_closest:
+                            t_closest = t
+                            index_hit = index_p
+            else:
+                left = 2 * node + 1
+                right = 2 * node + 2
+                t_left = self.intersect_box(left, origin, inv_d, t_min, t_closest)
+                t_right = self.intersect_box(right, origin, inv_d, t_min, t_closest)
+                # push the farther child first so the nearer one is visited first
+                if t_left > t_right:
+                    left, right = right, left
+                    t_left, t_right = t_right, t_left
+                if t_right < t_closest:
+                    stack_node[size] = right
+                    stack_t[size] = t_right
+                    size += 1
+                if t_left < t_closest:
+                    stack_node[size] = left
+                    stack_t[size] = t_left
+                    size += 1
+        self.counters.add(INTERSECTION, num_test)
+        return index_hit, t_closest
+
+    @ti.func
+    def any_hit(self, origin: vec, vec_d: vec, t_min: flt_default, t_max: flt_default) -> ti.i32:
+        """
+        occlusion query, stop at the first sphere intersected in (t_min, t_max)
+        :return: 1 if the segment is blocked, otherwise 0
+        """
+        inv_d = self.get_inv_dir(vec_d)
+        blocked = 0
+        num_test = 0
+        stack_node = ti.Vector([0] * STACK_SIZE, dt=ti.i32)
+        size = 1
+        while size > 0 and blocked == 0:
+            size -= 1
+            node = stack_node[size]
+            self.counters.add(NODE)
+            if self.intersect_box(node, origin, inv_d, t_min, t_max) >= INF:
+                continue
+            if node >= self.number_leaf - 1:
+                index_leaf = node - (self.number_leaf - 1)
+                for k in range(self.leaf_size):
+                    index_p = self.prim_index[index_leaf * self.leaf_size + k]
+                    if index_p >= 0:
+                        num_test += 1
+                        pos_rad = self.sphere.pos_rad[index_p]
+                        t1, t2 = solve_quadratic_equation(vec_d, origin - pos_rad.xyz, pos_rad.w)
+                        if t_min < t1 < t_max or t_min < t2 < t_max:
+                            blocked = 1
+                            break
+            else:
+                stack_node[size] = 2 * node + 2
+                stack_node[size + 1] = 2 * node + 1
+                size += 2
+        self.counters.add(INTERSECTION, num_test)
+        self.counters.add(EARLY_EXIT, blocked)
+        return blocked
@@ -1,34 +1,131 @@
+import numpy as np
 import taichi as ti
-from linalg import euler_rot
+from linalg import euler_rot, axis_rot
 from format import flt_default, INF
 vec = ti.math.vec3
 
 
 @ti.data_oriented
 class Camera(object):
-    def __init__(self):
-        self.origin = vec(-1.35, -0.4, 0.0)
-        self.distance = 1.0
+    def __init__(self, origin=(-1.35, -0.4, 0.0), resolution=(480, 720), yaw=ti.math.pi * 0.0,
+                 pitch=ti.math.pi * -0.5, roll=ti.math.pi * -0.0, distance=1.0, height=0.5):
+        """
+        :param origin: position of the eye
+        :param resolution: number of pixels (rows, columns)
+        :param yaw: rotation angles in radians
+        :param pitch:
+        :param roll:
+        :param distance: distance from the origin to the viewport
+        :param height: height of the viewport, its width follows the aspect ratio
+        """
+        self.distance = distance
         self.resolution = ti.field(dtype=ti.i32, shape=(2,))
-        self.resolution[0] = 480
-        self.resolution[1] = 720
-        self.height = 0.5
+        self.resolution[0] = resolution[0]
+        self.resolution[1] = resolution[1]
+        self.height = height
         self.width = self.height * self.resolution[1]/self.resolution[0]
-        self.yaw = ti.math.pi * 0.0
-        self.pitch = ti.math.pi * -0.5
-        self.roll = ti.math.pi * -0.0
-        self.rotation = euler_rot(self.yaw, self.pitch, self.roll)
-        # vectors from origin to viewport
-        self.vec_o_to_vp = ti.field(dtype=flt_default, shape=(self.resolution[0], self.resolution[1], 3))
-        self.calculate_o_to_vp()
-
-    @ti.kernel
-    def calculate_o_to_vp(self):
-        for i, j in ti.ndrange(self.resolution[0], self.resolution[1]):
-            vec_d = ti.math.vec3((j - self.resolution[1] / 2.0) / self.resolution[1] * self.width,
-                        (i - self.resolution[0] / 2.0) / self.resolution[0] * self.height, self.distance)
-            vec_d = vec_d @ self.rotation
-
-            self.vec_o_to_vp[i, j, 0] = vec_d[0]
-            self.vec_o_to_vp[i, j, 1] = vec_d[1]
-            self.vec_o_to_vp[i, j, 2] = vec_d[2]
+        # the pose lives in fields so that moving the camera does not recompile the kernels
+        self.origin = ti.Vector.field(3, dtype=flt_default, shape=())
+        self.rotation = ti.Matrix.field(3, 3, dtype=flt_default, shape=())
+        self.yaw = yaw
+        self.pitch = pitch
+        self.roll = roll
+        self.set_pose(origin, yaw, pitch, roll)
+
+    def set_pose(self, origin=None, yaw=None, pitch=None, roll=None):
+        """
+        update the eye position and the rotation angles, None keeps the current value
+        """
+        if origin is not None:
+            self.origin[None] = vec(*origin)
+        self.yaw = self.yaw if yaw is None else yaw
+        self.pitch = self.pitch if pitch is None else pitch
+        self.roll = self.roll if roll is None else roll
+        self.rotation[None] = euler_rot(self.yaw, self.pitch, self.roll)
+
+    def get_config(self) -> dict:
+        """
+        arguments that rebuild this camera, e.g. in another process
+        the rotation is included since orbiting does not update the euler angles
+        """
+        return {'origin': tuple(self.origin[None].to_numpy()),
+                'resolution': (self.resolution[0], self.resolution[1]),
+                'yaw': self.yaw, 'pitch': self.pitch, 'roll': self.roll,
+                'distance': self.distance, 'height': self.height,
+                'rotation': self.rotation[None].to_numpy()}
+
+    @classmethod
+    def from_config(cls, config: dict):
+        config = dict(config)
+        rotation = config.pop('rotation', None)
+        camera = cls(**config)
+        if rotation is not None:
+            camera.rotation[None] = ti.Matrix(rotation)
+        return camera
+
+    def get_axes(self):
+        """
+        :return: right, up and forward directions of the camera in world space
+        """
+        rotation = self.rotation[None].to_numpy()
+        return rotation[0], rotation[1], rotation[2]
+
+    def rotate(self, matrix: np.ndarray):
+        """
+        apply a world-space rotation to the camera axes, the euler angles are not updated
+        """
+        self.rotation[None] = ti.Matrix(self.rotation[None].to_numpy() @ matrix.T)
+
+    def orbit(self, d_azimuth, d_elevation, pivot_distance=1.5):
+        """
+        rotate the camera around the point pivot_distance in front of it,
+        horizontally about the world y axis and vertically about the camera right axis
+        """
+        forward = self.get_axes()[2]
+        pivot = self.origin[None].to_numpy() + forward * pivot_distance
+        self.rotate(axis_rot(np.array([0.0, 1.0, 0.0]), d_azimuth))
+        self.rotate(axis_rot(self.get_axes()[0], d_elevation))
+        forward = self.get_axes()[2]
+        self.origin[None] = pivot - forward * pivot_distance
+
+    def pan(self, d_right, d_up):
+        """
+        translate the camera in its viewport plane
+        """
+        right, up, forward = self.get_axes()
+        self.origin[None] = self.origin[None].to_numpy() + right * d_right + up * d_up
+
+    def zoom(self, d_forward):
+        """
+        move the camera along its viewing direction
+        """
+        forward = self.get_axes()[2]
+        self.origin[None] = self.origin[None].to_numpy() + forward * d_forward
+
+    def in_frustum(self, pos: np.ndarray, rad: np.ndarray) -> np.ndarray:
+        """
+        spheres that reach into the viewing frustum, the test is conservative
+        :param pos: (n, 3) centers
+        :param rad: (n,) radii
+        :return: (n,) boolean mask
+        """
+        # camera space, x to the right, y up and z forward
+        local = (pos - self.origin[None].to_numpy()) @ self.rotation[None].to_numpy().T
+        visible = local[:, 2] > -rad
+        # signed distances to the four side planes through the eye
+        for axis, half_size in ((0, self.width / 2.0), (1, self.height / 2.0)):
+            slope = half_size / self.distance
+            norm = np.sqrt(1.0 + slope * slope)
+            for sign in (1.0, -1.0):
+                visible &= (sign * local[:, axis] - slope * local[:, 2]) / norm < rad
+        return visible
+
+    @ti.func
+    def get_ray_dir(self, i: ti.i32, j: ti.i32, u_offset: flt_default, v_offset: flt_default) -> vec:
+        """
+        direction from the origin through the point (i + u_offset, j + v_offset) of pixel (i, j)
+        on the viewport, offsets are in pixels
+        """
+        vec_d = vec((j + v_offset - self.resolution[1] / 2.0) / self.resolution[1] * self.width,
+                    (i + u_offset - self.resolution[0] / 2.0) / self.resolution[0] * self.height, self.distance)
+        return vec_d @ self.rotation[None]
@@ -1,18 +1,40 @@
+import numpy as np
 import taichi as ti
 import matplotlib.pyplot as plt
+from format import flt_default, np_flt_default
 vec = ti.math.vec3
 
 
-def scalar_to_rgb(scalar: ti.f32) -> vec:
+def get_lut(name: str = 'rainbow', size: int = 256) -> np.ndarray:
     """
-    convert scalar ranging from 0.0 to 1.0 to rgb
-    :param scalar:
-    :return:
+    sample a matplotlib colormap into a (size, 3) rgb table
     """
-    if scalar < 0 or scalar > 1:
-        raise ValueError("Scalar value must be within the range [0, 1].")
-    colormap = plt.get_cmap('rainbow')
-    rgb = colormap(scalar)
+    colormap = plt.get_cmap(name)
+    return colormap(np.linspace(0.0, 1.0, size))[:, :3].astype(np_flt_default)
 
-    return vec(rgb[0], rgb[1], rgb[2])
 
+@ti.data_oriented
+class ColorMap(object):
+    """
+    colormap baked into a small lookup table so that it can be evaluated inside kernels
+    """
+    def __init__(self, name='rainbow', size=256):
+        self.size = size
+        self.lut = ti.field(dtype=flt_default, shape=(size, 3))
+        self.set_map(name)
+
+    def set_map(self, name: str):
+        self.name = name
+        self.lut.from_numpy(get_lut(name, self.size))
+
+    @ti.func
+    def get_rgb(self, scalar: flt_default) -> vec:
+        """
+        linear interpolation in the table, scalar is clamped to [0, 1]
+        """
+        x = ti.min(ti.max(scalar, 0.0), 1.0) * (self.size - 1)
+        k = ti.min(ti.cast(x, ti.i32), self.size - 2)
+        w = x - k
+        color_0 = vec(self.lut[k, 0], self.lut[k, 1], self.lut[k, 2])
+        color_1 = vec(self.lut[k + 1, 0], self.lut[k + 1, 1], self.lut[k + 1, 2])
+        return color_0 * (1.0 - w) + color_1 * w
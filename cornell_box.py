@@ -1,6 +1,8 @@
 # pylint: disable=W0622,W0621,W0401
+import random
 import taichi as ti
 from taichi.math import *
+from denoise import Denoiser
 
 ti.init(arch=ti.gpu, default_ip=ti.i32, default_fp=ti.f32)
 
@@ -8,12 +10,43 @@ image_resolution = (512, 512)
 image_buffer = ti.Vector.field(4, float, image_resolution)
 image_pixels = ti.Vector.field(3, float, image_resolution)
 
+# small boxes scattered in the room besides the 8 objects of the cornell box
+num_scattered = 0
+# sphere tracing reads the scene distance from a grid baked in build_scene instead of all objects
+use_sdf_grid = False
+sdf_grid_resolution = 128
+# the displayed mean is filtered by the a-trous denoiser, guided by the first hit through every pixel
+use_denoiser = False
+denoise_iterations = 5
+# bounces of a path, from roulette_depth on paths are ended at random in proportion to their throughput
+max_depth = 8
+roulette_depth = 3
+
 Ray = ti.types.struct(origin=vec3, direction=vec3, color=vec3)
 Material = ti.types.struct(albedo=vec3, emission=vec3)
 Transform = ti.types.struct(position=vec3, rotation=vec3, scale=vec3, matrix=mat3)
 SDFObject = ti.types.struct(distance=float, transform=Transform, material=Material)
 
-objects = SDFObject.field(shape=8)
+num_objects = 8 + num_scattered
+objects = SDFObject.field(shape=num_objects)
+# world-space bounding boxes of the objects, a point farther from the box than the closest
+# distance found so far cannot be closer to the object either
+bound_min = ti.Vector.field(3, float, num_objects)
+bound_max = ti.Vector.field(3, float, num_objects)
+# distance to the closest object and its index at the grid nodes, the grid covers all objects
+sdf_grid = ti.field(float, (sdf_grid_resolution,) * 3 if use_sdf_grid else (1, 1, 1))
+id_grid = ti.field(ti.i32, (sdf_grid_resolution,) * 3 if use_sdf_grid else (1, 1, 1))
+grid_lower = ti.Vector.field(3, float, ())
+grid_cell = ti.field(float, ())
+# objects whose emission brightens the path, every bounce sends a shadow ray to one of them
+emitters = ti.field(ti.i32, num_objects)
+num_emitters = ti.field(ti.i32, ())
+# linear mean color and the first-hit guides of the denoiser, in the (rows, columns, 3) layout it reads
+denoise_shape = image_resolution if use_denoiser else (1, 1)
+linear_color = ti.field(float, denoise_shape + (3,))
+normal_buffer = ti.field(float, denoise_shape + (3,))
+albedo_buffer = ti.field(float, denoise_shape + (3,))
+depth_buffer = ti.field(float, denoise_shape)
 objects[0] = SDFObject(
     transform=Transform(vec3(0, 0, -1), vec3(0, 0, 0), vec3(1, 1, 0.2)),
     material=Material(vec3(1, 1, 1) * 0.4, vec3(1)),
@@ -46,6 +79,16 @@ objects[7] = SDFObject(
     transform=Transform(vec3(0, 0.809, 0), vec3(90, 0, 0), vec3(0.2, 0.2, 0.01)),
     material=Material(vec3(1, 1, 1) * 1, vec3(100)),
 )
+random.seed(0)
+for i in range(8, num_objects):
+    objects[i] = SDFObject(
+        transform=Transform(
+            vec3(*(random.uniform(-0.75, 0.75) for _ in range(3))),
+            vec3(*(random.uniform(0, 360) for _ in range(3))),
+            vec3(1, 1, 1) * random.uniform(0.02, 0.06),
+        ),
+        material=Material(vec3(*(random.uniform(0, 0.6) for _ in range(3))), vec3(1)),
+    )
 
 
 @ti.func
@@ -66,15 +109,57 @@ def signed_distance(obj: SDFObject, pos: vec3) -> float:
 
 
 @ti.func
-def nearest_object(p: vec3):
-    index, min_dis = 0, 1e32
-    for i in ti.static(range(8)):
-        dis = signed_distance(objects[i], p)
-        if dis < min_dis:
-            min_dis, index = dis, i
+def box_distance(lower: vec3, upper: vec3, p: vec3) -> float:
+    return length(max(max(lower - p, p - upper), 0))
+
+
+@ti.func
+def nearest_object(p: vec3, index: int, min_dis: float):
+    """
+    objects whose bounding box is farther than the closest distance found so far are skipped,
+    start from index, min_dis = 0, 1e32 for a full search
+    """
+    for i in range(num_objects):
+        if box_distance(bound_min[i], bound_max[i], p) < min_dis:
+            dis = signed_distance(objects[i], p)
+            if dis < min_dis:
+                min_dis, index = dis, i
     return index, min_dis
 
 
+@ti.func
+def grid_distance(p: vec3):
+    """
+    trilinear lookup of the baked distance and the object at the closest node,
+    outside of the grid the distance to the grid is a safe step towards it
+    """
+    lower = grid_lower[None]
+    cell = grid_cell[None]
+    upper = lower + cell * (sdf_grid_resolution - 1)
+    outside = box_distance(lower, upper, p)
+    index, distance = 0, outside + cell
+    if outside <= 0.0:
+        f = (p - lower) / cell
+        base = ti.cast(min(floor(f), sdf_grid_resolution - 2), ti.i32)
+        w = f - base
+        distance = 0.0
+        for di, dj, dk in ti.static(ti.ndrange(2, 2, 2)):
+            weight = (w.x if di else 1 - w.x) * (w.y if dj else 1 - w.y) * (w.z if dk else 1 - w.z)
+            distance += weight * sdf_grid[base + ivec3(di, dj, dk)]
+        index = id_grid[ti.cast(min(floor(f + 0.5), sdf_grid_resolution - 1), ti.i32)]
+    return index, distance
+
+
+@ti.func
+def scene_distance(p: vec3):
+    index, distance = 0, 1e32
+    if ti.static(use_sdf_grid):
+        index, distance = grid_distance(p)
+    else:
+        index, distance = nearest_object(p, 0, 1e32)
+    return index, distance
+
+
 @ti.func
 def calc_normal(obj: SDFObject, p: vec3) -> vec3:
     e = vec2(1, -1) * 0.5773 * 0.005
@@ -92,7 +177,7 @@ def raycast(ray: Ray):
     index, t, position, hit = 0, 0.005, vec3(0), False
     for _ in range(64):
         position = ray.origin + ray.direction * t
-        index, distance = nearest_object(position)
+        index, distance = scene_distance(position)
 
         ld, d = d, distance
         if ld + d < s:
@@ -110,106 +195,260 @@ def raycast(ray: Ray):
         hit = err < 0.001
         if t > 5.0 or hit:
             break
+    if ti.static(use_sdf_grid):
+        if hit:
+            # the grid only knows the object at its nodes, the exact search starts from it
+            index, _ = nearest_object(position, index, signed_distance(objects[index], position))
     return objects[index], position, hit
 
 
 @ti.func
 def hemispheric_sampling(normal: vec3) -> vec3:
+    """
+    a uniform point on the unit sphere around the tip of the normal gives cosine-weighted directions,
+    the cosine and the pdf cancel and a diffuse bounce only scales the path by the albedo
+    """
     z = 2.0 * ti.random() - 1.0
     a = ti.random() * 2.0 * pi
     xy = sqrt(1.0 - z * z) * vec2(sin(a), cos(a))
     return normalize(normal + vec3(xy, z))
 
 
+@ti.func
+def is_emitter(material: Material) -> bool:
+    return dot(material.emission, vec3(0.299, 0.587, 0.114)) > 1.0
+
+
+@ti.func
+def sample_box(obj: SDFObject, pos: vec3):
+    """
+    uniform point on the faces of the box turned towards pos, the others cannot light it
+    :return: the point, the outward normal there and the area of the sampled faces, 0 inside the box
+    """
+    local = obj.transform.matrix @ (pos - obj.transform.position)
+    scale = obj.transform.scale
+    area = vec3(0)
+    for k in ti.static(range(3)):
+        if abs(local[k]) > scale[k]:
+            area[k] = 4.0 * scale[(k + 1) % 3] * scale[(k + 2) % 3]
+    pick = ti.random() * (area.x + area.y + area.z)
+    face = 0
+    if pick >= area.x + area.y:
+        face = 2
+    elif pick >= area.x:
+        face = 1
+    point = (2.0 * vec3(ti.random(), ti.random(), ti.random()) - 1.0) * scale
+    normal = vec3(0)
+    point[face] = sign(local[face]) * scale[face]
+    normal[face] = sign(local[face])
+    rotation = obj.transform.matrix.transpose()
+    return obj.transform.position + rotation @ point, rotation @ normal, area.x + area.y + area.z
+
+
+@ti.func
+def sample_light(position: vec3, normal: vec3) -> vec3:
+    """
+    next-event estimation, light reaching a diffuse point straight from a random emitter
+    :return: incoming radiance weighted by the cosine over pi, to be scaled by the albedo
+    """
+    radiance = vec3(0)
+    n = num_emitters[None]
+    if n > 0:
+        light = objects[emitters[min(int(ti.random() * n), n - 1)]]
+        point, light_normal, area = sample_box(light, position)
+        distance = length(point - position)
+        direction = (point - position) / distance
+        cos_surface = dot(normal, direction)
+        cos_light = -dot(light_normal, direction)
+        if area > 0 and cos_surface > 0 and cos_light > 0:
+            # anything hit clearly before the sampled point shadows it
+            _, blocker, hit = raycast(Ray(position, direction, vec3(1)))
+            if not hit or length(blocker - position) > distance - 0.01:
+                radiance = (light.material.albedo * light.material.emission
+                            * cos_surface * cos_light / (distance * distance) * area * n / pi)
+    return radiance
+
+
 @ti.func
 def raytrace(ray: Ray) -> Ray:
-    for _ in range(3):
+    """
+    ray.color enters as the throughput of the path and returns as the radiance it collected,
+    emitters only count when seen directly, afterwards they are reached by the shadow rays
+    """
+    radiance = vec3(0)
+    for depth in range(max_depth):
         object, position, hit = raycast(ray)
         if not hit:
-            ray.color = vec3(0)
+            break
+        if is_emitter(object.material):
+            if depth == 0:
+                radiance += ray.color * object.material.albedo * object.material.emission
             break
 
         normal = calc_normal(object, position)
-        ray.direction = hemispheric_sampling(normal)
         ray.color *= object.material.albedo
+        radiance += ray.color * sample_light(position, normal)
+        if depth + 1 >= roulette_depth:
+            survival = min(max(ray.color.x, ray.color.y, ray.color.z), 1.0)
+            if ti.random() >= survival:
+                break
+            ray.color /= survival
+        ray.direction = hemispheric_sampling(normal)
         ray.origin = position
-
-        intensity = dot(ray.color, vec3(0.299, 0.587, 0.114))
-        ray.color *= object.material.emission
-        visible = dot(ray.color, vec3(0.299, 0.587, 0.114))
-        if intensity < visible or visible < 0.000001:
-            break
+    ray.color = radiance
     return ray
 
 
 @ti.kernel
-def build_scene():
+def find_emitters():
+    num_emitters[None] = 0
+    ti.loop_config(serialize=True)
+    for i in range(num_objects):
+        if is_emitter(objects[i].material):
+            emitters[num_emitters[None]] = i
+            num_emitters[None] += 1
+
+
+@ti.kernel
+def build_transforms():
     for i in objects:
         rotation = radians(objects[i].transform.rotation)
         objects[i].transform.matrix = rotate(rotation)
+        # the matrix maps world to object space, its transpose maps the box half extents back
+        extent = abs(objects[i].transform.matrix.transpose()) @ objects[i].transform.scale
+        bound_min[i] = objects[i].transform.position - extent
+        bound_max[i] = objects[i].transform.position + extent
 
 
 @ti.kernel
-def render(camera_position: vec3, camera_lookat: vec3, camera_up: vec3):
-    for i, j in image_pixels:
-        z = normalize(camera_position - camera_lookat)
-        x = normalize(cross(camera_up, z))
-        y = cross(z, x)
+def bake_sdf_grid():
+    for i, j, k in sdf_grid:
+        index, distance = nearest_object(grid_lower[None] + vec3(i, j, k) * grid_cell[None], 0, 1e32)
+        sdf_grid[i, j, k] = distance
+        id_grid[i, j, k] = index
+
+
+def build_scene():
+    build_transforms()
+    find_emitters()
+    if use_sdf_grid:
+        lower = bound_min.to_numpy().min(axis=0)
+        upper = bound_max.to_numpy().max(axis=0)
+        # two cells of margin so that the surfaces lie well inside the grid
+        cell = float((upper - lower).max()) / (sdf_grid_resolution - 5)
+        grid_lower[None] = vec3(*(lower - 2 * cell))
+        grid_cell[None] = cell
+        bake_sdf_grid()
+
+
+@ti.func
+def camera_ray(camera_position: vec3, camera_lookat: vec3, camera_up: vec3, uv: vec2) -> vec3:
+    z = normalize(camera_position - camera_lookat)
+    x = normalize(cross(camera_up, z))
+    y = cross(z, x)
+
+    half_width = half_height = tan(radians(35) * 0.5)
+    lower_left_corner = camera_position - half_width * x - half_height * y - z
+    horizontal = 2.0 * half_width * x
+    vertical = 2.0 * half_height * y
 
-        half_width = half_height = tan(radians(35) * 0.5)
-        lower_left_corner = camera_position - half_width * x - half_height * y - z
-        horizontal = 2.0 * half_width * x
-        vertical = 2.0 * half_height * y
+    po = lower_left_corner + uv.x * horizontal + uv.y * vertical
+    return normalize(po - camera_position)
+
+
+@ti.func
+def tone_map(color: vec3) -> vec3:
+    color = pow(color, vec3(1.0 / 2.2))
+    color = (
+        mat3(
+            0.597190,
+            0.35458,
+            0.04823,
+            0.07600,
+            0.90834,
+            0.01566,
+            0.02840,
+            0.13383,
+            0.83777,
+        )
+        @ color
+    )
+    color = (color * (color + 0.024578) - 0.0000905) / (color * (0.983729 * color + 0.4329510) + 0.238081)
+    color = (
+        mat3(
+            1.60475,
+            -0.531,
+            -0.0736,
+            -0.102,
+            1.10813,
+            -0.00605,
+            -0.00327,
+            -0.07276,
+            1.07602,
+        )
+        @ color
+    )
+    return clamp(color, 0, 1)
 
+
+@ti.kernel
+def render(camera_position: vec3, camera_lookat: vec3, camera_up: vec3):
+    for i, j in image_pixels:
         uv = (vec2(i, j) + vec2(ti.random(), ti.random())) / vec2(image_resolution)
-        po = lower_left_corner + uv.x * horizontal + uv.y * vertical
-        rd = normalize(po - camera_position)
+        rd = camera_ray(camera_position, camera_lookat, camera_up, uv)
 
         ray = raytrace(Ray(camera_position, rd, vec3(1)))
         buffer = image_buffer[i, j]
         buffer += vec4(ray.color, 1.0)
         image_buffer[i, j] = buffer
 
-        color = buffer.rgb / buffer.a
-        color = pow(color, vec3(1.0 / 2.2))
-        color = (
-            mat3(
-                0.597190,
-                0.35458,
-                0.04823,
-                0.07600,
-                0.90834,
-                0.01566,
-                0.02840,
-                0.13383,
-                0.83777,
-            )
-            @ color
-        )
-        color = (color * (color + 0.024578) - 0.0000905) / (color * (0.983729 * color + 0.4329510) + 0.238081)
-        color = (
-            mat3(
-                1.60475,
-                -0.531,
-                -0.0736,
-                -0.102,
-                1.10813,
-                -0.00605,
-                -0.00327,
-                -0.07276,
-                1.07602,
-            )
-            @ color
-        )
-        image_pixels[i, j] = clamp(color, 0, 1)
+        if ti.static(use_denoiser):
+            for d in ti.static(range(3)):
+                linear_color[i, j, d] = buffer[d] / buffer.a
+        else:
+            image_pixels[i, j] = tone_map(buffer.rgb / buffer.a)
+
+
+@ti.kernel
+def capture_gbuffer(camera_position: vec3, camera_lookat: vec3, camera_up: vec3):
+    """
+    distance, normal and albedo of the first hit through the center of every pixel
+    """
+    for i, j in image_pixels:
+        uv = (vec2(i, j) + 0.5) / vec2(image_resolution)
+        rd = camera_ray(camera_position, camera_lookat, camera_up, uv)
+        object, position, hit = raycast(Ray(camera_position, rd, vec3(1)))
+        depth, normal, albedo = 1e32, -rd, vec3(0)
+        if hit:
+            depth = length(position - camera_position)
+            normal = calc_normal(object, position)
+            albedo = object.material.albedo
+        depth_buffer[i, j] = depth
+        for d in ti.static(range(3)):
+            normal_buffer[i, j, d] = normal[d]
+            albedo_buffer[i, j, d] = albedo[d]
+
+
+@ti.kernel
+def show_denoised(image: ti.template()):
+    for i, j in image_pixels:
+        image_pixels[i, j] = tone_map(vec3(image[i, j, 0], image[i, j, 1], image[i, j, 2]))
 
 
 def main():
     window = ti.ui.Window("Cornell Box", image_resolution)
     canvas = window.get_canvas()
     build_scene()
+    camera = vec3(0, 0, 3.5), vec3(0, 0, -1), vec3(0, 1, 0)
+    denoiser = None
+    if use_denoiser:
+        # no color weight, single bright light samples would stop the filter
+        denoiser = Denoiser(image_resolution, denoise_iterations, sigma_color=0.0)
+        capture_gbuffer(*camera)
     while window.running:
-        render(vec3(0, 0, 3.5), vec3(0, 0, -1), vec3(0, 1, 0))
+        render(*camera)
+        if use_denoiser:
+            show_denoised(denoiser.run(linear_color, normal_buffer, albedo_buffer, depth_buffer))
         canvas.set_image(image_pixels)
         window.show()
 
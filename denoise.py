@@ -0,0 +1,89 @@
+import taichi as ti
+from format import flt_default
+vec = ti.math.vec3
+
+# B3 spline weights of the 5x5 a-trous kernel
+KERNEL = (1.0 / 16.0, 1.0 / 4.0, 3.0 / 8.0, 1.0 / 4.0, 1.0 / 16.0)
+
+
+@ti.data_oriented
+class Denoiser(object):
+    """
+    edge-avoiding a-trous wavelet filter (Dammertz et al. 2010)
+    the image is divided by the albedo so that textures and particle colors are not blurred,
+    the remaining lighting is smoothed by 5x5 filters with growing holes, weighted down across
+    changes of color, normal and depth, and multiplied by the albedo again
+    inputs are fields of the renderer layout, (rows, columns, 3) and (rows, columns) for the depth
+    """
+    def __init__(self, resolution, iterations=2, sigma_color=1.0, sigma_normal=0.1, sigma_depth=0.01):
+        """
+        :param resolution: number of pixels (rows, columns)
+        :param iterations: number of filter passes, the footprint doubles with every pass
+        :param sigma_color: color tolerance of the first pass, halved with every pass,
+            0 filters on the geometry only, which suits path tracing where fireflies would stop the filter
+        :param sigma_normal: tolerance on 1 - cos of the angle between normals
+        :param sigma_depth: tolerance on the relative depth difference
+        """
+        self.iterations = iterations
+        self.sigma_color = sigma_color
+        self.sigma_normal = sigma_normal
+        self.sigma_depth = sigma_depth
+        self.ping = ti.Vector.field(3, dtype=flt_default, shape=(resolution[0], resolution[1]))
+        self.pong = ti.Vector.field(3, dtype=flt_default, shape=(resolution[0], resolution[1]))
+        self.output = ti.field(dtype=flt_default, shape=(resolution[0], resolution[1], 3))
+
+    def run(self, color, normal, albedo, depth):
+        """
+        :return: output field with the denoised color
+        """
+        self.demodulate(color, albedo)
+        src, dst = self.ping, self.pong
+        for index_pass in range(self.iterations):
+            self.filter_pass(src, dst, normal, depth, 2 ** index_pass, self.sigma_color * 0.5 ** index_pass)
+            src, dst = dst, src
+        self.modulate(src, albedo)
+        return self.output
+
+    @ti.func
+    def get_vec(self, field: ti.template(), i: ti.i32, j: ti.i32) -> vec:
+        return vec(field[i, j, 0], field[i, j, 1], field[i, j, 2])
+
+    @ti.kernel
+    def demodulate(self, color: ti.template(), albedo: ti.template()):
+        for i, j in self.ping:
+            self.ping[i, j] = self.get_vec(color, i, j) / ti.max(self.get_vec(albedo, i, j), 1.0e-3)
+
+    @ti.kernel
+    def modulate(self, src: ti.template(), albedo: ti.template()):
+        for i, j in src:
+            color = src[i, j] * ti.max(self.get_vec(albedo, i, j), 1.0e-3)
+            for d in ti.static(range(3)):
+                self.output[i, j, d] = color[d]
+
+    @ti.kernel
+    def filter_pass(self, src: ti.template(), dst: ti.template(), normal: ti.template(), depth: ti.template(),
+                    step: ti.i32, sigma_color: flt_default):
+        rows, cols = src.shape[0], src.shape[1]
+        for i, j in src:
+            color_p = src[i, j]
+            normal_p = self.get_vec(normal, i, j)
+            depth_p = depth[i, j]
+            color_sum = vec(0.0, 0.0, 0.0)
+            weight_sum = 0.0
+            for di, dj in ti.static(ti.ndrange(5, 5)):
+                ii = ti.math.clamp(i + (di - 2) * step, 0, rows - 1)
+                jj = ti.math.clamp(j + (dj - 2) * step, 0, cols - 1)
+                color_q = src[ii, jj]
+                diff = color_p - color_q
+                weight_color = 1.0
+                if sigma_color > 0.0:
+                    weight_color = ti.exp(-diff.dot(diff) / (sigma_color * sigma_color))
+                weight_normal = ti.exp(-ti.max(1.0 - normal_p.dot(self.get_vec(normal, ii, jj)), 0.0) /
+                                       self.sigma_normal)
+                depth_q = depth[ii, jj]
+                weight_depth = ti.exp(-ti.abs(depth_p - depth_q) /
+                                      (self.sigma_depth * ti.min(depth_p, depth_q) + 1.0e-6))
+                weight = KERNEL[di] * KERNEL[dj] * weight_color * weight_normal * weight_depth
+                color_sum += color_q * weight
+                weight_sum += weight
+            dst[i, j] = color_sum / weight_sum
@@ -0,0 +1,324 @@
+import numpy as np
+import taichi as ti
+from format import flt_default, INF
+from light_comput import DIRECTIONAL
+vec = ti.math.vec3
+
+# pixels along each edge of a tile
+TILE_SIZE = 8
+# bits of the bloom filter of every tile, a power of two
+BLOOM_BITS = 4096
+# the hash keeps the top log2(BLOOM_BITS) bits of the product
+BLOOM_SHIFT = 33 - BLOOM_BITS.bit_length()
+# cells along each edge of the grid over the scene box
+GRID_SIZE = 16
+GRID_WORDS = GRID_SIZE ** 3 // 32
+
+
+@ti.data_oriented
+class EditTracker(object):
+    """
+    remembers per tile of the image which spheres its rays may depend on, so that after an edit
+    only the tiles that can change are rendered again
+    every tile keeps a bloom filter of the spheres hit by its primary and secondary rays, and two
+    bitsets over a coarse grid on the scene box: the cells crossed by its secondary rays and the cells
+    holding its shading points (the origins of its shadow rays), shading points outside of the box
+    (e.g. on the far floor) are only bounded by a box
+    a sphere edit dirties the tiles that hit the sphere before, that see it now on screen, whose
+    secondary rays cross its new place, or that have shading points in its old or new shadow
+    """
+    def __init__(self, resolution, sphere, camera, light_computer, max_rad_ratio=100.0, margin=4.0):
+        """
+        :param resolution: number of pixels (rows, columns)
+        :param max_rad_ratio: spheres larger than this many times the median radius (e.g. the floor)
+            bound the scene from outside, the grid covers the box of the others
+        :param margin: the box is widened by this many times the largest of the other radii,
+            moving a sphere out of it dirties every tile
+        """
+        self.sphere = sphere
+        self.camera = camera
+        self.light_computer = light_computer
+        self.max_rad_ratio = max_rad_ratio
+        self.margin = margin
+        self.tiles = ((resolution[0] + TILE_SIZE - 1) // TILE_SIZE, (resolution[1] + TILE_SIZE - 1) // TILE_SIZE)
+        self.bloom = ti.field(dtype=ti.u32, shape=(self.tiles[0], self.tiles[1], BLOOM_BITS // 32))
+        self.ray_cells = ti.field(dtype=ti.u32, shape=(self.tiles[0], self.tiles[1], GRID_WORDS))
+        self.hit_cells = ti.field(dtype=ti.u32, shape=(self.tiles[0], self.tiles[1], GRID_WORDS))
+        self.hit_min = ti.field(dtype=flt_default, shape=(self.tiles[0], self.tiles[1], 3))
+        self.hit_max = ti.field(dtype=flt_default, shape=(self.tiles[0], self.tiles[1], 3))
+        self.dirty = ti.field(dtype=ti.i32, shape=(self.tiles[0], self.tiles[1]))
+        self.number_dirty = ti.field(dtype=ti.i32, shape=(1,))
+        # box of the small spheres with the margin, divided into the grid
+        self.scene_min = ti.field(dtype=flt_default, shape=(3,))
+        self.scene_max = ti.field(dtype=flt_default, shape=(3,))
+        self.reset()
+
+    def reset(self):
+        """
+        forget every tile, call it whenever the whole image is rendered again
+        """
+        self.update_bounds()
+        self.dirty.fill(1)
+        self.clear_dirty()
+
+    def update_bounds(self):
+        pos_rad = self.sphere.pos_rad.to_numpy()[:self.sphere.number].astype(np.float64)
+        small = pos_rad[:, 3] <= np.median(pos_rad[:, 3]) * self.max_rad_ratio
+        margin = self.margin * pos_rad[small, 3].max()
+        self.scene_min.from_numpy(((pos_rad[small, :3] - pos_rad[small, 3:]).min(axis=0) - margin).astype(np.float32))
+        self.scene_max.from_numpy(((pos_rad[small, :3] + pos_rad[small, 3:]).max(axis=0) + margin).astype(np.float32))
+
+    @ti.kernel
+    def clear_dirty(self):
+        """
+        empty the records of the dirty tiles, their pixels are rendered again
+        """
+        for tile_i, tile_j in self.dirty:
+            if self.dirty[tile_i, tile_j] == 1:
+                for w in range(BLOOM_BITS // 32):
+                    self.bloom[tile_i, tile_j, w] = ti.u32(0)
+                for w in range(GRID_WORDS):
+                    self.ray_cells[tile_i, tile_j, w] = ti.u32(0)
+                    self.hit_cells[tile_i, tile_j, w] = ti.u32(0)
+                for d in ti.static(range(3)):
+                    self.hit_min[tile_i, tile_j, d] = INF
+                    self.hit_max[tile_i, tile_j, d] = -INF
+                self.dirty[tile_i, tile_j] = 0
+        self.number_dirty[0] = 0
+
+    @ti.func
+    def get_bit(self, index: ti.i32):
+        """
+        :return: word and bit of the sphere in the bloom filter, Fibonacci hashing of the index
+        """
+        h = (ti.cast(index, ti.u32) * ti.u32(2654435761)) >> ti.u32(BLOOM_SHIFT)
+        return ti.cast(h >> ti.u32(5), ti.i32), h & ti.u32(31)
+
+    @ti.func
+    def get_scene_box(self):
+        return (vec(self.scene_min[0], self.scene_min[1], self.scene_min[2]),
+                vec(self.scene_max[0], self.scene_max[1], self.scene_max[2]))
+
+    @ti.func
+    def get_box(self, box_min: ti.template(), box_max: ti.template(), tile_i: ti.i32, tile_j: ti.i32):
+        return (vec(box_min[tile_i, tile_j, 0], box_min[tile_i, tile_j, 1], box_min[tile_i, tile_j, 2]),
+                vec(box_max[tile_i, tile_j, 0], box_max[tile_i, tile_j, 1], box_max[tile_i, tile_j, 2]))
+
+    @ti.func
+    def get_cell_coord(self, pos: vec):
+        scene_min, scene_max = self.get_scene_box()
+        return ti.math.clamp(ti.cast(ti.floor((pos - scene_min) / (scene_max - scene_min) * GRID_SIZE), ti.i32),
+                             0, GRID_SIZE - 1)
+
+    @ti.func
+    def set_cell(self, cells: ti.template(), tile_i: ti.i32, tile_j: ti.i32, pos: vec):
+        coord = self.get_cell_coord(pos)
+        index_cell = (coord[0] * GRID_SIZE + coord[1]) * GRID_SIZE + coord[2]
+        ti.atomic_or(cells[tile_i, tile_j, index_cell >> 5], ti.u32(1) << ti.u32(index_cell & 31))
+
+    @ti.func
+    def any_cell(self, cells: ti.template(), tile_i: ti.i32, tile_j: ti.i32, lower: vec, upper: vec) -> ti.i32:
+        """
+        whether a cell overlapping the box from lower to upper is set
+        """
+        coord_lower = self.get_cell_coord(lower)
+        coord_upper = self.get_cell_coord(upper)
+        res = 0
+        for x, y, z in ti.ndrange((coord_lower[0], coord_upper[0] + 1), (coord_lower[1], coord_upper[1] + 1),
+                                  (coord_lower[2], coord_upper[2] + 1)):
+            index_cell = (x * GRID_SIZE + y) * GRID_SIZE + z
+            if cells[tile_i, tile_j, index_cell >> 5] & (ti.u32(1) << ti.u32(index_cell & 31)):
+                res = 1
+        return res
+
+    @ti.func
+    def clip(self, origin: vec, vec_d: vec, box_min: vec, box_max: vec, t_max: flt_default):
+        """
+        slab test, part [t_enter, t_exit] of the ray from origin up to t_max inside the box,
+        empty if t_enter > t_exit
+        """
+        t_enter = 0.0
+        t_exit = t_max
+        for d in ti.static(range(3)):
+            if ti.abs(vec_d[d]) > 1.0e-12:
+                t_lower = (box_min[d] - origin[d]) / vec_d[d]
+                t_upper = (box_max[d] - origin[d]) / vec_d[d]
+                t_enter = ti.max(t_enter, ti.min(t_lower, t_upper))
+                t_exit = ti.min(t_exit, ti.max(t_lower, t_upper))
+            elif origin[d] < box_min[d] or origin[d] > box_max[d]:
+                t_exit = -1.0
+        return t_enter, t_exit
+
+    @ti.func
+    def get_step(self, vec_d: vec) -> flt_default:
+        """
+        half a cell along the ray, a cell whose corner is cut between two steps touches a visited one
+        """
+        scene_min, scene_max = self.get_scene_box()
+        return 0.5 * ((scene_max - scene_min) / GRID_SIZE).min() / vec_d.norm()
+
+    @ti.func
+    def record_hit(self, i: ti.i32, j: ti.i32, index: ti.i32, pos: vec):
+        """
+        a ray of pixel (i, j) hit sphere index at pos and shades it there
+        """
+        tile_i, tile_j = i // TILE_SIZE, j // TILE_SIZE
+        word, bit = self.get_bit(index)
+        ti.atomic_or(self.bloom[tile_i, tile_j, word], ti.u32(1) << bit)
+        scene_min, scene_max = self.get_scene_box()
+        if (scene_min <= pos).all() and (pos <= scene_max).all():
+            self.set_cell(self.hit_cells, tile_i, tile_j, pos)
+        else:
+            for d in ti.static(range(3)):
+                ti.atomic_min(self.hit_min[tile_i, tile_j, d], pos[d])
+                ti.atomic_max(self.hit_max[tile_i, tile_j, d], pos[d])
+
+    @ti.func
+    def record_ray(self, i: ti.i32, j: ti.i32, origin: vec, vec_d: vec, t: flt_default):
+        """
+        a secondary ray of pixel (i, j) from origin to its hit at t (INF if it escaped),
+        only the part inside the scene box is kept since an edited sphere never leaves it
+        """
+        scene_min, scene_max = self.get_scene_box()
+        t_enter, t_exit = self.clip(origin, vec_d, scene_min, scene_max, t)
+        if t_enter <= t_exit:
+            step = self.get_step(vec_d)
+            for k in range(ti.cast((t_exit - t_enter) / step, ti.i32) + 2):
+                self.set_cell(self.ray_cells, i // TILE_SIZE, j // TILE_SIZE,
+                              origin + ti.min(t_enter + k * step, t_exit) * vec_d)
+
+    @ti.func
+    def get_shadow(self, index_light: ti.i32, center: vec, rad: flt_default):
+        """
+        the shadow of the sphere as a half line with a width growing along it,
+        a cylinder for directional lights and a cone from the light otherwise
+        :return: origin, unit direction, width at the origin and growth of the width per unit length
+        """
+        light = self.light_computer.lights[index_light]
+        origin = center
+        vec_d = -light.direction
+        width = rad
+        growth = 0.0
+        if light.kind != DIRECTIONAL:
+            axis = center - light.position
+            dist_axis = axis.norm()
+            vec_d = axis / dist_axis
+            if dist_axis <= rad * 1.001:
+                # the light is inside the sphere, everything is in its shadow
+                origin = light.position
+                width = INF
+            else:
+                origin = light.position + vec_d * (dist_axis - rad)
+                growth = rad / ti.sqrt(dist_axis * dist_axis - rad * rad)
+                width = growth * (dist_axis - rad)
+        return origin, vec_d, width, growth
+
+    @ti.func
+    def in_shadow(self, tile_i: ti.i32, tile_j: ti.i32, index_light: ti.i32, center: vec,
+                  rad: flt_default, shadow_reach: flt_default) -> ti.i32:
+        """
+        conservative test whether the sphere may shadow a shading point of the tile from the light
+        :param shadow_reach: see ShadowMap.get_reach, the shadow of the light served by the shadow map
+            is widened by it and starts at the top of the sphere
+        """
+        origin, vec_d, width, growth = self.get_shadow(index_light, center, rad)
+        if index_light == self.light_computer.shadow_map_light and shadow_reach > 0.0:
+            origin -= vec_d * (rad + shadow_reach)
+            width += shadow_reach
+        res = 0
+        if width >= INF:
+            res = 1
+        hit_min, hit_max = self.get_box(self.hit_min, self.hit_max, tile_i, tile_j)
+        if res == 0 and (hit_min <= hit_max).all():
+            # the far shading points, the shadow grown to its width at the far corner of their box
+            dist_far = ti.max(ti.abs(hit_min - origin), ti.abs(hit_max - origin)).norm()
+            width_far = width + growth * dist_far
+            t_enter, t_exit = self.clip(origin, vec_d, hit_min - width_far, hit_max + width_far, INF)
+            if t_enter <= t_exit:
+                res = 1
+        if res == 0:
+            scene_min, scene_max = self.get_scene_box()
+            t_enter, t_exit = self.clip(origin, vec_d, scene_min, scene_max, INF)
+            if t_enter <= t_exit:
+                step = self.get_step(vec_d)
+                for k in range(ti.cast((t_exit - t_enter) / step, ti.i32) + 2):
+                    t = ti.min(t_enter + k * step, t_exit)
+                    # a step of margin covers the shadow between two steps
+                    reach = width + growth * t + step
+                    pos = origin + t * vec_d
+                    if self.any_cell(self.hit_cells, tile_i, tile_j, pos - reach, pos + reach):
+                        res = 1
+                        break
+        return res
+
+    @ti.kernel
+    def mark_dirty(self, index: ti.i32, old: ti.math.vec4, new: ti.math.vec4, moved: ti.i32,
+                   screen: ti.math.ivec4, shadow_reach: flt_default):
+        """
+        :param old: position and radius of the sphere before the edit
+        :param new: position and radius after the edit
+        :param moved: 0 if only the color or the material changed, the shadows stay as they are
+        :param screen: first and last row, first and last column the sphere may cover now
+        :param shadow_reach: see in_shadow, 0 without a shadow map
+        """
+        scene_min, scene_max = self.get_scene_box()
+        # the secondary rays may cut the corner of a cell next to the ones they marked
+        cell = (scene_max - scene_min) / GRID_SIZE
+        for tile_i, tile_j in self.dirty:
+            dirty = 0
+            word, bit = self.get_bit(index)
+            if self.bloom[tile_i, tile_j, word] & (ti.u32(1) << bit):
+                dirty = 1
+            if moved and dirty == 0:
+                if screen[0] <= (tile_i + 1) * TILE_SIZE - 1 and tile_i * TILE_SIZE <= screen[1] and \
+                        screen[2] <= (tile_j + 1) * TILE_SIZE - 1 and tile_j * TILE_SIZE <= screen[3]:
+                    dirty = 1
+                elif self.any_cell(self.ray_cells, tile_i, tile_j, new.xyz - new.w - cell, new.xyz + new.w + cell):
+                    dirty = 1
+                else:
+                    for index_light in range(self.light_computer.number_light):
+                        if dirty == 0:
+                            if self.in_shadow(tile_i, tile_j, index_light, old.xyz, old.w, shadow_reach) or \
+                                    self.in_shadow(tile_i, tile_j, index_light, new.xyz, new.w, shadow_reach):
+                                dirty = 1
+            if dirty:
+                self.dirty[tile_i, tile_j] = 1
+                self.number_dirty[0] += 1
+
+    def project(self, pos_rad: np.ndarray):
+        """
+        :return: first and last row, first and last column of the pixels the sphere may cover,
+            all of them if it reaches behind the viewport
+        """
+        rows, cols = self.camera.resolution[0], self.camera.resolution[1]
+        rotation = self.camera.rotation[None].to_numpy().astype(np.float64)
+        center = rotation @ (pos_rad[:3] - self.camera.origin[None].to_numpy())
+        rad = pos_rad[3]
+        if center[2] - rad <= 1.0e-6 * self.camera.distance:
+            return np.array([0, rows - 1, 0, cols - 1], dtype=np.int32)
+        # the extreme ratios over the corners of the bounding box bound the projection
+        z = np.array([center[2] - rad, center[2] + rad])
+        u = np.array([center[1] - rad, center[1] + rad])[:, None] / z[None, :] * self.camera.distance
+        v = np.array([center[0] - rad, center[0] + rad])[:, None] / z[None, :] * self.camera.distance
+        i = u / self.camera.height * rows + rows / 2.0
+        j = v / self.camera.width * cols + cols / 2.0
+        return np.array([np.floor(i.min()) - 1, np.ceil(i.max()) + 1,
+                         np.floor(j.min()) - 1, np.ceil(j.max()) + 1]).clip(-1, max(rows, cols)).astype(np.int32)
+
+    def mark(self, index: int, old: np.ndarray, new: np.ndarray, moved: bool) -> int:
+        """
+        mark the tiles an edit of sphere index can change
+        :return: number of dirty tiles
+        """
+        inside = (new[:3] - new[3] >= self.scene_min.to_numpy()).all() and \
+            (new[:3] + new[3] <= self.scene_max.to_numpy()).all()
+        if moved and not inside:
+            # the grid only covers the old scene box
+            self.update_bounds()
+            self.dirty.fill(1)
+            self.number_dirty[0] = self.tiles[0] * self.tiles[1]
+        else:
+            shadow_map = self.light_computer.shadow_map
+            self.mark_dirty(index, ti.math.vec4(*old), ti.math.vec4(*new), int(moved),
+                            ti.math.ivec4(*self.project(new)), 0.0 if shadow_map is None else shadow_map.get_reach())
+        return self.number_dirty[0]
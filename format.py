@@ -1,4 +1,6 @@
+import numpy as np
 import taichi as ti
 
 flt_default = ti.f32
+np_flt_default = np.float32
 INF = 1.0e8
@@ -0,0 +1,133 @@
+import os
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# rows compressed per step of the png writer
+PNG_ROWS = 256
+
+
+def get_image(canvas: np.ndarray) -> np.ndarray:
+    """
+    view of a framebuffer in the window layout (columns, rows, 3) as an image (rows, columns, 3),
+    no pixel is copied, row 0 stays the bottom of the image
+    """
+    return canvas.transpose(1, 0, 2)
+
+
+def quantize(image: np.ndarray) -> np.ndarray:
+    """
+    colors in [0, 1] to 8 bits, rounded to the nearest level
+    """
+    return (np.clip(image, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+
+def write_png_chunk(f, kind: bytes, data: bytes):
+    f.write(struct.pack('>I', len(data)))
+    f.write(kind)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+
+def write_png(file_name: str, image: np.ndarray, origin='lower', level=6):
+    """
+    write an 8 bit rgb png a few rows at a time, the image may be a memory-mapped array larger than the memory
+    :param image: (rows, columns, 3) uint8
+    :param origin: 'lower' if row 0 is the bottom of the image, as in the canvas
+    :param level: zlib compression level
+    """
+    rows, cols = image.shape[0], image.shape[1]
+    compressor = zlib.compressobj(level)
+    with open(file_name, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits per channel, truecolor, no interlacing
+        write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', cols, rows, 8, 2, 0, 0, 0))
+        for start in range(0, rows, PNG_ROWS):
+            stop = min(start + PNG_ROWS, rows)
+            block = image[rows - stop:rows - start][::-1] if origin == 'lower' else image[start:stop]
+            # every scanline starts with its filter type, 0 leaves the bytes unfiltered
+            lines = np.zeros((stop - start, 1 + 3 * cols), dtype=np.uint8)
+            lines[:, 1:] = np.asarray(block, dtype=np.uint8).reshape(stop - start, 3 * cols)
+            data = compressor.compress(lines.tobytes())
+            if data:
+                write_png_chunk(f, b'IDAT', data)
+        write_png_chunk(f, b'IDAT', compressor.flush())
+        write_png_chunk(f, b'IEND', b'')
+
+
+def write_pfm(file_name: str, image: np.ndarray, origin='lower'):
+    """
+    write the float colors as a portable float map, which stores the bottom row first
+    """
+    image = image if origin == 'lower' else image[::-1]
+    with open(file_name, 'wb') as f:
+        # a negative scale marks little-endian floats
+        f.write('PF\n{} {}\n-1.0\n'.format(image.shape[1], image.shape[0]).encode())
+        f.write(np.ascontiguousarray(image, dtype='<f4').tobytes())
+
+
+def write_exr(file_name: str, image: np.ndarray, origin='lower'):
+    """
+    write the float colors as OpenEXR, needs the optional OpenEXR package
+    """
+    try:
+        import OpenEXR
+    except ImportError:
+        raise RuntimeError("Writing {} needs the OpenEXR package, pip install OpenEXR.".format(file_name))
+    image = image[::-1] if origin == 'lower' else image
+    header = {'compression': OpenEXR.ZIP_COMPRESSION, 'type': OpenEXR.scanlineimage}
+    with OpenEXR.File(header, {'RGB': np.ascontiguousarray(image, dtype=np.float32)}) as f:
+        f.write(file_name)
+
+
+def save_image(file_name: str, image: np.ndarray, origin='lower'):
+    """
+    write the exact pixels, the format follows the extension:
+    .png quantized to 8 bits, .pfm and .exr as floats, .npy as the float array with the top row first
+    :param image: (rows, columns, 3) colors in [0, 1], see get_image for the framebuffer
+    :param origin: 'lower' if row 0 is the bottom of the image, as in the framebuffer
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.png':
+        write_png(file_name, image if image.dtype == np.uint8 else quantize(image), origin)
+    elif extension == '.pfm':
+        write_pfm(file_name, image, origin)
+    elif extension == '.exr':
+        write_exr(file_name, image, origin)
+    elif extension == '.npy':
+        np.save(file_name, image[::-1] if origin == 'lower' else image)
+    else:
+        raise ValueError("Unknown image format '{}', expected .png, .pfm, .exr or .npy.".format(extension))
+
+
+class ImageWriter(object):
+    def __init__(self):
+        """
+        writes images on a background thread so that rendering goes on meanwhile
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def submit(self, file_name: str, image: np.ndarray, origin='lower'):
+        """
+        :param image: owned by the writer from now on, pass a copy such as the result of to_numpy
+        """
+        for future in self.pending:
+            if future.done():
+                # raise the errors of earlier writes
+                future.result()
+        self.pending = [future for future in self.pending if not future.done()]
+        self.pending.append(self.executor.submit(save_image, file_name, image, origin))
+
+    def wait(self):
+        """
+        block until every submitted image is written, errors of the writes are raised here
+        """
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
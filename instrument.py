@@ -0,0 +1,108 @@
+import json
+import time
+from contextlib import contextmanager
+import taichi as ti
+
+PRIMARY = 0
+REFLECTION = 1
+REFRACTION = 2
+SHADOW = 3
+# ray-sphere intersection tests
+INTERSECTION = 4
+# shadow traversals stopped at the first occluder
+EARLY_EXIT = 5
+# directional shadows answered by the shadow map instead of a ray
+SHADOW_LOOKUP = 6
+# bvh nodes taken from the traversal stack
+NODE = 7
+COUNTER_NAMES = ('primary', 'reflection', 'refraction', 'shadow', 'intersection', 'early_exit', 'shadow_lookup',
+                 'node')
+
+
+@ti.data_oriented
+class Counters(object):
+    def __init__(self, enabled=False):
+        """
+        counters shared by the renderer, the light computer and the bvh
+        :param enabled: False compiles the counting out of the kernels
+        """
+        self.enabled = enabled
+        self.count = ti.field(dtype=ti.i64, shape=(len(COUNTER_NAMES),))
+
+    @ti.func
+    def add(self, index: ti.template(), value=1):
+        if ti.static(self.enabled):
+            ti.atomic_add(self.count[index], value)
+
+    def reset(self):
+        self.count.fill(0)
+
+    def to_dict(self) -> dict:
+        count = self.count.to_numpy()
+        return {name: int(count[k]) for k, name in enumerate(COUNTER_NAMES)}
+
+
+class Instrumentation(object):
+    def __init__(self, enabled=False):
+        """
+        ray counters and wall time of the kernels, collected frame by frame
+        :param enabled: False removes the counting from the kernels and skips the timing
+        """
+        self.enabled = enabled
+        self.counters = Counters(enabled)
+        self.timing = {}
+        self.frame = 0
+
+    @contextmanager
+    def time(self, name: str):
+        """
+        add the wall time of the enclosed kernel launches to name,
+        taichi is synchronized before and after so the time is not hidden by asynchronous launches
+        """
+        if not self.enabled:
+            yield
+            return
+        ti.sync()
+        time_start = time.perf_counter()
+        yield
+        ti.sync()
+        calls, total = self.timing.get(name, (0, 0.0))
+        self.timing[name] = (calls + 1, total + time.perf_counter() - time_start)
+
+    def end_frame(self) -> dict:
+        """
+        collect the counters and timings of the current frame and start a new one
+        """
+        record = {'frame': self.frame,
+                  'counters': self.counters.to_dict() if self.enabled else {},
+                  'kernels': {name: {'calls': calls, 'seconds': total}
+                              for name, (calls, total) in self.timing.items()}}
+        self.counters.reset()
+        self.timing = {}
+        self.frame += 1
+        return record
+
+    @staticmethod
+    def summary(record: dict) -> str:
+        lines = ['frame {}'.format(record['frame'])]
+        counters = record['counters']
+        if counters:
+            rays = counters['primary'] + counters['reflection'] + counters['refraction'] + counters['shadow']
+            for name in COUNTER_NAMES:
+                lines.append('  {:<14s}{:>16d}'.format(name, counters[name]))
+            if counters['shadow'] > 0:
+                lines.append('  {:<14s}{:>15.1f}%'.format(
+                    'shadow exits', 100.0 * counters['early_exit'] / counters['shadow']))
+            if rays > 0:
+                lines.append('  {:<14s}{:>16.1f}'.format('tests per ray', counters['intersection'] / rays))
+        for name, kernel in record['kernels'].items():
+            lines.append('  {:<24s}{:>6d} calls {:>10.4f} s'.format(name, kernel['calls'], kernel['seconds']))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def dump(record: dict, file_name: str):
+        """
+        append the record to a json lines file, one line per frame
+        """
+        with open(file_name, 'a') as f:
+            f.write(json.dumps(record) + '\n')
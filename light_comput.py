@@ -1,135 +1,282 @@
+import json
+import numpy as np
 import taichi as ti
 from format import INF, flt_default
 from linalg import solve_quadratic_equation
+from instrument import Counters, SHADOW, SHADOW_LOOKUP, INTERSECTION, EARLY_EXIT
+from shadow_map import ShadowMap
 vec = ti.math.vec3
 
+DIRECTIONAL = 0
+POINT = 1
+SPOT = 2
+LIGHT_TYPES = {'directional': DIRECTIONAL, 'point': POINT, 'spot': SPOT}
+# size of the per-hit light table, the light list may not be longer
+MAX_LIGHTS = 32
+# direction: towards the source for directional lights, along the cone axis for spot lights
+# range: distance at which point and spot lights fade out, 0 means no falloff
+Light = ti.types.struct(kind=ti.i32, intensity=flt_default, position=vec, direction=vec,
+                        cos_inner=flt_default, cos_outer=flt_default, range=flt_default)
+# the former fixed lighting
+DEFAULT_LIGHTS = {'ambient': 0.42,
+                  'lights': [{'type': 'directional', 'intensity': 0.36, 'direction': [-1.0, 0.5, 0.5]},
+                             {'type': 'point', 'intensity': 0.38, 'position': [-2.0, 3.0, 2.0]}]}
+
+
+def load_lights(file_name: str) -> dict:
+    """
+    light list of a scene, e.g.
+    {"ambient": 0.3,
+     "lights": [{"type": "directional", "intensity": 0.3, "direction": [-1, 0.5, 0.5]},
+                {"type": "point", "intensity": 0.4, "position": [-2, 3, 2], "range": 10},
+                {"type": "spot", "intensity": 0.5, "position": [1, 2, 0], "direction": [0, -1, 0],
+                 "inner_angle": 20, "outer_angle": 30, "range": 8}]}
+    angles are in degrees, the inner angle may not exceed the outer one, equal angles give a hard edge,
+    a missing inner angle is taken equal to the outer one,
+    directional and spot lights need a direction
+    """
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def get_shadow_map_light(lights: dict) -> int:
+    """
+    :return: index of the first directional light, the one served by the shadow map, or -1
+    """
+    return next((k for k, light in enumerate(lights['lights']) if light['type'] == 'directional'), -1)
+
 
 @ti.data_oriented
 class LightComputer(object):
-    def __init__(self):
-        self.intensity_amb = 0.42  # ambient light
-        self.intensity_dir = 0.36  # directional light
-        self.intensity_point = 0.38  # point light
-        self.light_dir = vec(-1.0, 0.5, 0.5).normalized()  # point to light source
-        self.pos_light = vec(-2.0, 3.0, 2.0)  # point light
+    def __init__(self, bvh=None, counters=None, sphere=None, shadow_map_size=0, pcf_radius=1, lights=None,
+                 shadow_rays=2, min_contribution=1.0e-3):
+        """
+        :param bvh: acceleration structure answering the shadow rays,
+            None falls back to the linear scan over all spheres
+        :param counters: ray counters, None disables counting
+        :param sphere: spheres drawn into the shadow map
+        :param shadow_map_size: texels along each edge of the shadow map of the first directional light,
+            0 traces every shadow ray exactly
+        :param pcf_radius: filter radius of the shadow map in texels, 0 gives hard shadows
+        :param lights: light list as in load_lights, a file name, or None for DEFAULT_LIGHTS
+        :param shadow_rays: shadow rays per hit, with more contributing lights they are shared
+            by sampling the lights in proportion to their unshadowed contribution
+        :param min_contribution: lights contributing less than this to a hit get no shadow ray
+        """
+        if lights is None:
+            lights = DEFAULT_LIGHTS
+        elif isinstance(lights, str):
+            lights = load_lights(lights)
+        self.shadow_rays = shadow_rays
+        self.min_contribution = min_contribution
+        self.number_light = len(lights['lights'])
+        if self.number_light > MAX_LIGHTS:
+            raise ValueError("{} lights, at most {} are supported.".format(self.number_light, MAX_LIGHTS))
+        self.ambient = ti.field(dtype=flt_default, shape=(1,))
+        self.lights = Light.field(shape=(max(self.number_light, 1),))
+        self.use_shadow_map = False
+        self.set_lights(lights)
+        self.bvh = bvh
+        self.use_bvh = bvh is not None
+        self.counters = Counters() if counters is None else counters
+        # the shadow map serves the first directional light
+        self.shadow_map_light = get_shadow_map_light(lights)
+        self.use_shadow_map = shadow_map_size > 0 and self.shadow_map_light >= 0
+        self.shadow_map = ShadowMap(sphere, lights['lights'][self.shadow_map_light]['direction'],
+                                    shadow_map_size, pcf_radius) if self.use_shadow_map else None
+
+    def set_lights(self, lights: dict):
+        """
+        upload the ambient intensity and the light list, the number of lights is fixed
+        with a shadow map, the light it serves has to keep its place in the list and its direction,
+        the map and its axes are compiled into the kernels
+        """
+        if len(lights['lights']) != self.number_light:
+            raise ValueError("{} lights given, the light computer was built for {}.".format(
+                len(lights['lights']), self.number_light))
+        if self.use_shadow_map:
+            index_light = get_shadow_map_light(lights)
+            if index_light != self.shadow_map_light:
+                raise ValueError("The shadow map serves light {}, the first directional light is now {}.".format(
+                    self.shadow_map_light, index_light))
+            direction = np.asarray(lights['lights'][index_light]['direction'], dtype=np.float64)
+            if not np.allclose(direction / np.linalg.norm(direction), self.shadow_map.light_dir.to_numpy(),
+                               atol=1.0e-6):
+                raise ValueError("Light {} changed its direction, the shadow map was built for the former one."
+                                 .format(index_light))
+        self.ambient[0] = lights.get('ambient', 0.0)
+        for k, light in enumerate(lights['lights']):
+            if light['type'] not in LIGHT_TYPES:
+                raise ValueError("Light {} has the unknown type '{}', expected one of {}.".format(
+                    k, light['type'], ', '.join(LIGHT_TYPES)))
+            if light['type'] != 'point' and 'direction' not in light:
+                raise ValueError("Light {} is a {} light without a direction.".format(k, light['type']))
+            # a missing inner angle gives a hard edge at the outer one
+            outer_angle = light.get('outer_angle', 180.0)
+            inner_angle = light.get('inner_angle', outer_angle)
+            if inner_angle > outer_angle:
+                raise ValueError("Light {} has an inner angle of {} above its outer angle of {}.".format(
+                    k, inner_angle, outer_angle))
+            direction = np.asarray(light.get('direction', (0.0, -1.0, 0.0)), dtype=np.float64)
+            self.lights[k] = Light(kind=LIGHT_TYPES[light['type']],
+                                   intensity=light['intensity'],
+                                   position=vec(*light.get('position', (0.0, 0.0, 0.0))),
+                                   direction=vec(*(direction / np.linalg.norm(direction))),
+                                   cos_inner=np.cos(np.radians(inner_angle)),
+                                   cos_outer=np.cos(np.radians(outer_angle)),
+                                   range=light.get('range', 0.0))
 
     @ti.func
-    def compute_intensity(self, sphere: ti.template(), index_p: ti.int32, pos: vec, camera: ti.template()):
-        intensity = 0.0
-        intensity += self.intensity_amb
-        intensity += self.compute_diffuse(sphere, index_p, pos)
-        intensity += self.compute_spec(sphere, index_p, pos, camera)
+    def get_light_vector(self, index_light: ti.i32, pos: vec):
+        """
+        :return: unit vector from pos to the light, distance to the light (INF for directional lights)
+            and the falloff of the intensity with the distance and the spot cone
+        """
+        light = self.lights[index_light]
+        vec_l = light.direction
+        distance = INF
+        falloff = 1.0
+        if light.kind != DIRECTIONAL:
+            vec_l = light.position - pos
+            distance = vec_l.norm()
+            vec_l = vec_l / distance
+            if light.range > 0.0:
+                # smooth window reaching zero at the range, everything beyond it is culled
+                ratio = ti.min(distance / light.range, 1.0)
+                falloff = (1.0 - ratio * ratio) ** 2
+            if light.kind == SPOT:
+                cos_axis = -vec_l.dot(light.direction)
+                if light.cos_inner > light.cos_outer:
+                    falloff *= ti.math.smoothstep(light.cos_outer, light.cos_inner, cos_axis)
+                elif cos_axis < light.cos_outer:
+                    # equal angles give a hard edge
+                    falloff = 0.0
+        return vec_l, distance, falloff
 
+    @ti.func
+    def compute_intensity(self, sphere: ti.template(), index_p: ti.int32, pos: vec, vec_norm: vec,
+                          camera: ti.template()):
+        """
+        the unshadowed contribution of every light is cheap and computed first, lights below
+        min_contribution are taken as lit, the shadow rays go to the remaining ones
+        if there are more of them than shadow_rays, the shadow rays sample the lights in proportion
+        to their contribution and the estimate is unbiased
+        :param vec_norm: unit normal of the hit record
+        """
+        vec_v = (camera.origin[None] - pos).normalized()
+        specular = sphere.get_material(index_p).specular
+        contribution = ti.Vector([0.0] * MAX_LIGHTS, dt=flt_default)
+        total = 0.0
+        num_active = 0
+        unshadowed = 0.0
+        for index_light in range(self.number_light):
+            vec_l, distance, falloff = self.get_light_vector(index_light, pos)
+            strength = self.lights[index_light].intensity * falloff
+            value = self.compute_diffuse(vec_norm, vec_l, strength) + \
+                self.compute_spec(specular, vec_norm, vec_l, vec_v, strength)
+            if value > self.min_contribution:
+                contribution[index_light] = value
+                total += value
+                num_active += 1
+            else:
+                # too weak to be worth a shadow ray, counted as lit
+                unshadowed += value
+
+        intensity = self.ambient[0] + unshadowed
+        if num_active <= self.shadow_rays:
+            for index_light in range(self.number_light):
+                if contribution[index_light] > 0.0:
+                    intensity += contribution[index_light] * self.check_shadow(pos, vec_norm, sphere, index_light)
+        else:
+            for sample in range(self.shadow_rays):
+                target = ti.random() * total
+                index_pick = -1
+                index_last = -1
+                for index_light in range(self.number_light):
+                    if index_pick < 0 and contribution[index_light] > 0.0:
+                        index_last = index_light
+                        target -= contribution[index_light]
+                        if target <= 0.0:
+                            index_pick = index_light
+                # rounding may leave target slightly above zero after the last light
+                if index_pick < 0:
+                    index_pick = index_last
+                # contribution / probability is the total
+                intensity += total / self.shadow_rays * self.check_shadow(pos, vec_norm, sphere, index_pick)
         return intensity
 
     @ti.func
-    def check_shadow(self, pos: vec, sphere: ti.template(), state: ti.int32) -> flt_default:
+    def check_shadow(self, pos: vec, vec_norm: vec, sphere: ti.template(), index_light: ti.int32) -> flt_default:
         """
-        check if the shadow is cast under the directional light
-        state 0 means directional light
-        state 1 means point light
+        visibility of a light from pos, directional lights may be answered by the shadow map
         """
         # shadow coefficient 1.0 means the point is not shadowed by other objects
         # shadow coefficient 0.0 means the point is shadowed by other objects
         shadow_coefficient = 1.0
-        vec_d = self.light_dir
+        vec_d, lmt_max, falloff = self.get_light_vector(index_light, pos)
+        # Minimum limitation is set to avoid self-cast, relative to the distance for point and spot lights
         lmt_min = 1.0e-3
-        lmt_max = INF
-        if state == 0:
-            vec_d = self.light_dir
-            # Minimum limitation is set to avoid self-cast
-            lmt_min = 1.0e-3
-            lmt_max = INF
+        if lmt_max < INF:
+            lmt_min = 1.0e-3 * lmt_max
+        traced = 1
+        if ti.static(self.use_shadow_map):
+            if index_light == self.shadow_map_light:
+                self.counters.add(SHADOW_LOOKUP)
+                shadow_coefficient = self.shadow_map.lookup(pos, vec_norm)
+                traced = 0
+        if traced == 0:
+            pass
+        elif ti.static(self.use_bvh):
+            self.counters.add(SHADOW)
+            if self.bvh.any_hit(pos, vec_d, lmt_min, lmt_max):
+                shadow_coefficient = 0.0
         else:
-            vec_d = self.pos_light - pos
-            lmt_min = 1.0e-3
-            lmt_max = 1.0
-        for index_p in range(sphere.number):
-            # vector from the centroid of sphere to the position
-
-            vec_co = pos - vec(sphere.pos[index_p, 0], sphere.pos[index_p, 1], sphere.pos[index_p, 2])
-            radius = sphere.rad[index_p]
-            t1, t2 = solve_quadratic_equation(vec_d, vec_co, radius)
+            self.counters.add(SHADOW)
+            for index_p in range(sphere.number):
+                self.counters.add(INTERSECTION)
+                # vector from the centroid of sphere to the position
+                pos_rad = sphere.pos_rad[index_p]
+                t1, t2 = solve_quadratic_equation(vec_d, pos - pos_rad.xyz, pos_rad.w)
 
-            if lmt_min < t1 < lmt_max or lmt_min < t2 < lmt_max:
-                shadow_coefficient = 0.0
-                break
-            else:
-                pass
+                if lmt_min < t1 < lmt_max or lmt_min < t2 < lmt_max:
+                    shadow_coefficient = 0.0
+                    self.counters.add(EARLY_EXIT)
+                    break
+                else:
+                    pass
         return shadow_coefficient
 
     @ti.func
-    def compute_spec(self, sphere: ti.template(), index_p: ti.int32, pos: vec, camera: ti.template()) -> flt_default:
+    def compute_spec(self, specular: flt_default, vec_norm: vec, vec_l: vec, vec_v: vec,
+                     intensity: flt_default) -> flt_default:
         """
-        specular reflection
+        specular reflection of one light, not yet attenuated by shadows
+        :param vec_l: unit vector pointing to the light
+        :param vec_v: unit vector pointing to the camera
         """
-        intensity = 0.0
-        if sphere.specular[index_p] != -1:  # -1 refers to matte object
-            # directional
-            # vector from the centroid to the point
-            vec_norm = pos - vec(sphere.pos[index_p, 0], sphere.pos[index_p, 1], sphere.pos[index_p, 2])
-            vec_norm = vec_norm.normalized()
+        res = 0.0
+        if specular != -1:  # -1 refers to matte object
             # reflection vector
-            vec_r_dir = vec_norm * self.light_dir.dot(vec_norm) * 2 - self.light_dir
-            # view vector
-            origin = camera.origin
-            vec_v = origin - pos
-            vec_v = vec_v.normalized()
-            # directional light reflection vector
-            prod_vr_dir = vec_r_dir.dot(vec_v)
-            if prod_vr_dir > 0:
-                shadow_coefficient = self.check_shadow(pos, sphere, 0)
-                intensity_dir = (self.intensity_dir * prod_vr_dir ** sphere.specular[index_p] *
-                                 shadow_coefficient)
-                intensity += intensity_dir
-
-            else:
-                pass
-
-            # point light
-            vec_pl = self.pos_light - pos  # pointing to source
-            vec_pl = vec_pl.normalized()
-            # point light reflection vector
-            vec_r_point = vec_norm * vec_pl.dot(vec_norm) * 2 - vec_pl
-            prod_vr_point = vec_r_point.dot(vec_v)
-            if prod_vr_point > 0:
-                shadow_coefficient = self.check_shadow(pos, sphere, 1)
-                intensity_point = (self.intensity_point * prod_vr_point ** sphere.specular[index_p] *
-                                   shadow_coefficient)
-                intensity += intensity_point
+            vec_r = vec_norm * vec_l.dot(vec_norm) * 2 - vec_l
+            prod_vr = vec_r.dot(vec_v)
+            if prod_vr > 0:
+                res = intensity * prod_vr ** specular
             else:
                 pass
         else:
             pass
-        return intensity
-
-
+        return res
 
     @ti.func
-    def compute_diffuse(self, sphere: ti.template(), index_p: ti.int32, pos: vec) -> flt_default:
-        intensity = 0.0
-        # vector from the centroid to the point
-        pos_sphere = sphere.get_pos(index_p)
-        vec_norm = pos - pos_sphere
-        vec_norm = vec_norm.normalized()
-        # inner product of directional light (pointing to source) and radius vector
-        prod_dir = vec_norm.dot(self.light_dir)
-        if prod_dir >= 0.0:
-            shadow_coefficient = self.check_shadow(pos, sphere, state=0)
-            intensity_dir = prod_dir * self.intensity_dir * shadow_coefficient
-            intensity += intensity_dir
-        else:
-            pass
-
-        vec_pl = self.pos_light - pos
-        vec_pl = vec_pl.normalized()
-        prod_point = vec_norm.dot(vec_pl)
-        # point light
-        if prod_point >= 0.0:
-            shadow_coefficient = self.check_shadow(pos, sphere, state=1)
-            intensity_point = prod_point * self.intensity_point * shadow_coefficient
-            intensity += intensity_point
+    def compute_diffuse(self, vec_norm: vec, vec_l: vec, intensity: flt_default) -> flt_default:
+        """
+        diffuse reflection of one light, not yet attenuated by shadows
+        """
+        res = 0.0
+        # inner product of the light direction (pointing to source) and radius vector
+        prod = vec_norm.dot(vec_l)
+        if prod >= 0.0:
+            res = prod * intensity
         else:
             pass
-
-        return intensity
+        return res
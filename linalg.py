@@ -1,3 +1,4 @@
+import numpy as np
 import taichi as ti
 from format import flt_default, INF
 vec = ti.math.vec3
@@ -21,6 +22,18 @@ def euler_rot(yaw: flt_default, pitch: flt_default, roll: flt_default) -> ti.mat
 
     return res
 
+
+def axis_rot(axis: np.ndarray, angle: float) -> np.ndarray:
+    """
+    rotation matrix of angle radians about axis (Rodrigues' formula)
+    """
+    axis = np.asarray(axis, dtype=np.float64)
+    axis = axis / np.linalg.norm(axis)
+    cross = np.array([[0.0, -axis[2], axis[1]],
+                      [axis[2], 0.0, -axis[0]],
+                      [-axis[1], axis[0], 0.0]])
+    return np.eye(3) + np.sin(angle) * cross + (1.0 - np.cos(angle)) * cross @ cross
+
 @ti.func
 def solve_quadratic_equation(vec_1: vec, vec_2: vec, radius: flt_default) -> flt_default:
     a = vec_1[0] ** 2 + vec_1[1] ** 2 + vec_1[2] ** 2
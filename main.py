@@ -1,25 +1,87 @@
 import taichi as ti
-import matplotlib.pyplot as plt
+import runtime
 from render import Renderer
-from format import flt_default
+from sphere import Sphere
+from instrument import Instrumentation
+from image_io import ImageWriter, get_image
+
+
+def handle_input(window, camera, cursor_last):
+    """
+    left drag orbits, right drag pans, w/s moves forward/backward
+    :return: whether the camera moved and the cursor position
+    """
+    cursor = window.get_cursor_pos()
+    dx, dy = cursor[0] - cursor_last[0], cursor[1] - cursor_last[1]
+    moved = False
+    if window.is_pressed(ti.ui.LMB) and (dx != 0.0 or dy != 0.0):
+        camera.orbit(-dx * ti.math.pi, dy * ti.math.pi * 0.5)
+        moved = True
+    elif window.is_pressed(ti.ui.RMB) and (dx != 0.0 or dy != 0.0):
+        camera.pan(-dx * camera.width, -dy * camera.height)
+        moved = True
+    if window.is_pressed('w'):
+        camera.zoom(0.05)
+        moved = True
+    elif window.is_pressed('s'):
+        camera.zoom(-0.05)
+        moved = True
+    return moved, cursor
+
 
 def main():
-    ti.init(arch=ti.cpu, device_memory_fraction=1.0, default_fp=flt_default, debug=True)
-    renderer = Renderer()
+    # 'debug' enables bound checks, 'release' reuses the compiled kernels of the previous run
+    runtime.init('release', arch=ti.cpu)
+    # ray counters and kernel timing, appended to stats_file once per displayed frame
+    instrument = False
+    stats_file = 'render_stats.jsonl'
+    instrumentation = Instrumentation(enabled=instrument)
+    # the last 50000 particles of the default scene are left out
+    renderer = Renderer(sphere=Sphere(subset=slice(None, -50000)), instrumentation=instrumentation)
     resolution = (renderer.camera.resolution[1], renderer.camera.resolution[0])
     window = ti.ui.Window("Ball in space", resolution)
     canvas = window.get_canvas()
     supersample = 4
+    # accumulate samples until the noise target is met instead of rendering every pixel once
+    progressive = True
+    noise_target = 0.01
+    # the converged image is filtered once by the denoiser, progressive rendering only
+    denoise = False
+    denoised = False
+    # p saves the current frame, the files are written in the background
+    writer = ImageWriter()
+    number_screenshot = 0
+    cursor = window.get_cursor_pos()
     while window.running:
-        renderer.render(supersample)
-        canvas.set_image(renderer.canvas_to_gui)
+        for event in window.get_events(ti.ui.PRESS):
+            if event.key == 'p':
+                writer.submit('screenshot_{:03d}.png'.format(number_screenshot),
+                              get_image(renderer.canvas.to_numpy()))
+                number_screenshot += 1
+        moved, cursor = handle_input(window, renderer.camera, cursor)
+        if moved:
+            # only the accumulated samples are dropped, fields and kernels are kept
+            renderer.reset_accumulation()
+            denoised = False
+        if progressive:
+            if renderer.num_pixel_rendered[0] < renderer.num_pixel_render[0]:
+                with instrumentation.time('render_progressive'):
+                    renderer.render_progressive(supersample, noise_target, 2 * supersample, 64 * supersample)
+            elif denoise and not denoised:
+                renderer.denoise()
+                denoised = True
+        else:
+            with instrumentation.time('render'):
+                renderer.render(supersample)
+        with instrumentation.time('set_image'):
+            canvas.set_image(renderer.canvas)
         window.show()
-    fig = plt.figure(figsize=(renderer.camera.resolution[1]/400, renderer.camera.resolution[0]/400))
-    ax = fig.gca()
-    ax.set_axis_off()
-    plt.imshow(renderer.canvas.to_numpy())
-    plt.gca().invert_yaxis()
-    fig.savefig('particleRayTracing.png', dpi=500, bbox_inches='tight', pad_inches=0)
-    
+        if instrument:
+            instrumentation.dump(instrumentation.end_frame(), stats_file)
+    # the exact pixels, without resampling
+    writer.submit('particleRayTracing.png', get_image(renderer.canvas.to_numpy()))
+    writer.close()
+
+
 if __name__ == '__main__':
     main()
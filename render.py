@@ -1,37 +1,111 @@
+import numpy as np
 import taichi as ti
 from camera import Camera
 from sphere import Sphere
 from format import flt_default, INF
 from light_comput import LightComputer
+from bvh import BVH
+from denoise import Denoiser
+from dirty_region import EditTracker, TILE_SIZE
+from instrument import Instrumentation, PRIMARY, REFLECTION, REFRACTION, INTERSECTION
 from linalg import solve_quadratic_equation, clip
+from tile_render import split_tiles
+from image_io import quantize
 
 vec = ti.math.vec3
+# pending secondary rays per primary ray, the tracing depth can reach STACK_SIZE - 1
+STACK_SIZE = 16
+# secondary rays contributing less than this to the pixel are not traced
+MIN_WEIGHT = 1.0e-4
+# result of the intersection phase, index -1 means the ray escaped
+HitRecord = ti.types.struct(index=ti.i32, t=flt_default, normal=vec)
 
 @ti.data_oriented
 class Renderer:
-    def __init__(self):
-        self.camera = Camera()
-        self.pixels = ti.field(dtype=flt_default, shape=(self.camera.resolution[0], self.camera.resolution[1]))
-        self.pixels_rendered = ti.field(dtype=ti.i32, shape=(self.camera.resolution[0], self.camera.resolution[1]))
+    def __init__(self, use_bvh=True, camera=None, sphere=None, max_depth=4, instrumentation=None,
+                 shadow_map_size=0, lights=None, track_edits=False, framebuffer=True):
+        """
+        :param use_bvh: route closest-hit queries through the bounding volume hierarchy,
+            False falls back to the brute-force loop over all spheres for validation
+        :param camera: None uses the default camera
+        :param sphere: None loads the default particle file
+        :param max_depth: number of reflection/refraction bounces, below STACK_SIZE
+        :param instrumentation: ray counters and kernel timing, None disables both
+        :param shadow_map_size: texels along each edge of the directional shadow map,
+            0 traces the directional shadow rays exactly
+        :param lights: light list or json file, see light_comput.load_lights, None uses the default lights
+        :param track_edits: record per tile which spheres the rays depend on, so that edit_sphere
+            renders only the tiles an edit can change
+        :param framebuffer: False skips every full-resolution buffer so that the memory does not grow
+            with the resolution, only render_tile and render_tiled are available then
+        """
+        self.camera = Camera() if camera is None else camera
+        if track_edits and not framebuffer:
+            raise ValueError("Edit tracking needs the framebuffer.")
+        self.framebuffer = framebuffer
+        # placeholders of a single pixel without the framebuffer
+        shape = (self.camera.resolution[0], self.camera.resolution[1]) if framebuffer else (1, 1)
+        self.pixels = ti.field(dtype=flt_default, shape=shape)
+        self.pixels_rendered = ti.field(dtype=ti.i32, shape=shape)
         self.num_pixel_render = ti.field(dtype=ti.i32, shape=(1,))
         self.num_pixel_render[0] = self.camera.resolution[0] * self.camera.resolution[1]
         self.num_pixel_rendered = ti.field(dtype=ti.i32, shape=(1,))
-        self.canvas = ti.field(dtype=flt_default, shape=(self.camera.resolution[0], self.camera.resolution[1], 3))
-        self.canvas_to_gui = ti.field(dtype=ti.f32,
-                                      shape=(self.camera.resolution[1], self.camera.resolution[0], 3))
+        # the framebuffer in the layout of the window, (columns, rows, 3) with row 0 at the bottom
+        self.canvas = ti.field(dtype=ti.f32, shape=(shape[1], shape[0], 3))
         self.canvas.fill(1.0)
-        self.sphere = Sphere()
+        self.sphere = Sphere() if sphere is None else sphere
+        self.use_bvh = use_bvh
+        self.instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        self.counters = self.instrumentation.counters
+        self.bvh = BVH(self.sphere, counters=self.counters) if use_bvh else None
         # record the distance of the closest object, initiated as infinite
-        self.distance_object_close = ti.field(
-            dtype=flt_default, shape=(self.camera.resolution[0], self.camera.resolution[1]))
+        # together with the normal and the albedo of the first hit it guides the denoiser,
+        # the three are the means over the samples of a pixel, see resolve_gbuffer
+        self.distance_object_close = ti.field(dtype=flt_default, shape=shape)
         self.distance_object_close.fill(INF)
+        self.normal_buffer = ti.field(dtype=flt_default, shape=shape + (3,))
+        self.albedo_buffer = ti.field(dtype=flt_default, shape=shape + (3,))
+        # created by the first call of denoise, together with the mean color it filters
+        self.denoiser = None
+        self.color_mean = None
         self.render_lmt = ti.field(dtype=flt_default, shape=(2,))
         self.render_lmt[0] = self.camera.distance
         self.render_lmt[1] = INF
-        self.light_computer = LightComputer()
+        # runtime tracing depth, changing it does not recompile the kernels
+        self.max_depth = ti.field(dtype=ti.i32, shape=(1,))
+        self.max_depth[0] = min(max_depth, STACK_SIZE - 1)
+        self.light_computer = LightComputer(self.bvh, self.counters, self.sphere, shadow_map_size,
+                                            lights=lights)
+        self.track_edits = track_edits
+        self.edit_tracker = EditTracker(self.camera.resolution, self.sphere, self.camera,
+                                        self.light_computer) if track_edits else None
+        # progressive rendering, running sums of the samples of every pixel
+        self.color_sum = ti.field(dtype=flt_default, shape=shape + (3,))
+        self.lum_sum = ti.field(dtype=flt_default, shape=shape)
+        self.lum_sq_sum = ti.field(dtype=flt_default, shape=shape)
+        self.sample_count = ti.field(dtype=ti.i32, shape=shape)
+        # first hits of the same samples, the depth is summed over the samples that hit a sphere
+        self.normal_sum = ti.field(dtype=flt_default, shape=shape + (3,))
+        self.albedo_sum = ti.field(dtype=flt_default, shape=shape + (3,))
+        self.depth_sum = ti.field(dtype=flt_default, shape=shape)
+        self.hit_count = ti.field(dtype=ti.i32, shape=shape)
+        # adaptive sampling, squared standard error of every pixel and the sample budget spent so far
+        self.sample_error = ti.field(dtype=flt_default, shape=shape)
+        self.error_sum = ti.field(dtype=flt_default, shape=(1,))
+        self.samples_spent = ti.field(dtype=ti.i32, shape=(1,))
+        # pixels dropped by the last edit_sphere
+        self.number_dropped = ti.field(dtype=ti.i32, shape=(1,))
+
+    def check_framebuffer(self):
+        if not self.framebuffer:
+            raise ValueError("The renderer was created without the framebuffer, use render_tile or render_tiled.")
+
+    def render(self, supersample):
+        self.check_framebuffer()
+        self.render_kernel(supersample)
 
     @ti.kernel
-    def render(self, supersample: ti.i32):
+    def render_kernel(self, supersample: ti.i32):
         for i, j in self.pixels:
             if self.pixels_rendered[i, j] == 1:
                 continue
@@ -41,25 +115,356 @@ class Renderer:
                     continue
             color_accum = vec(0.0, 0.0, 0.0)
             for sample in range(supersample):
-                u_offset = ti.random() / self.camera.resolution[0] * 1.0
-                v_offset = ti.random() / self.camera.resolution[1] * 1.0
-                vec_d = vec(self.camera.vec_o_to_vp[i, j, 0] + u_offset,
-                        self.camera.vec_o_to_vp[i, j, 1] + v_offset,
-                        self.camera.vec_o_to_vp[i, j, 2])
-                color = clip(self.trace_color(self.camera.origin, vec_d, 1, 4),
-                            0.0, 1.0)
-                color_accum += color
+                color_accum += self.sample_pixel(i, j, False)
             color_avg = color_accum / supersample
             self.num_pixel_rendered[0] += 1
-            self.canvas[i, j, 0] = color_avg[0]
-            self.canvas[i, j, 1] = color_avg[1]
-            self.canvas[i, j, 2] = color_avg[2]
-            self.canvas_to_gui[j, i, 0] = color_avg[0]
-            self.canvas_to_gui[j, i, 1] = color_avg[1]
-            self.canvas_to_gui[j, i, 2] = color_avg[2]
+            self.set_canvas(i, j, color_avg)
             self.pixels_rendered[i, j] = 1
             # print("{} / {} pixels rendered".format(self.num_pixel_rendered[0], self.num_pixel_render[0]))
 
+    def render_progressive(self, samples_per_pass, noise_target, min_samples, max_samples):
+        """
+        add samples to every unconverged pixel and display the running mean
+        a pixel is converged once the standard error of its mean luminance is
+        below noise_target (after at least min_samples), or after max_samples,
+        a noise_target of 0 always takes max_samples, the last pass is cut to max_samples
+        """
+        self.check_framebuffer()
+        self.render_progressive_kernel(samples_per_pass, noise_target, min_samples, max_samples)
+
+    @ti.kernel
+    def render_progressive_kernel(self, samples_per_pass: ti.i32, noise_target: flt_default, min_samples: ti.i32,
+                                  max_samples: ti.i32):
+        for i, j in self.pixels:
+            if self.pixels_rendered[i, j] == 1:
+                continue
+            samples = ti.max(ti.min(samples_per_pass, max_samples - self.sample_count[i, j]), 0)
+            n = self.accumulate(i, j, samples)
+            if n == 0:
+                # a pass without samples only compiles the kernel
+                continue
+            # a flat pixel has a variance of exactly 0, which would meet a target of 0 too
+            if n >= max_samples or (n >= min_samples and noise_target > 0.0 and
+                                    self.get_variance(i, j) / n <= noise_target * noise_target):
+                self.pixels_rendered[i, j] = 1
+                self.num_pixel_rendered[0] += 1
+
+    @ti.kernel
+    def estimate_error(self, max_samples: ti.i32):
+        """
+        squared standard error of the mean luminance of every pixel, the variance is the largest one
+        of its 3x3 neighbourhood so that edges missed by the first few samples are refined as well
+        """
+        for i, j in self.pixels:
+            n = self.sample_count[i, j]
+            error = 0.0
+            if 0 < n < max_samples:
+                variance = 0.0
+                for di, dj in ti.static(ti.ndrange((-1, 2), (-1, 2))):
+                    variance = ti.max(variance, self.get_variance(
+                        ti.math.clamp(i + di, 0, self.pixels.shape[0] - 1),
+                        ti.math.clamp(j + dj, 0, self.pixels.shape[1] - 1)))
+                error = variance / n
+            self.sample_error[i, j] = error
+            self.error_sum[0] += error
+
+    @ti.kernel
+    def render_adaptive_pass(self, base_samples: ti.i32, pass_budget: flt_default, max_samples: ti.i32):
+        """
+        add base_samples to every pixel and share pass_budget samples in proportion to sample_error,
+        the shares are rounded stochastically so that the budget is met on average
+        """
+        # the noisy pixels are clustered along the edges, small blocks balance the threads
+        ti.loop_config(block_dim=16)
+        for i, j in self.pixels:
+            samples = base_samples
+            if self.error_sum[0] > 0.0:
+                samples += ti.cast(pass_budget * self.sample_error[i, j] / self.error_sum[0] + ti.random(), ti.i32)
+            samples = ti.min(samples, max_samples - self.sample_count[i, j])
+            if samples > 0:
+                self.accumulate(i, j, samples)
+                self.samples_spent[0] += samples
+
+    @ti.kernel
+    def render_tile(self, tile: ti.types.ndarray(), row_start: ti.i32, col_start: ti.i32, supersample: ti.i32):
+        """
+        render the pixels starting at (row_start, col_start) straight into tile (rows, columns, 3),
+        the canvas is not touched
+        """
+        for i, j in ti.ndrange(tile.shape[0], tile.shape[1]):
+            color_accum = vec(0.0, 0.0, 0.0)
+            for sample in range(supersample):
+                color_accum += self.sample_pixel(row_start + i, col_start + j, False)
+            color_avg = color_accum / supersample
+            for d in ti.static(range(3)):
+                tile[i, j, d] = color_avg[d]
+
+    def render_tiled(self, image, tile_size=256, supersample=4):
+        """
+        render the whole image tile by tile, only one tile is held in memory
+        :param image: (rows, columns, 3) array written tile by tile, e.g. a memory-mapped file,
+            uint8 arrays receive the quantized colors
+        """
+        for row_start, col_start, rows, cols in split_tiles(image.shape[:2], tile_size):
+            tile = np.empty((rows, cols, 3), dtype=np.float32)
+            self.render_tile(tile, row_start, col_start, supersample)
+            image[row_start:row_start + rows, col_start:col_start + cols] = \
+                quantize(tile) if image.dtype == np.uint8 else tile
+
+    def render_until_converged(self, noise_target=0.01, samples_per_pass=4, min_samples=8, max_samples=256):
+        """
+        progressive rendering until every pixel reached the noise target or the sample budget
+        :param min_samples: raised to 2, the variance of a single sample is 0
+        :return: number of passes
+        """
+        self.check_framebuffer()
+        if samples_per_pass < 1:
+            raise ValueError("samples_per_pass is {}, at least one sample per pass is needed.".format(
+                samples_per_pass))
+        if max_samples < 1:
+            raise ValueError("max_samples is {}, at least one sample per pixel is needed.".format(max_samples))
+        min_samples = max(min_samples, 2)
+        num_pass = 0
+        while self.num_pixel_rendered[0] < self.num_pixel_render[0]:
+            with self.instrumentation.time('render_progressive'):
+                self.render_progressive(samples_per_pass, noise_target, min_samples, max_samples)
+            num_pass += 1
+        return num_pass
+
+    def render_adaptive(self, samples_per_pixel=8, initial_samples=2, max_samples=256, num_pass=4):
+        """
+        adaptive sampling under a global budget of samples_per_pixel samples per pixel on average,
+        every pixel starts with initial_samples and the rest of the budget goes to the noisiest
+        pixels over num_pass passes, flat background and floor regions keep their first samples
+        :return: number of samples traced
+        """
+        self.check_framebuffer()
+        # the variance needs two samples
+        initial_samples = max(initial_samples, 2)
+        budget = samples_per_pixel * self.num_pixel_render[0]
+        self.reset_accumulation()
+        self.samples_spent[0] = 0
+        self.error_sum[0] = 0.0
+        with self.instrumentation.time('render_adaptive_pass'):
+            self.render_adaptive_pass(initial_samples, 0.0, max_samples)
+        for index_pass in range(num_pass):
+            remaining = budget - self.samples_spent[0]
+            if remaining <= 0:
+                break
+            self.error_sum[0] = 0.0
+            with self.instrumentation.time('estimate_error'):
+                self.estimate_error(max_samples)
+            if self.error_sum[0] <= 0.0:
+                break
+            with self.instrumentation.time('render_adaptive_pass'):
+                self.render_adaptive_pass(0, remaining / (num_pass - index_pass), max_samples)
+        self.pixels_rendered.fill(1)
+        self.num_pixel_rendered[0] = self.num_pixel_render[0]
+        return self.samples_spent[0]
+
+    def resolve_gbuffer(self):
+        """
+        mean color, depth, normal and albedo of the first hits of the accumulated samples,
+        the depth is averaged over the samples that hit a sphere and is infinite without any,
+        pixels without samples keep the displayed color
+        """
+        self.check_framebuffer()
+        if self.color_mean is None:
+            self.color_mean = ti.field(dtype=flt_default, shape=self.pixels.shape + (3,))
+        self.resolve_gbuffer_kernel(self.color_mean)
+
+    @ti.kernel
+    def resolve_gbuffer_kernel(self, color_mean: ti.template()):
+        for i, j in self.pixels:
+            n = self.sample_count[i, j]
+            depth = INF
+            if self.hit_count[i, j] > 0:
+                depth = self.depth_sum[i, j] / self.hit_count[i, j]
+            self.distance_object_close[i, j] = depth
+            normal = vec(self.normal_sum[i, j, 0], self.normal_sum[i, j, 1], self.normal_sum[i, j, 2])
+            if normal.norm() > 0.0:
+                normal = normal.normalized()
+            for d in ti.static(range(3)):
+                self.normal_buffer[i, j, d] = normal[d]
+                if n > 0:
+                    color_mean[i, j, d] = self.color_sum[i, j, d] / n
+                    self.albedo_buffer[i, j, d] = self.albedo_sum[i, j, d] / n
+                else:
+                    color_mean[i, j, d] = self.canvas[j, i, d]
+                    self.albedo_buffer[i, j, d] = 1.0
+
+    def denoise(self, iterations=2):
+        """
+        filter the mean of the accumulated samples guided by their first hits and display the result,
+        the samples are kept so that rendering can go on and calling it again gives the same image
+        """
+        self.check_framebuffer()
+        if self.denoiser is None or self.denoiser.iterations != iterations:
+            self.denoiser = Denoiser((self.camera.resolution[0], self.camera.resolution[1]), iterations)
+        with self.instrumentation.time('denoise'):
+            self.resolve_gbuffer()
+            self.show_image(self.denoiser.run(self.color_mean, self.normal_buffer, self.albedo_buffer,
+                                              self.distance_object_close))
+
+    def show_image(self, image):
+        """
+        :param image: field (rows, columns, 3) displayed on the canvas
+        """
+        self.check_framebuffer()
+        self.show_image_kernel(image)
+
+    @ti.kernel
+    def show_image_kernel(self, image: ti.template()):
+        for i, j in self.pixels:
+            self.set_canvas(i, j, vec(image[i, j, 0], image[i, j, 1], image[i, j, 2]))
+
+    def update_scene(self, keep_extent=False) -> bool:
+        """
+        rebuild the acceleration structures after the spheres moved
+        :param keep_extent: keep the extent of the shadow map if the spheres still fit, see ShadowMap.build
+        :return: False if the shadow map was fitted again, every shadow lookup may have changed
+        """
+        if self.bvh is not None:
+            self.bvh.refit()
+        if self.light_computer.shadow_map is not None:
+            return self.light_computer.shadow_map.build(keep_extent)
+        return True
+
+    def edit_sphere(self, index, pos=None, rad=None, color=None, material_id=None) -> int:
+        """
+        change one sphere and drop the pixels of the tiles the change can reach, progressive rendering
+        then renders only those again, without track_edits every pixel is dropped, as well as when
+        the sphere leaves the extent of the shadow map
+        :param material_id: entry of the material palette, see Sphere.set_materials
+        :return: number of pixels to render again
+        """
+        old = self.sphere.pos_rad[index].to_numpy().astype(np.float64)
+        new = old.copy()
+        if pos is not None:
+            new[:3] = pos
+        if rad is not None:
+            new[3] = rad
+        moved = not np.array_equal(old, new)
+        self.sphere.pos_rad[index] = new
+        if color is not None:
+            self.sphere.color[index] = color
+        if material_id is not None:
+            self.sphere.material_id[index] = material_id
+        extent_kept = True
+        if moved:
+            extent_kept = self.update_scene(keep_extent=self.edit_tracker is not None)
+        if self.edit_tracker is None or not extent_kept:
+            self.reset_accumulation()
+            return self.num_pixel_render[0]
+        self.edit_tracker.mark(index, old, new, moved)
+        self.number_dropped[0] = 0
+        self.drop_dirty_pixels()
+        self.edit_tracker.clear_dirty()
+        return self.number_dropped[0]
+
+    def drop_dirty_pixels(self):
+        self.check_framebuffer()
+        self.drop_dirty_pixels_kernel()
+
+    @ti.kernel
+    def drop_dirty_pixels_kernel(self):
+        for i, j in self.pixels:
+            if self.edit_tracker.dirty[i // TILE_SIZE, j // TILE_SIZE] == 1:
+                if self.pixels_rendered[i, j] == 1:
+                    self.pixels_rendered[i, j] = 0
+                    self.num_pixel_rendered[0] -= 1
+                for d in ti.static(range(3)):
+                    self.color_sum[i, j, d] = 0.0
+                self.lum_sum[i, j] = 0.0
+                self.lum_sq_sum[i, j] = 0.0
+                self.sample_count[i, j] = 0
+                for d in ti.static(range(3)):
+                    self.normal_sum[i, j, d] = 0.0
+                    self.albedo_sum[i, j, d] = 0.0
+                self.depth_sum[i, j] = 0.0
+                self.hit_count[i, j] = 0
+                self.number_dropped[0] += 1
+
+    def reset_accumulation(self):
+        self.color_sum.fill(0.0)
+        self.lum_sum.fill(0.0)
+        self.lum_sq_sum.fill(0.0)
+        self.sample_count.fill(0)
+        self.normal_sum.fill(0.0)
+        self.albedo_sum.fill(0.0)
+        self.depth_sum.fill(0.0)
+        self.hit_count.fill(0)
+        self.pixels_rendered.fill(0)
+        self.num_pixel_rendered[0] = 0
+        if self.edit_tracker is not None:
+            self.edit_tracker.reset()
+
+    @ti.func
+    def accumulate(self, i: ti.i32, j: ti.i32, samples: ti.i32) -> ti.i32:
+        """
+        add samples to the running sums of pixel (i, j) and display their mean,
+        their first hits are summed for the denoiser
+        :return: number of samples of the pixel
+        """
+        for sample in range(samples):
+            color = self.sample_pixel(i, j, True)
+            lum = color.dot(vec(0.299, 0.587, 0.114))
+            for d in ti.static(range(3)):
+                self.color_sum[i, j, d] += color[d]
+            self.lum_sum[i, j] += lum
+            self.lum_sq_sum[i, j] += lum * lum
+        self.sample_count[i, j] += samples
+        n = self.sample_count[i, j]
+        if n > 0:
+            self.set_canvas(i, j, vec(self.color_sum[i, j, 0], self.color_sum[i, j, 1],
+                                      self.color_sum[i, j, 2]) / n)
+        return n
+
+    @ti.func
+    def get_variance(self, i: ti.i32, j: ti.i32) -> flt_default:
+        """
+        unbiased variance of the luminance samples of pixel (i, j)
+        """
+        n = self.sample_count[i, j]
+        variance = 0.0
+        if n > 1:
+            mean = self.lum_sum[i, j] / n
+            variance = ti.max(self.lum_sq_sum[i, j] / n - mean * mean, 0.0) * n / (n - 1)
+        return variance
+
+    @ti.func
+    def sample_pixel(self, i: ti.i32, j: ti.i32, gbuffer: ti.template()) -> vec:
+        """
+        trace one jittered primary ray through pixel (i, j)
+        :param gbuffer: add the first hit to the sums of the denoiser
+        """
+        vec_d = self.camera.get_ray_dir(i, j, ti.random(), ti.random())
+        self.counters.add(PRIMARY)
+        return clip(self.trace_color(self.camera.origin[None], vec_d, 1, self.max_depth[0], i, j, gbuffer),
+                    0.0, 1.0)
+
+    @ti.func
+    def record_first_hit(self, i: ti.i32, j: ti.i32, origin: vec, vec_d: vec, hit: HitRecord):
+        """
+        the background faces the camera and keeps its own color
+        """
+        normal = -vec_d.normalized()
+        albedo = self.get_bg_color(vec_d)
+        if hit.index >= 0:
+            normal = hit.normal
+            albedo = self.sphere.get_color(hit.index, origin + hit.t * vec_d)
+            self.depth_sum[i, j] += hit.t * vec_d.norm()
+            self.hit_count[i, j] += 1
+        for d in ti.static(range(3)):
+            self.normal_sum[i, j, d] += normal[d]
+            self.albedo_sum[i, j, d] += albedo[d]
+
+    @ti.func
+    def set_canvas(self, i: ti.i32, j: ti.i32, color: vec):
+        self.canvas[j, i, 0] = color[0]
+        self.canvas[j, i, 1] = color[1]
+        self.canvas[j, i, 2] = color[2]
+
     @ti.func
     def get_bg_color(self, vec_d: vec) -> vec:
         y = vec_d[1] / vec_d.norm()
@@ -97,51 +502,140 @@ class Renderer:
         return r0 + (1.0 - r0) * ((1.0 - cos_theta) ** 5)
 
     @ti.func
-    def trace_color(self, origin, vec_d: vec, t_min: flt_default, recursion_depth: ti.template()) -> vec:
+    def closest_hit(self, origin, vec_d: vec, t_min: flt_default):
+        """
+        :return: index of the closest sphere (-1 if nothing is hit) and the distance
+        """
         t_closest = self.render_lmt[1]
-        color = self.get_bg_color(vec_d)
-        for index_particle in range(self.sphere.number):
-            pos_sphere = self.sphere.get_pos(index_particle)
-            vec_centroid_origin = origin - pos_sphere
-            t1, t2 = solve_quadratic_equation(vec_d, vec_centroid_origin, self.sphere.rad[index_particle])
-            t = ti.math.min(t1, t2)
-            if t_min < t < t_closest:
-                t_closest = t
-                pos = origin + t * vec_d
-                vec_n = (pos - pos_sphere).normalized()
-
-                # 本地颜色
-                color_local = self.sphere.get_color(index_particle, pos) * self.light_computer.compute_intensity(
-                    self.sphere, index_particle, pos, self.camera)
-
-                reflect_ratio = self.sphere.reflective[index_particle]
-                refract_index = self.sphere.refraction_index[index_particle]
-                refract_ratio = self.sphere.refractive[index_particle]
-                reflected_color = vec(0.0, 0.0, 0.0)
-                refracted_color = vec(0.0, 0.0, 0.0)
-
-                if ti.static(recursion_depth > 0):
-                    if refract_ratio > 0.0:
-                        cos_theta = -vec_d.dot(vec_n)
-                        eta = 1.0 / refract_index if vec_d.dot(vec_n) < 0 else refract_index
-                        vec_n = vec_n if vec_d.dot(vec_n) < 0 else -vec_n
-                        refracted_vec = self.refract(vec_d, vec_n, eta)
-                        if refracted_vec.norm() > 0.0:
-                            refracted_color = self.trace_color(pos, refracted_vec, 0.001, recursion_depth - 1) * refract_ratio
-                            refracted_color = refracted_color * refract_ratio
-
-                    # 反射光
-                    vec_reflect = self.get_reflect_ray(vec_d, vec_n)
-                    reflected_color = self.trace_color(pos, vec_reflect, 0.001, recursion_depth - 1) * reflect_ratio
-
-                # 混合颜色
-                local_weight = max(0.0, 1.0 - reflect_ratio - refract_ratio)
-                color = color_local * local_weight + reflected_color + refracted_color
-        return color
+        index_hit = -1
+        if ti.static(self.use_bvh):
+            index_hit, t_closest = self.bvh.closest_hit(origin, vec_d, t_min, t_closest)
+        else:
+            self.counters.add(INTERSECTION, self.sphere.number)
+            for index_particle in range(self.sphere.number):
+                pos_rad = self.sphere.pos_rad[index_particle]
+                t1, t2 = solve_quadratic_equation(vec_d, origin - pos_rad.xyz, pos_rad.w)
+                t = ti.math.min(t1, t2)
+                if t_min < t < t_closest:
+                    t_closest = t
+                    index_hit = index_particle
+        return index_hit, t_closest
+
+    @ti.func
+    def intersect(self, origin, vec_d: vec, t_min: flt_default) -> HitRecord:
+        """
+        intersection phase, only the closest hit gets a normal and is shaded afterwards
+        """
+        index_hit, t = self.closest_hit(origin, vec_d, t_min)
+        normal = vec(0.0, 0.0, 0.0)
+        if index_hit >= 0:
+            normal = (origin + t * vec_d - self.sphere.get_pos(index_hit)).normalized()
+        return HitRecord(index=index_hit, t=t, normal=normal)
 
     @ti.kernel
-    def update_canvas_to_gui(self):
-        for i, j in self.pixels:
-            self.canvas_to_gui[j, i, 0] = self.canvas[i, j, 0]
-            self.canvas_to_gui[j, i, 1] = self.canvas[i, j, 1]
-            self.canvas_to_gui[j, i, 2] = self.canvas[i, j, 2]
+    def cast_rays(self, origin: ti.types.ndarray(), direction: ti.types.ndarray(), t_min: flt_default,
+                  index: ti.types.ndarray(), t: ti.types.ndarray(), normal: ti.types.ndarray()):
+        """
+        closest hits of a batch of rays without shading, e.g. for picking
+        :param origin: ray origins (n, 3)
+        :param direction: ray directions (n, 3)
+        :param index: hit sphere (n,), -1 if the ray escaped
+        :param t: hit distance (n,)
+        :param normal: unit normal at the hit (n, 3)
+        """
+        for k in range(index.shape[0]):
+            hit = self.intersect(vec(origin[k, 0], origin[k, 1], origin[k, 2]),
+                                 vec(direction[k, 0], direction[k, 1], direction[k, 2]), t_min)
+            index[k] = hit.index
+            t[k] = hit.t
+            for d in ti.static(range(3)):
+                normal[k, d] = hit.normal[d]
+
+    @ti.func
+    def trace_color(self, origin, vec_d: vec, t_min: flt_default, max_depth: ti.i32, i: ti.i32, j: ti.i32,
+                    gbuffer: ti.template()) -> vec:
+        """
+        iterative ray tracing, the secondary rays wait on a small stack together
+        with the weight they contribute to the pixel, so max_depth is a runtime
+        value and the kernel size does not depend on it
+        :param i: row of the pixel the ray belongs to, for the edit tracker and the denoiser sums
+        :param j: column of the pixel
+        :param gbuffer: add the first hit to the sums of the denoiser
+        """
+        color = vec(0.0, 0.0, 0.0)
+        stack_origin = ti.Matrix.zero(flt_default, STACK_SIZE, 3)
+        stack_dir = ti.Matrix.zero(flt_default, STACK_SIZE, 3)
+        stack_t_min = ti.Vector([0.0] * STACK_SIZE, dt=flt_default)
+        stack_weight = ti.Vector([0.0] * STACK_SIZE, dt=flt_default)
+        stack_depth = ti.Vector([0] * STACK_SIZE, dt=ti.i32)
+        for d in ti.static(range(3)):
+            stack_origin[0, d] = origin[d]
+            stack_dir[0, d] = vec_d[d]
+        stack_t_min[0] = t_min
+        stack_weight[0] = 1.0
+        size = 1
+        while size > 0:
+            size -= 1
+            ray_o = vec(stack_origin[size, 0], stack_origin[size, 1], stack_origin[size, 2])
+            ray_d = vec(stack_dir[size, 0], stack_dir[size, 1], stack_dir[size, 2])
+            weight = stack_weight[size]
+            depth = stack_depth[size]
+            hit = self.intersect(ray_o, ray_d, stack_t_min[size])
+            if ti.static(gbuffer):
+                if depth == 0:
+                    self.record_first_hit(i, j, ray_o, ray_d, hit)
+            if ti.static(self.track_edits):
+                if depth > 0:
+                    self.edit_tracker.record_ray(i, j, ray_o, ray_d, hit.t if hit.index >= 0 else INF)
+                if hit.index >= 0:
+                    self.edit_tracker.record_hit(i, j, hit.index, ray_o + hit.t * ray_d)
+            if hit.index < 0:
+                color += self.get_bg_color(ray_d) * weight
+                continue
+            # shading phase, once per ray on its closest hit
+            index_particle = hit.index
+            pos = ray_o + hit.t * ray_d
+            vec_n = hit.normal
+
+            # 本地颜色
+            color_local = self.sphere.get_color(index_particle, pos) * self.light_computer.compute_intensity(
+                self.sphere, index_particle, pos, vec_n, self.camera)
+
+            material = self.sphere.get_material(index_particle)
+            reflect_ratio = material.reflective
+            refract_index = material.refraction_index
+            refract_ratio = material.refractive
+            # 混合颜色
+            local_weight = max(0.0, 1.0 - reflect_ratio - refract_ratio)
+            color += color_local * local_weight * weight
+
+            if depth < max_depth:
+                if refract_ratio > 0.0:
+                    eta = 1.0 / refract_index if ray_d.dot(vec_n) < 0 else refract_index
+                    vec_n = vec_n if ray_d.dot(vec_n) < 0 else -vec_n
+                    refracted_vec = self.refract(ray_d, vec_n, eta)
+                    # the refraction ratio is applied twice, as in the former recursive tracer
+                    weight_refract = weight * refract_ratio * refract_ratio
+                    if refracted_vec.norm() > 0.0 and weight_refract > MIN_WEIGHT and size < STACK_SIZE:
+                        self.counters.add(REFRACTION)
+                        for d in ti.static(range(3)):
+                            stack_origin[size, d] = pos[d]
+                            stack_dir[size, d] = refracted_vec[d]
+                        stack_t_min[size] = 0.001
+                        stack_weight[size] = weight_refract
+                        stack_depth[size] = depth + 1
+                        size += 1
+
+                # 反射光
+                vec_reflect = self.get_reflect_ray(ray_d, vec_n)
+                weight_reflect = weight * reflect_ratio
+                if weight_reflect > MIN_WEIGHT and size < STACK_SIZE:
+                    self.counters.add(REFLECTION)
+                    for d in ti.static(range(3)):
+                        stack_origin[size, d] = pos[d]
+                        stack_dir[size, d] = vec_reflect[d]
+                    stack_t_min[size] = 0.001
+                    stack_weight[size] = weight_reflect
+                    stack_depth[size] = depth + 1
+                    size += 1
+        return color
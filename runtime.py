@@ -0,0 +1,31 @@
+import os
+import taichi as ti
+from format import flt_default
+
+# compiled kernels are kept here between runs in the release profile
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.ti_cache')
+
+PROFILES = {
+    # bound checks and no kernel cache, for development
+    'debug': dict(debug=True, offline_cache=False),
+    # kernels are compiled once and loaded from the offline cache on the next launch
+    'release': dict(debug=False, offline_cache=True),
+}
+
+
+def init(profile='release', arch=ti.cpu, cache_dir=CACHE_DIR, **kwargs):
+    """
+    initialize taichi with one of the PROFILES
+    :param profile: 'debug' or 'release'
+    :param arch: taichi backend
+    :param cache_dir: location of the offline kernel cache
+    :param kwargs: extra arguments passed to ti.init
+    """
+    if profile not in PROFILES:
+        raise ValueError("Unknown profile '{}', expected one of {}.".format(profile, ', '.join(PROFILES)))
+    options = dict(arch=arch, device_memory_fraction=1.0, default_fp=flt_default)
+    options.update(PROFILES[profile])
+    if options['offline_cache']:
+        options['offline_cache_file_path'] = cache_dir
+    options.update(kwargs)
+    ti.init(**options)
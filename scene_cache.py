@@ -0,0 +1,211 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from format import np_flt_default
+
+
+def get_cache_name(file_name: str) -> str:
+    return file_name + '.npy'
+
+
+def get_file_key(file_name: str) -> dict:
+    """
+    the cache is valid as long as the size and the modification time of the source file are unchanged
+    """
+    stat = os.stat(file_name)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_cache(file_name: str):
+    """
+    :return: column names and the memory-mapped (n, k) array, None if the cache is missing or stale
+    """
+    cache_name = get_cache_name(file_name)
+    try:
+        with open(cache_name + '.json') as f:
+            meta = json.load(f)
+        if meta['key'] != get_file_key(file_name):
+            return None
+        data = np.load(cache_name, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    return meta['columns'], data
+
+
+def write_cache(file_name: str, columns: list, data: np.ndarray):
+    cache_name = get_cache_name(file_name)
+    try:
+        # write to temporary files first so an interrupted run never leaves a broken cache
+        with open(cache_name + '.tmp', 'wb') as f:
+            np.save(f, data)
+        os.replace(cache_name + '.tmp', cache_name)
+        with open(cache_name + '.json.tmp', 'w') as f:
+            json.dump({'key': get_file_key(file_name), 'columns': columns}, f)
+        os.replace(cache_name + '.json.tmp', cache_name + '.json')
+    except OSError:
+        # read-only location, keep working without the cache
+        pass
+
+
+def load_structured(file_name: str) -> np.memmap:
+    """
+    :return: the memory-mapped structured array of a .npy particle file
+    """
+    data = np.load(file_name, mmap_mode='r')
+    if data.dtype.names is None:
+        raise ValueError("{} is not a structured array, the columns need names.".format(file_name))
+    return data
+
+
+def load_columns(file_name: str, use_cache: bool = True):
+    """
+    load the numeric columns of a particle file
+    the columns are stored as one float array so that repeat launches map the
+    binary sidecar instead of parsing the CSV again
+    :param file_name: csv file with one particle per row, or a .npy file of a structured array,
+        which needs no sidecar
+    :param use_cache: read and write the binary sidecar next to the csv
+    :return: column names and the (n, k) array
+    """
+    if file_name.endswith('.npy'):
+        data = load_structured(file_name)
+        columns = [name for name in data.dtype.names if np.issubdtype(data.dtype[name], np.number)]
+        return columns, np.stack([np.asarray(data[name], dtype=np_flt_default) for name in columns], axis=1)
+    if use_cache:
+        res = read_cache(file_name)
+        if res is not None:
+            return res
+    df = pd.read_csv(file_name).select_dtypes('number')
+    columns = list(df.columns)
+    data = df.to_numpy(dtype=np_flt_default)
+    if use_cache:
+        write_cache(file_name, columns, data)
+    return columns, data
+
+
+def count_rows(file_name: str, block_size: int = 1 << 24) -> int:
+    """
+    number of lines after the header of a csv file, counted without parsing
+    an upper bound of the rows pandas reads, it skips blank lines
+    """
+    number_line = 0
+    last = b'\n'
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            number_line += block.count(b'\n')
+            last = block[-1:]
+    # the last row may lack its line break
+    if last != b'\n':
+        number_line += 1
+    return number_line - 1
+
+
+def read_csv_chunks(file_name: str, chunk_size: int):
+    """
+    parse a csv file chunk by chunk, the numeric columns are taken from the first chunk
+    :return: generator of (column names, (rows, k) array)
+    """
+    columns = None
+    for df in pd.read_csv(file_name, chunksize=chunk_size):
+        if columns is None:
+            columns = list(df.select_dtypes('number').columns)
+        yield columns, df[columns].to_numpy(dtype=np_flt_default)
+
+
+def truncate_rows(data: np.memmap, file_name: str, number: int, chunk_size: int) -> np.memmap:
+    """
+    copy the first rows of a memory-mapped .npy array into a new file of that name, chunk by chunk
+    :return: the new array
+    """
+    data.flush()
+    truncated = np.lib.format.open_memmap(file_name + '.part', mode='w+', dtype=data.dtype,
+                                          shape=(number,) + data.shape[1:])
+    for start in range(0, number, chunk_size):
+        truncated[start:start + chunk_size] = data[start:min(start + chunk_size, number)]
+    del data
+    truncated.flush()
+    del truncated
+    os.replace(file_name + '.part', file_name)
+    return np.load(file_name, mmap_mode='r+')
+
+
+def count_csv_rows(file_name: str, chunk_size: int) -> int:
+    """
+    number of rows pandas reads from a csv file, only the first column is parsed
+    """
+    return sum(df.shape[0] for df in pd.read_csv(file_name, chunksize=chunk_size, usecols=[0]))
+
+
+def write_cache_chunked(file_name: str, chunk_size: int):
+    """
+    convert a csv file to its binary sidecar without holding more than one chunk in memory,
+    the array is written through a memory map
+    :return: column names and the memory-mapped (n, k) array, None if the sidecar cannot be written
+    """
+    cache_name = get_cache_name(file_name)
+    number = count_rows(file_name)
+    data = None
+    start = 0
+    try:
+        for columns, chunk in read_csv_chunks(file_name, chunk_size):
+            if data is None:
+                data = np.lib.format.open_memmap(cache_name + '.tmp', mode='w+', dtype=np_flt_default,
+                                                 shape=(number, len(columns)))
+            if start + chunk.shape[0] > number:
+                raise ValueError("{} has more rows than lines.".format(file_name))
+            data[start:start + chunk.shape[0]] = chunk
+            start += chunk.shape[0]
+        if data is None:
+            return None
+        if start < number:
+            # blank lines were counted, only the rows written are kept
+            data = truncate_rows(data, cache_name + '.tmp', start, chunk_size)
+        data.flush()
+        del data
+        os.replace(cache_name + '.tmp', cache_name)
+        with open(cache_name + '.json.tmp', 'w') as f:
+            json.dump({'key': get_file_key(file_name), 'columns': columns}, f)
+        os.replace(cache_name + '.json.tmp', cache_name + '.json')
+    except OSError:
+        return None
+    return read_cache(file_name)
+
+
+def iter_chunks(file_name: str, chunk_size: int, use_cache: bool = True):
+    """
+    stream the numeric columns of a particle file, at most chunk_size rows at a time
+    a csv file is converted to the binary sidecar first if use_cache is set, which also makes
+    repeat passes cheap; a .npy file of a structured array is memory-mapped directly
+    :return: number of rows and a function returning a new generator of (first row, columns by name)
+    """
+    if file_name.endswith('.npy'):
+        data = load_structured(file_name)
+        names = data.dtype.names
+
+        def generate():
+            for start in range(0, data.shape[0], chunk_size):
+                chunk = data[start:start + chunk_size]
+                yield start, {name: np.asarray(chunk[name], dtype=np_flt_default) for name in names}
+        return data.shape[0], generate
+
+    res = None
+    if use_cache:
+        res = read_cache(file_name)
+        if res is None:
+            res = write_cache_chunked(file_name, chunk_size)
+    if res is not None:
+        columns, data = res
+
+        def generate():
+            for start in range(0, data.shape[0], chunk_size):
+                chunk = np.asarray(data[start:start + chunk_size])
+                yield start, {name: chunk[:, k] for k, name in enumerate(columns)}
+        return data.shape[0], generate
+
+    def generate():
+        start = 0
+        for columns, chunk in read_csv_chunks(file_name, chunk_size):
+            yield start, {name: chunk[:, k] for k, name in enumerate(columns)}
+            start += chunk.shape[0]
+    return count_csv_rows(file_name, chunk_size), generate
@@ -0,0 +1,131 @@
+import os
+import re
+import glob
+import time
+import argparse
+import numpy as np
+import taichi as ti
+from concurrent.futures import ThreadPoolExecutor
+import runtime
+from camera import Camera
+from sphere import Sphere, read_columns
+from render import Renderer
+from batch_render import save_canvas
+
+
+def find_frames(pattern: str):
+    """
+    snapshot files matching pattern, sorted by the last number in their name
+    e.g. ball_info_2.csv comes before ball_info_10.csv
+    """
+    def get_index(file_name):
+        numbers = re.findall(r'\d+', os.path.basename(file_name))
+        return int(numbers[-1]) if numbers else -1
+    return sorted(glob.glob(pattern), key=get_index)
+
+
+def prefetch(file_name: str, subset, use_cache: bool) -> dict:
+    """
+    read a snapshot into memory, runs on the loader thread
+    """
+    return {name: np.array(values) for name, values in read_columns(file_name, subset, use_cache).items()}
+
+
+class SequenceRenderer(object):
+    def __init__(self, frames, camera=None, subset=slice(None), use_cache=True, max_depth=4, color_column='rad',
+                 value_range=None):
+        """
+        :param frames: snapshot files of the same particle set, rendered in this order
+        :param camera: None uses the default camera
+        :param subset: particle rows to keep, as in Sphere
+        :param color_column: column mapped to the particle color
+        :param value_range: (min, max) of the colormap, None takes the range of the first frame,
+            every frame uses the same range
+        """
+        if len(frames) == 0:
+            raise ValueError("No frames to render.")
+        self.frames = list(frames)
+        self.subset = subset
+        self.use_cache = use_cache
+        # the first snapshot defines the fields and the bvh topology, later frames only update them
+        sphere = Sphere(self.frames[0], subset, use_cache)
+        sphere.set_colormap(color_column, value_range=value_range)
+        self.renderer = Renderer(camera=camera, sphere=sphere, max_depth=max_depth)
+
+    def render(self, output_dir: str, noise_target=0.0, samples_per_pass=4, samples=16, verbose=True,
+               min_samples=None):
+        """
+        render every frame into output_dir/frame_<n>.png while the next snapshot is read in the background
+        :param min_samples: samples per pixel before noise_target may stop it, None uses 2 * samples_per_pass
+        :return: timing of every frame in seconds
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        if min_samples is None:
+            min_samples = min(2 * samples_per_pass, samples)
+        timing = []
+        with ThreadPoolExecutor(max_workers=1) as loader:
+            future = None
+            for index_frame, file_name in enumerate(self.frames):
+                record = {'frame': index_frame, 'file': file_name}
+                time_start = time.perf_counter()
+                if index_frame > 0:
+                    columns = future.result()
+                    record['wait'] = time.perf_counter() - time_start
+                    time_stage = time.perf_counter()
+                    self.renderer.sphere.update_frame(columns)
+                    self.renderer.update_scene()
+                    ti.sync()
+                    record['update'] = time.perf_counter() - time_stage
+                if index_frame + 1 < len(self.frames):
+                    future = loader.submit(prefetch, self.frames[index_frame + 1], self.subset, self.use_cache)
+
+                time_stage = time.perf_counter()
+                self.renderer.reset_accumulation()
+                self.renderer.render_until_converged(noise_target, samples_per_pass, min_samples, samples)
+                ti.sync()
+                record['render'] = time.perf_counter() - time_stage
+
+                time_stage = time.perf_counter()
+                output = os.path.join(output_dir, 'frame_{:05d}.png'.format(index_frame))
+                save_canvas(output, self.renderer.canvas.to_numpy())
+                record['write'] = time.perf_counter() - time_stage
+                record['total'] = time.perf_counter() - time_start
+                timing.append(record)
+                if verbose:
+                    print('frame {:5d} {}: '.format(index_frame, os.path.basename(file_name)) + ', '.join(
+                        '{} {:.3f} s'.format(stage, record[stage])
+                        for stage in ('wait', 'update', 'render', 'write', 'total') if stage in record))
+        return timing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='render a sequence of particle snapshots')
+    parser.add_argument('--frames', default='ball_info_*.csv', help='glob pattern of the snapshot files')
+    parser.add_argument('--output-dir', default='frames')
+    parser.add_argument('--resolution', type=int, nargs=2, default=(480, 720), metavar=('ROWS', 'COLUMNS'))
+    parser.add_argument('--samples', type=int, default=16)
+    parser.add_argument('--samples-per-pass', type=int, default=4)
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='stop sampling a pixel once its noise is below this level, 0 always uses all samples')
+    parser.add_argument('--min-samples', type=int, default=None,
+                        help='samples per pixel before --noise may stop it, 2 * --samples-per-pass by default')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--color-column', default='rad', help='particle column mapped to the color')
+    parser.add_argument('--range', type=float, nargs=2, default=None, metavar=('MIN', 'MAX'),
+                        help='values at the ends of the colormap, the range of the first frame by default')
+    parser.add_argument('--arch', choices=('cpu', 'gpu'), default='cpu')
+    args = parser.parse_args(argv)
+    frames = find_frames(args.frames)
+    if not frames:
+        parser.error('no snapshot file matches {}'.format(args.frames))
+
+    runtime.init('release', arch=ti.cpu if args.arch == 'cpu' else ti.gpu)
+    sequence = SequenceRenderer(frames, camera=Camera(resolution=args.resolution),
+                                max_depth=args.depth, color_column=args.color_column, value_range=args.range)
+    timing = sequence.render(args.output_dir, args.noise, args.samples_per_pass, args.samples,
+                            min_samples=args.min_samples)
+    print('{} frames in {:.3f} s'.format(len(timing), sum(record['total'] for record in timing)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import numpy as np
+import taichi as ti
+from format import flt_default, INF
+from linalg import solve_quadratic_equation
+vec = ti.math.vec3
+
+
+@ti.data_oriented
+class ShadowMap(object):
+    """
+    orthographic depth map of the spheres seen from the directional light
+    every texel keeps the height (along the light direction) of the highest sphere surface above it,
+    a point is lit if nothing in its texel is higher, so the directional shadow test becomes a lookup
+    the map is fitted to the particles, outside of it only the few large spheres can cast a shadow
+    and they are tested exactly
+    """
+    def __init__(self, sphere, light_dir, resolution=2048, pcf_radius=1, normal_offset=1.0, bias=0.5,
+                 max_rad_ratio=100.0, max_large=16):
+        """
+        :param light_dir: unit vector pointing to the light source
+        :param resolution: number of texels along each edge of the map
+        :param pcf_radius: percentage-closer filtering over (2 pcf_radius + 1)^2 texels, 0 gives hard shadows
+        :param normal_offset: the lookup point is moved along the normal by this many texels against acne
+        :param bias: depth tolerance in texels
+        :param max_rad_ratio: spheres larger than this many times the median radius (e.g. the floor)
+            are drawn into the map but do not widen its extent, at most max_large of them
+        """
+        self.sphere = sphere
+        self.resolution = resolution
+        self.pcf_radius = pcf_radius
+        self.normal_offset = normal_offset
+        self.bias = bias
+        self.max_rad_ratio = max_rad_ratio
+        light_dir = np.asarray(light_dir, dtype=np.float64)
+        light_dir = light_dir / np.linalg.norm(light_dir)
+        # any vector not parallel to the light gives the first axis of the map
+        helper = np.array([0.0, 1.0, 0.0]) if abs(light_dir[1]) < 0.9 else np.array([1.0, 0.0, 0.0])
+        axis_u = np.cross(light_dir, helper)
+        axis_u /= np.linalg.norm(axis_u)
+        axis_v = np.cross(light_dir, axis_u)
+        self.light_dir = vec(*light_dir)
+        self.axis_u = vec(*axis_u)
+        self.axis_v = vec(*axis_v)
+        self.depth = ti.field(dtype=flt_default, shape=(resolution, resolution))
+        # lower corner of the map in the (u, v) plane and the edge length of a texel
+        self.lower = ti.field(dtype=flt_default, shape=(2,))
+        self.texel = ti.field(dtype=flt_default, shape=(1,))
+        self.max_large = max_large
+        self.large_index = ti.field(dtype=ti.i32, shape=(max_large,))
+        self.number_large = ti.field(dtype=ti.i32, shape=(1,))
+        self.build()
+
+    def build(self, keep_extent=False) -> bool:
+        """
+        fit the map to the spheres and draw them, call it again after the spheres moved
+        :param keep_extent: keep the fitted map as long as the spheres stay inside it and the large
+            spheres are the same, only the depth is drawn again, so a lookup away from the moved
+            spheres gives the same result as before
+        :return: True if the extent was kept
+        """
+        pos_rad = self.sphere.pos_rad.to_numpy()[:self.sphere.number].astype(np.float64)
+        pos, rad = pos_rad[:, :3], pos_rad[:, 3]
+        small = rad <= np.median(rad) * self.max_rad_ratio
+        large_index = np.nonzero(~small)[0].astype(np.int32)
+        if large_index.shape[0] > self.max_large:
+            raise ValueError("{} spheres are larger than {} times the median radius, at most {} are supported."
+                             .format(large_index.shape[0], self.max_rad_ratio, self.max_large))
+        large_index = np.pad(large_index, (0, self.max_large - large_index.shape[0]), constant_values=-1)
+        pos, rad = pos[small], rad[small]
+        axes = np.stack([self.axis_u.to_numpy(), self.axis_v.to_numpy()], axis=1)
+        proj = pos @ axes
+        lower = (proj - rad[:, None]).min(axis=0)
+        upper = (proj + rad[:, None]).max(axis=0)
+        # the margin keeps the filter footprint of the border points inside the map
+        margin = self.pcf_radius + 2
+        if keep_extent and np.array_equal(large_index, self.large_index.to_numpy()):
+            texel = float(self.texel[0])
+            # the corner is stored in single precision, a hundredth of a texel absorbs the rounding
+            map_lower = self.lower.to_numpy().astype(np.float64) + (margin - 0.01) * texel
+            map_upper = map_lower + (self.resolution - 2 * margin + 0.02) * texel
+            if np.all(lower >= map_lower) and np.all(upper <= map_upper):
+                self.depth.fill(-INF)
+                self.draw()
+                return True
+        self.large_index.from_numpy(large_index)
+        self.number_large[0] = np.count_nonzero(large_index >= 0)
+        # square texels
+        texel = max((upper - lower).max(), 1.0e-12) / (self.resolution - 2 * margin)
+        self.lower[0] = lower[0] - margin * texel
+        self.lower[1] = lower[1] - margin * texel
+        self.texel[0] = texel
+        self.depth.fill(-INF)
+        self.draw()
+        return False
+
+    def get_reach(self) -> float:
+        """
+        :return: distance across the light direction over which a change of the depth can change
+            a lookup, the filter footprint, the normal offset and the rounding to texels
+        """
+        return (self.normal_offset + 2.0 * (self.pcf_radius + 1)) * float(self.texel[0])
+
+    @ti.kernel
+    def draw(self):
+        """
+        raster every sphere into the texels its disk covers, keeping the highest surface
+        """
+        for index_p in range(self.sphere.number):
+            # double precision, the floor is a sphere of thousands of units drawn at texel scale
+            pos = ti.cast(self.sphere.get_pos(index_p), ti.f64)
+            texel = ti.cast(self.texel[0], ti.f64)
+            rad_texel = ti.cast(self.sphere.get_rad(index_p), ti.f64) / texel
+            cu = (pos.dot(ti.cast(self.axis_u, ti.f64)) - self.lower[0]) / texel
+            cv = (pos.dot(ti.cast(self.axis_v, ti.f64)) - self.lower[1]) / texel
+            height = pos.dot(ti.cast(self.light_dir, ti.f64))
+            i_start = ti.max(ti.cast(ti.floor(cu - rad_texel), ti.i32), 0)
+            i_end = ti.min(ti.cast(ti.ceil(cu + rad_texel), ti.i32), self.resolution - 1)
+            j_start = ti.max(ti.cast(ti.floor(cv - rad_texel), ti.i32), 0)
+            j_end = ti.min(ti.cast(ti.ceil(cv + rad_texel), ti.i32), self.resolution - 1)
+            for i in range(i_start, i_end + 1):
+                for j in range(j_start, j_end + 1):
+                    du = i + 0.5 - cu
+                    dv = j + 0.5 - cv
+                    dist_sq = du * du + dv * dv
+                    if dist_sq < rad_texel * rad_texel:
+                        ti.atomic_max(self.depth[i, j], ti.cast(
+                            height + ti.sqrt(rad_texel * rad_texel - dist_sq) * texel, flt_default))
+
+    @ti.func
+    def lookup(self, pos: vec, vec_norm: vec) -> flt_default:
+        """
+        the height of the receiver is extrapolated along its tangent plane to the center of every
+        texel of the filter footprint, so that sloped surfaces do not shadow themselves
+        :return: fraction of the filter footprint that is lit
+        """
+        texel = self.texel[0]
+        pos_offset = pos + vec_norm * self.normal_offset * texel
+        fu = (pos_offset.dot(self.axis_u) - self.lower[0]) / texel
+        fv = (pos_offset.dot(self.axis_v) - self.lower[1]) / texel
+        i = ti.cast(ti.floor(fu), ti.i32)
+        j = ti.cast(ti.floor(fv), ti.i32)
+        visibility = 1.0
+        if self.pcf_radius <= i < self.resolution - self.pcf_radius and \
+                self.pcf_radius <= j < self.resolution - self.pcf_radius:
+            # height gained per texel along u and v on the tangent plane, steep near the terminator
+            cos_light = ti.max(vec_norm.dot(self.light_dir), 0.05)
+            grad_u = -vec_norm.dot(self.axis_u) / cos_light
+            grad_v = -vec_norm.dot(self.axis_v) / cos_light
+            height = pos_offset.dot(self.light_dir) + (
+                grad_u * (i + 0.5 - fu) + grad_v * (j + 0.5 - fv) + self.bias) * texel
+            lit = 0
+            for di, dj in ti.static(ti.ndrange((-self.pcf_radius, self.pcf_radius + 1),
+                                               (-self.pcf_radius, self.pcf_radius + 1))):
+                if self.depth[i + di, j + dj] <= height + (grad_u * di + grad_v * dj) * texel:
+                    lit += 1
+            visibility = lit / (2 * self.pcf_radius + 1) ** 2
+        else:
+            vec_d = vec(self.light_dir)
+            for k in range(self.number_large[0]):
+                index_p = self.large_index[k]
+                t1, t2 = solve_quadratic_equation(vec_d, pos - self.sphere.get_pos(index_p),
+                                                  self.sphere.get_rad(index_p))
+                # a missed sphere gives INF for both roots
+                if 1.0e-3 < t1 < INF or 1.0e-3 < t2 < INF:
+                    visibility = 0.0
+                    break
+        return visibility
@@ -1,128 +1,265 @@
 import numpy as np
 import taichi as ti
-import pandas as pd
-from format import flt_default
-from colormap import scalar_to_rgb
+from format import flt_default, np_flt_default
+from scene_cache import load_columns, iter_chunks
+from colormap import ColorMap
 vec = ti.math.vec3
+# per-particle fields, see Sphere.get_arrays
+ARRAY_NAMES = ('pos_rad', 'color', 'material_id')
+# shared surface properties, every particle refers to one entry of the palette
+Material = ti.types.struct(specular=flt_default, reflective=flt_default, refractive=flt_default,
+                           refraction_index=flt_default, texture=ti.i32)
+MATERIAL_NAMES = ('specular', 'reflective', 'refractive', 'refraction_index', 'texture')
+# materials of the particles and of the floor appended after them
+PARTICLE_MATERIAL = {'specular': 64.0, 'reflective': 0.4, 'refractive': 0.1, 'refraction_index': 1.5, 'texture': 0}
+FLOOR_MATERIAL = {'specular': 512.0, 'reflective': 0.0, 'refractive': 0.0, 'refraction_index': 0.0, 'texture': 1}
+FLOOR_POS_RAD = (1.5, -1024*6 - 2.2, 0.3, 1024*6)
+# rows per chunk of the streaming loader
+CHUNK_SIZE = 1 << 20
+
+
+def read_columns(file_name: str, subset=slice(None), use_cache=True) -> dict:
+    """
+    :return: numeric columns of the particle file restricted to the subset rows, by name
+    """
+    columns, data = load_columns(file_name, use_cache)
+    data = data[subset]
+    return {name: data[:, k] for k, name in enumerate(columns)}
 
 
 @ti.data_oriented
 class Sphere(object):
-    def __init__(self):
-
+    def __init__(self, file_name='ball_info_0.csv', subset=slice(None), use_cache=True, arrays=None,
+                 columns=None, half_color=False, chunk_size=None, roi=None, frustum=None, keep_columns=('rad',)):
+        """
+        :param file_name: particle file, the default scene is used if it does not exist
+        :param subset: slice of the particle rows to keep, every row by default
+        :param use_cache: keep a binary sidecar of the csv to skip parsing on the next launch
+        :param arrays: particle data from get_arrays, replaces the file (colors included)
+        :param columns: particle columns by name (at least rad, pos_x, pos_y, pos_z), replaces the file
+        :param half_color: store the particle colors in half precision
+        :param chunk_size: stream the file in chunks of this many rows straight into the fields,
+            None reads it at once; the streaming loader is also used if roi or frustum is given
+        :param roi: ((x, y, z), (x, y, z)) corners of a box, particles not reaching into it are skipped
+        :param frustum: camera whose view the particles have to reach into, note that particles
+            outside it may still cast shadows or show in reflections
+        :param keep_columns: columns kept for the colormap by the streaming loader
+        """
+        self.file_name = file_name
+        self.subset = subset
+        self.use_cache = use_cache
+        self.color_dtype = ti.f16 if half_color else flt_default
         self.number = None
-        self.rad = None
-        self.rad_max = None
-        self.rad_min = None
-        self.pos = None
+        # position and radius packed together, a single load per intersection test
+        self.pos_rad = None
         self.color = None
-        self.specular = None
-        self.reflective = None
-        self.load_file()
-        self.get_rad_range()
-        self.set_rad_colormap()
+        self.material_id = None
+        self.materials = None
+        # numeric columns of the particle file, the floor is not included
+        self.columns = None
+        # scalar mapped to the particle color and its range
+        self.color_column = 'rad'
+        self.attribute_range = ti.field(dtype=flt_default, shape=(2,))
+        self.colormap = ColorMap()
+        if arrays is not None:
+            self.set_arrays(arrays)
+        else:
+            if columns is not None:
+                self.set_columns(columns)
+            elif chunk_size is not None or roi is not None or frustum is not None:
+                self.load_stream(CHUNK_SIZE if chunk_size is None else chunk_size, roi, frustum, keep_columns)
+            else:
+                self.load_file()
+            self.set_colormap('rad')
 
     @ti.func
     def set_radius(self, i: ti.i32, rad: flt_default):
-        self.rad[i] = rad
+        self.pos_rad[i][3] = rad
 
     @ti.func
     def set_pos(self, i: ti.i32, pos: vec):
-        self.pos[i, 0] = pos[0]
-        self.pos[i, 1] = pos[1]
-        self.pos[i, 2] = pos[2]
+        self.pos_rad[i][0] = pos[0]
+        self.pos_rad[i][1] = pos[1]
+        self.pos_rad[i][2] = pos[2]
 
     def set_color(self, i: ti.i32, color: vec):
-        self.color[i, 0] = color[0]
-        self.color[i, 1] = color[1]
-        self.color[i, 2] = color[2]
+        self.color[i] = color
 
     @ti.func
-    def set_specular(self, i: ti.i32, specular: flt_default):
-        self.specular[i] = specular
+    def set_material_specular(self, index_material: ti.i32, specular: flt_default):
+        """
+        specular exponent of a palette entry, every sphere using the material is changed,
+        give a sphere its own look by pointing its material_id to another entry
+        """
+        self.materials[index_material].specular = specular
 
     def load_file(self):
         try:
-            file_name = 'ball_info_0.csv'
-            df = pd.read_csv(file_name)
-            self.number = df.shape[0] - 50000 + 1
-            self.rad = ti.field(dtype=flt_default, shape=(self.number,))
-            self.pos = ti.field(dtype=flt_default, shape=(self.number, 3))
-            self.color = ti.field(dtype=flt_default, shape=(self.number, 3))
-            self.texture = ti.field(dtype=ti.i32, shape=(self.number))
-            self.specular = ti.field(dtype=flt_default, shape=(self.number,))
-            self.reflective = ti.field(dtype=flt_default, shape=(self.number))
-            self.refractive = ti.field(dtype=flt_default, shape=(self.number))
-            self.refraction_index = ti.field(dtype=flt_default, shape=(self.number))
-            radii = df['rad'].to_numpy()
-            pos_x = df['pos_x'].to_numpy()
-            pos_y = df['pos_y'].to_numpy()
-            pos_z = df['pos_z'].to_numpy()
-            # specular = df['specular'].to_numpy()
-            for i in range(self.number - 1):
-                self.rad[i] = radii[i]
-                self.pos[i, 0] = pos_x[i]
-                self.pos[i, 1] = pos_y[i]
-                self.pos[i, 2] = pos_z[i]
-                self.specular[i] = 64
-                self.reflective[i] = 0.4
-                self.refractive[i] = 0.1
-                self.refraction_index[i] = 1.5
-            self.rad[self.number - 1] = 1024*6
-            self.pos[self.number - 1, 0] = 1.5
-            self.pos[self.number - 1, 1] = -1024*6 - 2.2
-            self.pos[self.number - 1, 2] = 0.3
-            self.specular[self.number - 1] = 512
-            self.reflective[self.number - 1] = 0
-            self.refractive[self.number - 1] = 0.0
-            self.texture[self.number - 1] = 1
+            columns = read_columns(self.file_name, self.subset, self.use_cache)
+        except FileNotFoundError:
+            self.default_init()
+            return
+        self.set_columns(columns)
 
+    def set_columns(self, columns: dict):
+        self.columns = columns
+        # the particles are followed by the floor
+        self.number = self.columns['rad'].shape[0] + 1
+        pos_rad = np.empty((self.number, 4), dtype=np_flt_default)
+        pos_rad[:-1, 0] = self.columns['pos_x']
+        pos_rad[:-1, 1] = self.columns['pos_y']
+        pos_rad[:-1, 2] = self.columns['pos_z']
+        pos_rad[:-1, 3] = self.columns['rad']
+        pos_rad[-1] = FLOOR_POS_RAD
+        self.set_default_materials()
+        self.pos_rad.from_numpy(pos_rad)
+
+    def load_stream(self, chunk_size: int, roi=None, frustum=None, keep_columns=('rad',)):
+        """
+        read the particle file chunk by chunk into preallocated fields, only one chunk is held in memory
+        with a filter, a first pass counts the particles kept so that the fields are not oversized
+        """
+        try:
+            number_row, generate = iter_chunks(self.file_name, chunk_size, self.use_cache)
         except FileNotFoundError:
             self.default_init()
+            return
+        rows = range(number_row)[self.subset]
+        if roi is not None:
+            roi = np.asarray(roi, dtype=np.float64)
+
+        def get_chunks():
+            """
+            :return: generator of the kept rows of each chunk as (n, 4) pos_rad and the kept columns
+            """
+            for start, columns in generate():
+                index = np.arange(start, start + columns['rad'].shape[0])
+                keep = (index >= rows.start) & (index < rows.stop) & ((index - rows.start) % rows.step == 0) \
+                    if rows.step > 0 else np.isin(index, rows)
+                pos_rad = np.stack([columns['pos_x'], columns['pos_y'], columns['pos_z'], columns['rad']], axis=1)
+                if roi is not None:
+                    keep &= np.all((pos_rad[:, :3] + pos_rad[:, 3:] > roi[0]) &
+                                   (pos_rad[:, :3] - pos_rad[:, 3:] < roi[1]), axis=1)
+                if frustum is not None:
+                    keep &= frustum.in_frustum(pos_rad[:, :3], pos_rad[:, 3])
+                yield np.ascontiguousarray(pos_rad[keep]), {name: columns[name][keep] for name in keep_columns}
+
+        if roi is None and frustum is None:
+            number_kept = len(rows)
+        else:
+            number_kept = sum(pos_rad.shape[0] for pos_rad, _ in get_chunks())
+        self.number = number_kept + 1
+        self.set_default_materials()
+        self.columns = {name: np.empty(number_kept, dtype=np_flt_default) for name in keep_columns}
+        offset = 0
+        for pos_rad, columns in get_chunks():
+            self.write_particles(offset, pos_rad)
+            for name in keep_columns:
+                self.columns[name][offset:offset + pos_rad.shape[0]] = columns[name]
+            offset += pos_rad.shape[0]
+        self.pos_rad[self.number - 1] = FLOOR_POS_RAD
+
+    @ti.kernel
+    def write_particles(self, offset: ti.i32, pos_rad: ti.types.ndarray()):
+        for i in range(pos_rad.shape[0]):
+            for d in ti.static(range(4)):
+                self.pos_rad[offset + i][d] = pos_rad[i, d]
+
+    def set_default_materials(self):
+        """
+        allocate the fields with a palette of two entries, the particles use the first and the floor the second
+        """
+        self.allocate(2)
+        self.materials.from_numpy({name: np.array([PARTICLE_MATERIAL[name], FLOOR_MATERIAL[name]],
+                                                  dtype=np.int32 if name == 'texture' else np_flt_default)
+                                   for name in MATERIAL_NAMES})
+        self.material_id.fill(0)
+        self.material_id[self.number - 1] = 1
+
+    def set_materials(self, materials: dict):
+        """
+        allocate the fields and fill the material palette with the distinct materials
+        every column is deduplicated on its own and the distinct combinations are found on an integer key
+        :param materials: value of every particle by name, see MATERIAL_NAMES
+        """
+        key = np.zeros(self.number, dtype=np.int64)
+        for name in MATERIAL_NAMES:
+            unique, code = np.unique(np.asarray(materials[name]), return_inverse=True)
+            # renumbered after every column, the key stays below the number of particles
+            key = np.unique(key * unique.shape[0] + code.reshape(-1), return_inverse=True)[1].reshape(-1)
+        _, first, material_id = np.unique(key, return_index=True, return_inverse=True)
+        self.allocate(first.shape[0])
+        self.materials.from_numpy({name: np.asarray(materials[name])[first].astype(
+            np.int32 if name == 'texture' else np_flt_default) for name in MATERIAL_NAMES})
+        self.material_id.from_numpy(material_id.reshape(-1).astype(np.uint8 if first.shape[0] <= 256 else np.uint16))
+
+    def update_frame(self, columns: dict):
+        """
+        replace positions and radii in place with another snapshot of the same particle set,
+        the fields are reused and the particles are recolored by the current column within the current range
+        :param columns: see read_columns
+        """
+        if columns['rad'].shape[0] != self.number - 1:
+            raise ValueError("Snapshot has {} particles, expected {}.".format(columns['rad'].shape[0],
+                                                                            self.number - 1))
+        self.columns = columns
+        pos_rad = np.stack([columns['pos_x'], columns['pos_y'], columns['pos_z'], columns['rad']],
+                           axis=1).astype(np_flt_default)
+        self.write_particles(0, pos_rad)
+        self.set_colormap(self.color_column, fit_range=False)
+
+    def allocate(self, number_material=1):
+        if number_material > 65536:
+            raise ValueError("{} distinct materials, at most 65536 are supported.".format(number_material))
+        self.pos_rad = ti.Vector.field(4, dtype=flt_default, shape=(self.number,))
+        self.color = ti.Vector.field(3, dtype=self.color_dtype, shape=(self.number,))
+        self.material_id = ti.field(dtype=ti.u8 if number_material <= 256 else ti.u16, shape=(self.number,))
+        self.materials = Material.field(shape=(number_material,))
+
+    def get_arrays(self) -> dict:
+        """
+        copy of the particle fields and the material palette, e.g. to ship the scene to another process
+        """
+        arrays = {name: getattr(self, name).to_numpy() for name in ARRAY_NAMES}
+        arrays['materials'] = self.materials.to_numpy()
+        return arrays
+
+    def set_arrays(self, arrays: dict):
+        self.number = arrays['pos_rad'].shape[0]
+        self.color_dtype = ti.f16 if arrays['color'].dtype == np.float16 else flt_default
+        self.allocate(arrays['materials']['texture'].shape[0])
+        for name in ARRAY_NAMES:
+            getattr(self, name).from_numpy(arrays[name])
+        self.materials.from_numpy(arrays['materials'])
 
     def default_init(self):
         self.number = 3
-        self.rad = ti.field(dtype=flt_default, shape=(self.number,))
-        self.pos = ti.field(dtype=flt_default, shape=(self.number, 3))
-        self.color = ti.field(dtype=flt_default, shape=(self.number, 3))
-        self.specular = ti.field(dtype=flt_default, shape=(self.number,))
-        self.reflective = ti.field(dtype=flt_default, shape=(self.number,))
-        self.refractive = ti.field(dtype=flt_default, shape=(self.number))
-        self.refraction_index = ti.field(dtype=flt_default, shape=(self.number))
-        self.texture = ti.field(dtype=ti.i32, shape=(self.number))
-        self.rad[0] = 0.28
-        self.pos[0, 0] = 1.5
-        self.pos[0, 1] = -0.3
-        self.pos[0, 2] = -0.3
-        self.specular[0] = 16.0
-        self.reflective[0] = 0.4
-        self.refractive[0] = 0.3
-        self.refraction_index[0] = 1.5
-        self.rad[1] = 0.26
-        self.pos[1, 0] = 1.5
-        self.pos[1, 1] = -0.3
-        self.pos[1, 2] = 0.3
-        self.specular[1] = 64
-        self.reflective[1] = 0.1
-        self.refractive[1] = 0.8
-        self.refraction_index[1] = 1.5
-        self.rad[2] = 1024*6
-        self.pos[2, 0] = 1.5
-        self.pos[2, 1] = -1024*6 - 2.2
-        self.pos[2, 2] = 0.3
-        self.specular[2] = 512
-        self.reflective[2] = 0.4
-        self.refractive[2] = 0.0
-        self.texture[2] = 1
+        self.set_materials({'specular': [16.0, 64.0, 512.0],
+                            'reflective': [0.4, 0.1, 0.4],
+                            'refractive': [0.3, 0.8, 0.0],
+                            'refraction_index': [1.5, 1.5, 0.0],
+                            'texture': [0, 0, 1]})
+        self.pos_rad.from_numpy(np.array([[1.5, -0.3, -0.3, 0.28],
+                                          [1.5, -0.3, 0.3, 0.26],
+                                          FLOOR_POS_RAD], dtype=np_flt_default))
+        self.columns = {'rad': np.array([0.28, 0.26], dtype=np_flt_default)}
 
     @ti.func
     def get_pos(self, i: ti.i32):
-        return vec(self.pos[i, 0], self.pos[i, 1], self.pos[i, 2])
+        return vec(self.pos_rad[i][0], self.pos_rad[i][1], self.pos_rad[i][2])
+
+    @ti.func
+    def get_rad(self, i: ti.i32):
+        return self.pos_rad[i][3]
+
+    @ti.func
+    def get_material(self, i: ti.i32):
+        return self.materials[ti.cast(self.material_id[i], ti.i32)]
 
     @ti.func
     def get_color(self, i: ti.i32, pos: vec):
-        color = vec(self.color[i, 0], self.color[i, 1], self.color[i, 2])
-        if self.texture[i] == 1:
+        color = ti.cast(self.color[i], flt_default)
+        if self.get_material(i).texture == 1:
             stripLen = 1.0e0
             vec_p = pos - self.get_pos(i)
             checker = (ti.floor(vec_p[0]/stripLen) + ti.floor(vec_p[2]/stripLen)) % 2
@@ -132,19 +269,44 @@ class Sphere(object):
                 color = vec(1.0, 0.98, 0.9)
         return color
 
-    def get_rad_range(self):
-        rad_max = self.rad[0]
-        rad_min = self.rad[0]
-        for i in range(self.number-1):
-            if self.rad[i] >= rad_max:
-                rad_max = self.rad[i]
-            if self.rad[i] <= rad_min:
-                rad_min = self.rad[i]
-        self.rad_max = rad_max
-        self.rad_min = rad_min
-
-    def set_rad_colormap(self):
-        for i in range(self.number-1):
-            scalar = ti.min((self.rad[i] - self.rad_min) / (self.rad_max * 1.02 - self.rad_min * 0.98), 1)
-            color = scalar_to_rgb(scalar)
-            self.set_color(i, color)
+    def set_colormap(self, column='rad', cmap=None, value_range=None, fit_range=True):
+        """
+        color the particles by any numeric column of the particle file
+        :param column: name of the column, e.g. rad, a velocity or a contact count
+        :param cmap: name of a matplotlib colormap, None keeps the current one
+        :param value_range: (min, max) of the column mapped to the ends of the colormap,
+            None fits it to the values
+        :param fit_range: False keeps the current range, e.g. so that a color means the same value
+            in every frame of a sequence
+        """
+        if cmap is not None and cmap != self.colormap.name:
+            self.colormap.set_map(cmap)
+        self.color_column = column
+        if value_range is not None:
+            self.attribute_range.from_numpy(np.asarray(value_range, dtype=np_flt_default))
+            fit_range = False
+        values = np.ascontiguousarray(self.columns[column], dtype=np_flt_default)
+        if values.shape[0] == 0:
+            # e.g. every particle was filtered out while loading, only the floor is left
+            return
+        if fit_range:
+            self.get_attribute_range(values)
+        self.apply_colormap(values)
+
+    @ti.kernel
+    def get_attribute_range(self, values: ti.types.ndarray()):
+        self.attribute_range[0] = values[0]
+        self.attribute_range[1] = values[0]
+        for i in range(values.shape[0]):
+            ti.atomic_min(self.attribute_range[0], values[i])
+            ti.atomic_max(self.attribute_range[1], values[i])
+
+    @ti.kernel
+    def apply_colormap(self, values: ti.types.ndarray()):
+        value_min = self.attribute_range[0]
+        value_max = self.attribute_range[1]
+        # the range is padded by 2% so that the extreme values stay inside the colormap
+        span = ti.max(value_max - value_min + 0.02 * (ti.abs(value_max) + ti.abs(value_min)), 1.0e-12)
+        for i in range(values.shape[0]):
+            scalar = ti.min((values[i] - value_min) / span, 1)
+            self.color[i] = ti.cast(self.colormap.get_rgb(scalar), self.color_dtype)
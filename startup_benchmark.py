@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+def first_pixel(profile: str, cache_dir: str, scene: str, resolution):
+    """
+    run in a fresh process: initialize taichi, load the scene and render one pass
+    :return: seconds spent in each startup stage
+    """
+    time_start = time.perf_counter()
+    import taichi as ti
+    import runtime
+    from camera import Camera
+    from sphere import Sphere
+    from render import Renderer
+    timing = {'import': time.perf_counter() - time_start}
+
+    time_stage = time.perf_counter()
+    runtime.init(profile, arch=ti.cpu, cache_dir=cache_dir)
+    timing['init'] = time.perf_counter() - time_stage
+
+    time_stage = time.perf_counter()
+    # the csv is parsed in both runs, only the kernel cache differs between cold and warm
+    renderer = Renderer(camera=Camera(resolution=resolution), sphere=Sphere(file_name=scene, use_cache=False))
+    ti.sync()
+    timing['load'] = time.perf_counter() - time_stage
+
+    time_stage = time.perf_counter()
+    renderer.render_progressive(1, 0.0, 1, 1)
+    ti.sync()
+    timing['first_pass'] = time.perf_counter() - time_stage
+    timing['time_to_first_pixel'] = time.perf_counter() - time_start
+    return timing
+
+
+def run_child(profile: str, cache_dir: str, scene: str, resolution):
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--profile', profile, '--cache-dir', cache_dir,
+               '--scene', scene, '--resolution', str(resolution[0]), str(resolution[1])]
+    time_start = time.perf_counter()
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    timing = json.loads(output.strip().splitlines()[-1])
+    # includes the interpreter startup
+    timing['wall'] = time.perf_counter() - time_start
+    return timing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='time to first pixel with a cold and a warm kernel cache')
+    parser.add_argument('--scene', default='ball_info_0.csv')
+    parser.add_argument('--resolution', type=int, nargs=2, default=(480, 720), metavar=('ROWS', 'COLUMNS'))
+    parser.add_argument('--profile', default='release')
+    parser.add_argument('--cache-dir', default=None, help='empty or new directory, kept after the run, a temporary one by default')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(first_pixel(args.profile, args.cache_dir, args.scene, args.resolution)))
+        return
+
+    # the cold run starts from an empty cache, a given directory is never emptied by the benchmark
+    if args.cache_dir is None:
+        cache_dir = tempfile.mkdtemp(prefix='ti_cache_')
+    else:
+        cache_dir = args.cache_dir
+        if os.path.isdir(cache_dir) and os.listdir(cache_dir):
+            parser.error('--cache-dir {} is not empty, the cold run needs an empty cache'.format(cache_dir))
+        os.makedirs(cache_dir, exist_ok=True)
+    try:
+        result = {
+            'cold': run_child(args.profile, cache_dir, args.scene, args.resolution),
+            'warm': run_child(args.profile, cache_dir, args.scene, args.resolution),
+        }
+    finally:
+        if args.cache_dir is None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    print('warm: kernel cache, the scene is parsed without its sidecar in both runs')
+    print('{:<22s}{:>10s}{:>10s}'.format('stage [s]', 'cold', 'warm'))
+    for stage in result['cold']:
+        print('{:<22s}{:10.3f}{:10.3f}'.format(stage, result['cold'][stage], result['warm'][stage]))
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
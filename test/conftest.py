@@ -0,0 +1,45 @@
+import os
+import sys
+import numpy as np
+import pytest
+import taichi as ti
+
+# the modules live at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sphere import Sphere
+
+
+@pytest.fixture(scope='session', autouse=True)
+def taichi_cpu():
+    ti.init(arch=ti.cpu, log_level=ti.ERROR)
+    yield
+
+
+def make_sphere(pos_rad: np.ndarray) -> Sphere:
+    """
+    particles from an (n, 4) array of positions and radii, the floor is added as the last sphere
+    """
+    pos_rad = np.asarray(pos_rad, dtype=np.float32).reshape(-1, 4)
+    return Sphere(columns={'pos_x': pos_rad[:, 0], 'pos_y': pos_rad[:, 1], 'pos_z': pos_rad[:, 2],
+                           'rad': pos_rad[:, 3]})
+
+
+def random_pos_rad(number: int, lower=-1.0, upper=1.0, rad=(0.02, 0.08), seed=0) -> np.ndarray:
+    """
+    :param lower: lower corner of the box the centers are drawn from, a number or (x, y, z)
+    :param upper: upper corner of the box
+    :param rad: (min, max) of the radii, or a single radius for every particle
+    :return: (number, 4) positions and radii
+    """
+    rng = np.random.default_rng(seed)
+    pos = rng.uniform(lower, upper, (number, 3))
+    rad = np.full(number, rad) if np.isscalar(rad) else rng.uniform(rad[0], rad[1], number)
+    return np.column_stack([pos, rad]).astype(np.float32)
+
+
+def random_packing(number: int, lower=-1.0, upper=1.0, rad=(0.02, 0.08), seed=0) -> Sphere:
+    """
+    particles at random in a box, see random_pos_rad
+    """
+    return make_sphere(random_pos_rad(number, lower, upper, rad, seed))
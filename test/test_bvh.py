@@ -0,0 +1,102 @@
+import numpy as np
+import taichi as ti
+from bvh import BVH
+from instrument import Counters
+from camera import Camera
+from render import Renderer
+from light_comput import LightComputer
+from conftest import random_packing
+
+
+def count_nodes(number: int) -> float:
+    """
+    mean number of nodes visited by closest-hit and any-hit rays towards the max-Morton corner
+    of number particles in the unit cube (the floor is added as the last sphere)
+    """
+    sphere = random_packing(number, 0.0, 1.0, 0.004)
+    rng = np.random.default_rng(1)
+    counters = Counters(enabled=True)
+    bvh = BVH(sphere, counters=counters)
+    number_ray = 256
+    target = ti.Vector.field(3, dtype=ti.f32, shape=(number_ray,))
+    target.from_numpy((0.9 + 0.1 * rng.random((number_ray, 3))).astype(np.float32))
+
+    @ti.kernel
+    def trace():
+        for k in target:
+            origin = ti.math.vec3(2.0, 2.0, 2.0)
+            vec_d = (target[k] - origin).normalized()
+            bvh.closest_hit(origin, vec_d, 1.0e-3, 1.0e8)
+            bvh.any_hit(origin, vec_d, 1.0e-3, 1.0e8)
+    trace()
+    return counters.to_dict()['node'] / number_ray
+
+
+def test_padding_leaves_are_not_visited():
+    # 4095 particles and the floor fill the leaves exactly, 5 more double the leaves with padding
+    full = count_nodes(4095)
+    padded = count_nodes(4100)
+    assert padded < 1.5 * full + 10
+
+
+def cast(renderer, origin: np.ndarray, direction: np.ndarray):
+    number = origin.shape[0]
+    index = np.zeros(number, dtype=np.int32)
+    t = np.zeros(number, dtype=np.float32)
+    normal = np.zeros((number, 3), dtype=np.float32)
+    renderer.cast_rays(origin.astype(np.float32), direction.astype(np.float32), 1.0e-3, index, t, normal)
+    return index, t
+
+
+def test_closest_hit_matches_brute_force():
+    # 999 particles and the floor, not a power of two
+    sphere = random_packing(999)
+    rng = np.random.default_rng(1)
+    origin = rng.uniform(-1.5, 1.5, (512, 3))
+    direction = rng.normal(size=(512, 3))
+    # axis-aligned rays, some of them through the particle centers
+    axes = np.concatenate([np.eye(3), -np.eye(3)])
+    centers = sphere.pos_rad.to_numpy()[:64, :3]
+    origin = np.concatenate([origin, np.repeat(origin[:32], 6, axis=0), centers - 2.0 * axes[np.arange(64) % 6]])
+    direction = np.concatenate([direction, np.tile(axes, (32, 1)), axes[np.arange(64) % 6]])
+    camera = Camera(resolution=(4, 4))
+    index_bvh, t_bvh = cast(Renderer(use_bvh=True, camera=camera, sphere=sphere), origin, direction)
+    index_linear, t_linear = cast(Renderer(use_bvh=False, camera=camera, sphere=sphere), origin, direction)
+    assert np.count_nonzero(index_linear[:-64] >= 0) > 100
+    assert np.all(index_linear[-64:] >= 0)
+    assert np.array_equal(index_bvh, index_linear)
+    assert np.array_equal(t_bvh, t_linear)
+
+
+def test_any_hit_matches_linear_shadow_scan():
+    sphere = random_packing(999, seed=2)
+    rng = np.random.default_rng(3)
+    lights = {'ambient': 0.0,
+              'lights': [{'type': 'directional', 'intensity': 1.0, 'direction': [0.0, 1.0, 0.0]},
+                         {'type': 'directional', 'intensity': 1.0, 'direction': [-1.0, 0.5, 0.5]}] +
+                        [{'type': 'point', 'intensity': 1.0, 'position': list(p)}
+                         for p in rng.uniform(-1.5, 1.5, (6, 3))]}
+    # shadow ray origins on the particle surfaces
+    pos_rad = sphere.pos_rad.to_numpy()[:-1]
+    index = rng.integers(0, pos_rad.shape[0], 512)
+    normal = rng.normal(size=(512, 3))
+    normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+    points = ti.Vector.field(3, dtype=ti.f32, shape=(512,))
+    normals = ti.Vector.field(3, dtype=ti.f32, shape=(512,))
+    points.from_numpy((pos_rad[index, :3] + pos_rad[index, 3:] * normal).astype(np.float32))
+    normals.from_numpy(normal.astype(np.float32))
+    number_light = len(lights['lights'])
+    visibility = ti.field(dtype=ti.f32, shape=(512, number_light))
+
+    def scan(light_computer) -> np.ndarray:
+        @ti.kernel
+        def run():
+            for k, index_light in visibility:
+                visibility[k, index_light] = light_computer.check_shadow(points[k], normals[k], sphere, index_light)
+        run()
+        return visibility.to_numpy()
+
+    any_hit = scan(LightComputer(BVH(sphere), sphere=sphere, lights=lights))
+    linear = scan(LightComputer(None, sphere=sphere, lights=lights))
+    assert 0.0 < linear.mean() < 1.0
+    assert np.array_equal(any_hit, linear)
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import taichi as ti
+from camera import Camera
+from render import Renderer
+from conftest import random_packing
+
+
+def get_renderer(shadow_map_size=0) -> Renderer:
+    """
+    a loose pile of particles on the floor, their shadows fall on the visible part of the floor
+    """
+    sphere = random_packing(200, (6.5, -2.0, -1.0), (7.5, -1.2, 1.0), (0.06, 0.1))
+    return Renderer(camera=Camera(resolution=(48, 72)), sphere=sphere, track_edits=True,
+                    shadow_map_size=shadow_map_size)
+
+
+class CenterRender(object):
+    """
+    one ray through the center of every pixel, deterministic unlike the jittered samples,
+    recorded by the edit tracker like the progressive passes
+    """
+    def __init__(self, renderer: Renderer):
+        self.renderer = renderer
+        self.image = ti.field(dtype=ti.f32, shape=renderer.pixels.shape + (3,))
+        self.first_hit = ti.field(dtype=ti.i32, shape=renderer.pixels.shape)
+        self.position = ti.field(dtype=ti.f32, shape=renderer.pixels.shape + (3,))
+
+    def __call__(self):
+        renderer, image, first_hit, position = self.renderer, self.image, self.first_hit, self.position
+
+        @ti.kernel
+        def run():
+            for i, j in renderer.pixels:
+                origin = renderer.camera.origin[None]
+                vec_d = renderer.camera.get_ray_dir(i, j, 0.5, 0.5)
+                hit = renderer.intersect(origin, vec_d, 1)
+                first_hit[i, j] = hit.index
+                color = renderer.trace_color(origin, vec_d, 1, renderer.max_depth[0], i, j, False)
+                for d in ti.static(range(3)):
+                    image[i, j, d] = color[d]
+                    position[i, j, d] = origin[d] + hit.t * vec_d[d]
+        run()
+        return image.to_numpy(), first_hit.to_numpy(), position.to_numpy()
+
+
+@pytest.mark.parametrize('shadow_map_size', [0, 256])
+def test_pixels_outside_the_dropped_tiles_do_not_change(shadow_map_size):
+    renderer = get_renderer(shadow_map_size)
+    render = CenterRender(renderer)
+    floor = renderer.sphere.number - 1
+    image, first_hit, position = render()
+    assert np.count_nonzero(first_hit == floor) > 0
+    assert np.count_nonzero((first_hit >= 0) & (first_hit < floor)) > 0
+    visible = int(np.bincount(first_hit[(first_hit >= 0) & (first_hit < floor)]).argmax())
+    pos = renderer.sphere.pos_rad[visible].to_numpy()
+    # a visible floor point whose shadow caster can be placed inside the scene box
+    light_dir = np.array([-1.0, 0.5, 0.5]) / np.linalg.norm([-1.0, 0.5, 0.5])
+    caster = position + 0.75 * light_dir
+    inside = np.all((caster - 0.1 > renderer.edit_tracker.scene_min.to_numpy()) &
+                    (caster + 0.1 < renderer.edit_tracker.scene_max.to_numpy()), axis=2)
+    caster = caster[tuple(np.argwhere((first_hit == floor) & inside)[0])]
+    edits = [('color', dict(color=(1.0, 0.0, 0.0))),
+             ('material', dict(material_id=1)),
+             ('move', dict(pos=pos[:3] + (0.0, 0.0, 0.3))),
+             ('shadow', dict(pos=caster, rad=0.1))]
+    floor_changed = 0
+    for name, edit in edits:
+        # the dropped pixels lose their samples
+        renderer.sample_count.fill(1)
+        number_dropped = renderer.edit_sphere(visible, **edit)
+        kept = renderer.sample_count.to_numpy() == 1
+        assert 0 < number_dropped < kept.size, name
+        assert np.count_nonzero(~kept) == number_dropped, name
+        image_new, first_hit, _ = render()
+        changed = np.any(image_new != image, axis=2)
+        assert np.count_nonzero(changed) > 0, name
+        assert not np.any(changed & kept), name
+        floor_changed += np.count_nonzero(changed & (first_hit == floor))
+        image = image_new
+    # a shadow moved on the floor
+    assert floor_changed > 0
+
+
+def test_leaving_the_scene_box_drops_every_pixel():
+    renderer = get_renderer()
+    render = CenterRender(renderer)
+    render()
+    number_dropped = renderer.edit_sphere(0, pos=(7.0, 5.0, 0.0))
+    assert number_dropped == renderer.num_pixel_render[0]
+
+
+def test_leaving_the_shadow_map_drops_every_pixel():
+    renderer = get_renderer(256)
+    render = CenterRender(renderer)
+    render()
+    # inside the scene box, which has a margin around the spheres, but outside the fitted shadow map
+    pos = renderer.edit_tracker.scene_min.to_numpy() + 0.1
+    number_dropped = renderer.edit_sphere(0, pos=pos)
+    assert number_dropped == renderer.num_pixel_render[0]
+
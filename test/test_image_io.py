@@ -0,0 +1,86 @@
+import zlib
+import struct
+import numpy as np
+import pytest
+import matplotlib.pyplot as plt
+import image_io
+from image_io import save_image, write_png, write_pfm
+
+
+def get_image(rows=7, cols=5) -> np.ndarray:
+    """
+    a non-square image with every pixel different, row 0 is the bottom
+    """
+    return np.arange(rows * cols * 3, dtype=np.uint8).reshape(rows, cols, 3)
+
+
+def read_png(file_name) -> np.ndarray:
+    """
+    :return: the decoded rgb image (rows, columns, 3) with the top row first, as a png stores it
+    """
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    offset = 8
+    chunks = []
+    while offset < len(data):
+        length, = struct.unpack('>I', data[offset:offset + 4])
+        kind = data[offset + 4:offset + 8]
+        body = data[offset + 8:offset + 8 + length]
+        crc, = struct.unpack('>I', data[offset + 8 + length:offset + 12 + length])
+        assert crc == zlib.crc32(kind + body) & 0xffffffff, kind
+        chunks.append((kind, body))
+        offset += 12 + length
+    assert chunks[0][0] == b'IHDR' and chunks[-1] == (b'IEND', b'')
+    cols, rows, depth, color_type, compression, filter_method, interlace = struct.unpack('>IIBBBBB', chunks[0][1])
+    assert (depth, color_type, compression, filter_method, interlace) == (8, 2, 0, 0, 0)
+    lines = zlib.decompress(b''.join(body for kind, body in chunks if kind == b'IDAT'))
+    lines = np.frombuffer(lines, dtype=np.uint8).reshape(rows, 1 + 3 * cols)
+    # no scanline is filtered
+    assert np.all(lines[:, 0] == 0)
+    return lines[:, 1:].reshape(rows, cols, 3)
+
+
+@pytest.mark.parametrize('png_rows', [256, 3])
+def test_png_keeps_every_pixel_and_the_row_order(tmp_path, monkeypatch, png_rows):
+    # a few rows per step exercise the blocks of the writer
+    monkeypatch.setattr(image_io, 'PNG_ROWS', png_rows)
+    image = get_image()
+    write_png(str(tmp_path / 'lower.png'), image, origin='lower')
+    assert np.array_equal(read_png(tmp_path / 'lower.png'), image[::-1])
+    write_png(str(tmp_path / 'upper.png'), image, origin='upper')
+    assert np.array_equal(read_png(tmp_path / 'upper.png'), image)
+    # and an independent decoder agrees
+    assert np.array_equal(np.rint(plt.imread(tmp_path / 'upper.png') * 255.0).astype(np.uint8), image)
+
+
+def test_png_of_float_colors_is_quantized(tmp_path):
+    image = np.linspace(0.0, 1.0, 7 * 5 * 3, dtype=np.float32).reshape(7, 5, 3)
+    save_image(str(tmp_path / 'image.png'), image)
+    assert np.array_equal(read_png(tmp_path / 'image.png'), np.rint(image[::-1] * 255.0).astype(np.uint8))
+
+
+@pytest.mark.parametrize('origin', ['lower', 'upper'])
+def test_pfm_stores_the_bottom_row_first(tmp_path, origin):
+    image = get_image().astype(np.float32) / 255.0
+    write_pfm(str(tmp_path / 'image.pfm'), image, origin)
+    with open(tmp_path / 'image.pfm', 'rb') as f:
+        assert f.readline() == b'PF\n'
+        assert f.readline() == b'5 7\n'
+        assert f.readline() == b'-1.0\n'
+        pixels = np.frombuffer(f.read(), dtype='<f4').reshape(7, 5, 3)
+    assert np.array_equal(pixels, image if origin == 'lower' else image[::-1])
+
+
+@pytest.mark.parametrize('origin', ['lower', 'upper'])
+def test_npy_stores_the_top_row_first(tmp_path, origin):
+    image = get_image().astype(np.float32) / 255.0
+    save_image(str(tmp_path / 'image.npy'), image, origin)
+    pixels = np.load(tmp_path / 'image.npy')
+    assert pixels.dtype == np.float32
+    assert np.array_equal(pixels, image[::-1] if origin == 'lower' else image)
+
+
+def test_unknown_extension_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        save_image(str(tmp_path / 'image.bmp'), get_image())
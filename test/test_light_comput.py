@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+import taichi as ti
+from camera import Camera
+from bvh import BVH
+from light_comput import LightComputer
+from conftest import random_packing
+
+LIGHTS = {'ambient': 0.1,
+          'lights': [{'type': 'directional', 'intensity': 0.3, 'direction': [-1.0, 0.5, 0.5]},
+                     {'type': 'point', 'intensity': 0.4, 'position': [-2.0, 3.0, 2.0], 'range': 20.0},
+                     {'type': 'point', 'intensity': 0.3, 'position': [2.0, 2.0, -2.0]},
+                     {'type': 'spot', 'intensity': 0.5, 'position': [0.0, 3.0, 0.0], 'direction': [0.0, -1.0, 0.0],
+                      'inner_angle': 20.0, 'outer_angle': 40.0}]}
+NUMBER_POINT = 256
+
+
+def get_scene():
+    """
+    a packing of particles and shading points on their surfaces
+    """
+    sphere = random_packing(500, rad=(0.05, 0.1))
+    rng = np.random.default_rng(1)
+    index = rng.integers(0, 500, NUMBER_POINT)
+    normal = rng.normal(size=(NUMBER_POINT, 3))
+    normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+    pos_rad = sphere.pos_rad.to_numpy()
+    return sphere, index, pos_rad[index, :3] + pos_rad[index, 3:] * normal, normal
+
+
+def compute(light_computer, sphere, index, points, normal, repeat=1):
+    """
+    :return: intensity of every shading point, exact (every light traced) and as computed
+        by compute_intensity averaged over repeat calls
+    """
+    camera = Camera()
+    index_p = ti.field(dtype=ti.i32, shape=(NUMBER_POINT,))
+    pos = ti.Vector.field(3, dtype=ti.f32, shape=(NUMBER_POINT,))
+    vec_n = ti.Vector.field(3, dtype=ti.f32, shape=(NUMBER_POINT,))
+    exact = ti.field(dtype=ti.f32, shape=(NUMBER_POINT,))
+    computed = ti.field(dtype=ti.f32, shape=(NUMBER_POINT,))
+    index_p.from_numpy(index.astype(np.int32))
+    pos.from_numpy(points.astype(np.float32))
+    vec_n.from_numpy(normal.astype(np.float32))
+
+    @ti.kernel
+    def run():
+        for k in pos:
+            vec_v = (camera.origin[None] - pos[k]).normalized()
+            specular = sphere.get_material(index_p[k]).specular
+            intensity = light_computer.ambient[0]
+            for index_light in range(light_computer.number_light):
+                vec_l, distance, falloff = light_computer.get_light_vector(index_light, pos[k])
+                strength = light_computer.lights[index_light].intensity * falloff
+                value = light_computer.compute_diffuse(vec_n[k], vec_l, strength) + \
+                    light_computer.compute_spec(specular, vec_n[k], vec_l, vec_v, strength)
+                intensity += value * light_computer.check_shadow(pos[k], vec_n[k], sphere, index_light)
+            exact[k] = intensity
+            total = 0.0
+            for r in range(repeat):
+                total += light_computer.compute_intensity(sphere, index_p[k], pos[k], vec_n[k], camera)
+            computed[k] = total / repeat
+    run()
+    return exact.to_numpy(), computed.to_numpy()
+
+
+def test_lights_within_the_shadow_rays_are_traced_exactly():
+    sphere, index, points, normal = get_scene()
+    light_computer = LightComputer(BVH(sphere), sphere=sphere, lights=LIGHTS, shadow_rays=4, min_contribution=0.0)
+    exact, computed = compute(light_computer, sphere, index, points, normal)
+    assert np.all(np.isfinite(exact))
+    assert 0.1 < exact.mean() < exact.max()
+    np.testing.assert_allclose(computed, exact, rtol=1.0e-5, atol=1.0e-6)
+
+
+def test_sampled_shadow_rays_are_unbiased():
+    sphere, index, points, normal = get_scene()
+    light_computer = LightComputer(BVH(sphere), sphere=sphere, lights=LIGHTS, shadow_rays=1, min_contribution=0.0)
+    exact, computed = compute(light_computer, sphere, index, points, normal, repeat=2000)
+    np.testing.assert_allclose(computed.mean(), exact.mean(), rtol=0.01)
+    np.testing.assert_allclose(computed, exact, atol=0.05)
+
+
+@pytest.mark.parametrize('light', [{'type': 'directional', 'intensity': 0.3},
+                                   {'type': 'spot', 'intensity': 0.3, 'position': [0.0, 3.0, 0.0]},
+                                   {'type': 'spot', 'intensity': 0.3, 'position': [0.0, 3.0, 0.0],
+                                    'direction': [0.0, -1.0, 0.0], 'inner_angle': 40.0, 'outer_angle': 20.0},
+                                   {'type': 'area', 'intensity': 0.3}])
+def test_invalid_lights_are_rejected(light):
+    with pytest.raises(ValueError, match='Light 1 '):
+        LightComputer(lights={'lights': [LIGHTS['lights'][1], light]})
+
+
+def test_spot_light_with_equal_angles_has_a_hard_edge():
+    light_computer = LightComputer(lights={'lights': [
+        {'type': 'spot', 'intensity': 1.0, 'position': [0.0, 1.0, 0.0], 'direction': [0.0, -1.0, 0.0]},
+        {'type': 'spot', 'intensity': 1.0, 'position': [0.0, 1.0, 0.0], 'direction': [0.0, -1.0, 0.0],
+         'inner_angle': 30.0, 'outer_angle': 30.0},
+        {'type': 'spot', 'intensity': 1.0, 'position': [0.0, 1.0, 0.0], 'direction': [0.0, -1.0, 0.0],
+         'outer_angle': 30.0}]})
+    falloff = ti.field(dtype=ti.f32, shape=(3, 2))
+
+    @ti.kernel
+    def run():
+        for index_light in range(3):
+            # 10 and 50 degrees off the axis
+            falloff[index_light, 0] = light_computer.get_light_vector(index_light, ti.math.vec3(0.176, 0.0, 0.0))[2]
+            falloff[index_light, 1] = light_computer.get_light_vector(index_light, ti.math.vec3(1.192, 0.0, 0.0))[2]
+    run()
+    assert np.array_equal(falloff.to_numpy(), [[1.0, 1.0], [1.0, 0.0], [1.0, 0.0]])
+
+
+def test_lights_served_by_the_shadow_map_cannot_change():
+    sphere, index, points, normal = get_scene()
+    light_computer = LightComputer(sphere=sphere, lights=LIGHTS, shadow_map_size=64)
+    brighter = [dict(light) for light in LIGHTS['lights']]
+    brighter[0]['intensity'] = 0.6
+    light_computer.set_lights({'lights': brighter})
+    assert light_computer.lights[0].intensity == pytest.approx(0.6)
+    moved = [dict(light) for light in LIGHTS['lights']]
+    moved[0]['direction'] = [1.0, 0.5, 0.5]
+    with pytest.raises(ValueError, match='direction'):
+        light_computer.set_lights({'lights': moved})
+    with pytest.raises(ValueError, match='serves light 0'):
+        light_computer.set_lights({'lights': LIGHTS['lights'][1:] + LIGHTS['lights'][:1]})
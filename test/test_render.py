@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from camera import Camera
+from sphere import Sphere
+from render import Renderer
+
+
+@pytest.fixture(scope='module')
+def renderer():
+    return Renderer(camera=Camera(resolution=(8, 12)), sphere=Sphere(file_name='missing.csv'))
+
+
+def test_passes_without_samples_are_rejected(renderer):
+    with pytest.raises(ValueError):
+        renderer.render_until_converged(0.01, samples_per_pass=0)
+    with pytest.raises(ValueError):
+        renderer.render_until_converged(0.01, max_samples=0)
+
+
+def test_single_sample_does_not_converge(renderer):
+    renderer.reset_accumulation()
+    renderer.render_until_converged(1.0, samples_per_pass=1, min_samples=1, max_samples=8)
+    assert np.all(renderer.sample_count.to_numpy() >= 2)
+
+
+def test_samples_stop_at_max_samples(renderer):
+    renderer.reset_accumulation()
+    renderer.render_until_converged(0.0, samples_per_pass=4, min_samples=8, max_samples=10)
+    assert renderer.sample_count.to_numpy().min() == renderer.sample_count.to_numpy().max() == 10
+    renderer.reset_accumulation()
+    renderer.render_until_converged(0.0, samples_per_pass=4, min_samples=8, max_samples=1)
+    assert renderer.sample_count.to_numpy().max() == 1
+
+
+def test_denoise_filters_the_accumulated_mean(renderer):
+    renderer.reset_accumulation()
+    renderer.render_until_converged(0.0, samples_per_pass=4, min_samples=8, max_samples=8)
+    renderer.denoise()
+    denoised = renderer.canvas.to_numpy()
+    renderer.denoise()
+    assert np.array_equal(renderer.canvas.to_numpy(), denoised)
+    # the guides are the means over the same samples
+    assert np.all(renderer.albedo_buffer.to_numpy().max(axis=2) > 0.0)
+    assert np.allclose(np.linalg.norm(renderer.normal_buffer.to_numpy(), axis=2), 1.0, atol=1.0e-5)
+    depth = renderer.distance_object_close.to_numpy()
+    assert np.all(depth[np.isfinite(depth)] > 0.0)
+
+
+def test_framebuffer_methods_need_the_framebuffer():
+    renderer = Renderer(camera=Camera(resolution=(8, 12)), sphere=Sphere(file_name='missing.csv'), framebuffer=False)
+    for call in (lambda: renderer.render(1),
+                 lambda: renderer.render_progressive(1, 0.0, 1, 1),
+                 lambda: renderer.render_until_converged(),
+                 lambda: renderer.render_adaptive(),
+                 renderer.resolve_gbuffer,
+                 renderer.denoise,
+                 lambda: renderer.show_image(renderer.normal_buffer),
+                 renderer.drop_dirty_pixels):
+        with pytest.raises(ValueError):
+            call()
+    # the tiles are rendered without it
+    tile = np.zeros((3, 5, 3), dtype=np.float32)
+    renderer.render_tile(tile, 2, 4, 1)
+    assert np.all(tile > 0.0)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+from scene_cache import load_columns, write_cache_chunked, iter_chunks
+from sphere import Sphere
+
+COLUMNS = ('id', 'rad', 'pos_x', 'pos_y', 'pos_z')
+
+
+def write_csv(path, number: int, tail: str) -> str:
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'id': np.arange(number), 'rad': rng.uniform(0.01, 0.02, number),
+                       'pos_x': rng.random(number), 'pos_y': rng.random(number), 'pos_z': rng.random(number)})
+    file_name = str(path / 'particles.csv')
+    with open(file_name, 'w') as f:
+        f.write(df.to_csv(index=False) + tail)
+    return file_name
+
+
+def test_trailing_blank_lines_add_no_rows(tmp_path):
+    file_name = write_csv(tmp_path, 25, '\n\n')
+    columns, data = write_cache_chunked(file_name, chunk_size=10)
+    assert data.shape == (25, len(COLUMNS))
+    assert np.all(data[:, columns.index('rad')] > 0.0)
+    # the eager loader reads the sidecar written above
+    columns, data = load_columns(file_name, use_cache=True)
+    assert data.shape[0] == 25
+    number, generate = iter_chunks(file_name, chunk_size=10, use_cache=False)
+    assert number == sum(chunk['rad'].shape[0] for _, chunk in generate()) == 25
+
+
+def test_streamed_sphere_without_sidecar(tmp_path):
+    file_name = write_csv(tmp_path, 25, '\n')
+    sphere = Sphere(file_name, subset=slice(None), use_cache=False, chunk_size=10)
+    assert sphere.number == 26
+    assert np.all(sphere.pos_rad.to_numpy()[:, 3] > 0.0)
+
+
+def test_structured_npy_loads_without_streaming(tmp_path):
+    df = pd.read_csv(write_csv(tmp_path, 25, ''))
+    file_name = str(tmp_path / 'particles.npy')
+    np.save(file_name, df.to_records(index=False))
+    sphere = Sphere(file_name)
+    streamed = Sphere(file_name, chunk_size=10)
+    assert sphere.number == streamed.number == 26
+    assert np.array_equal(sphere.pos_rad.to_numpy(), streamed.pos_rad.to_numpy())
+    assert np.allclose(sphere.pos_rad.to_numpy()[:-1, 3], df['rad'])
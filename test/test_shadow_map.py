@@ -0,0 +1,65 @@
+import numpy as np
+import taichi as ti
+from sphere import Sphere
+from shadow_map import ShadowMap
+from conftest import make_sphere, random_pos_rad
+
+LIGHT_DIR = np.array([-1.0, 0.5, 0.5]) / np.linalg.norm([-1.0, 0.5, 0.5])
+
+
+def lookup(shadow_map, points: np.ndarray) -> np.ndarray:
+    pos = ti.Vector.field(3, dtype=ti.f32, shape=(points.shape[0],))
+    visibility = ti.field(dtype=ti.f32, shape=(points.shape[0],))
+    pos.from_numpy(points.astype(np.float32))
+
+    @ti.kernel
+    def run():
+        for k in pos:
+            visibility[k] = shadow_map.lookup(pos[k], ti.math.vec3(0.0, 1.0, 0.0))
+    run()
+    return visibility.to_numpy()
+
+
+def get_sphere(large: list) -> Sphere:
+    """
+    a small cluster of particles, the given large spheres (x, y, z, rad) and the floor
+    """
+    return make_sphere(np.concatenate([random_pos_rad(50, 1.0, 2.0, 0.05),
+                                       np.asarray(large, dtype=np.float32).reshape(-1, 4)]))
+
+
+def test_missed_large_sphere_does_not_shadow():
+    # far to the side of every shadow ray below, outside the map
+    shadow_map = ShadowMap(get_sphere([(0.0, -50.0, 300.0, 20.0)]), LIGHT_DIR, resolution=64)
+    points = np.array([(x, -2.2, z) for x in (20.0, 30.0, 40.0) for z in (-30.0, 20.0, 30.0)])
+    assert np.all(lookup(shadow_map, points) == 1.0)
+
+
+def test_large_sphere_shadows_outside_the_map():
+    point = np.array([30.0, -2.2, 30.0])
+    center = point + LIGHT_DIR * 50.0
+    shadow_map = ShadowMap(get_sphere([(*center, 20.0)]), LIGHT_DIR, resolution=64)
+    assert lookup(shadow_map, point[None])[0] == 0.0
+
+
+def test_edits_inside_the_map_keep_its_extent():
+    sphere = get_sphere([])
+    shadow_map = ShadowMap(sphere, LIGHT_DIR, resolution=64)
+    lower, texel, depth = shadow_map.lower.to_numpy(), shadow_map.texel[0], shadow_map.depth.to_numpy()
+    # the particle reaching furthest along the first axis moves inwards, the floor is the last sphere
+    axis_u = shadow_map.axis_u.to_numpy()
+    pos_rad = sphere.pos_rad.to_numpy()[:sphere.number - 1]
+    border = int((pos_rad[:, :3] @ axis_u + pos_rad[:, 3]).argmax())
+    sphere.pos_rad[border] = np.append(pos_rad[border, :3] - 0.1 * axis_u, pos_rad[border, 3])
+    assert shadow_map.build(keep_extent=True)
+    assert np.array_equal(shadow_map.lower.to_numpy(), lower) and shadow_map.texel[0] == texel
+    # only the texels under the old and the new place of the sphere are drawn again
+    changed = np.argwhere(shadow_map.depth.to_numpy() != depth)
+    assert changed.shape[0] > 0
+    center = (pos_rad[border, :3] - 0.05 * axis_u) @ np.stack([axis_u, shadow_map.axis_v.to_numpy()], axis=1)
+    reach = (0.05 + pos_rad[border, 3]) / texel + 1.0
+    assert np.all(np.abs(changed + 0.5 - (center - lower) / texel) <= reach)
+    # moving out of the map fits it again
+    sphere.pos_rad[border] = np.append(pos_rad[border, :3] + 5.0 * axis_u, pos_rad[border, 3])
+    assert not shadow_map.build(keep_extent=True)
+    assert shadow_map.lower[0] != lower[0] or shadow_map.texel[0] != texel
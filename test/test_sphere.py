@@ -0,0 +1,30 @@
+import numpy as np
+from sphere import Sphere
+
+
+def test_region_without_particles_keeps_the_floor(tmp_path):
+    file_name = str(tmp_path / 'particles.csv')
+    with open(file_name, 'w') as f:
+        f.write('id,rad,pos_x,pos_y,pos_z\n0,0.01,0.5,0.5,0.5\n1,0.02,0.6,0.6,0.6\n')
+    sphere = Sphere(file_name, subset=slice(None), use_cache=False, roi=((5.0, 5.0, 5.0), (6.0, 6.0, 6.0)))
+    assert sphere.number == 1
+    assert sphere.columns['rad'].shape[0] == 0
+    assert sphere.pos_rad.to_numpy()[0, 3] == 6144.0
+    assert np.all(sphere.material_id.to_numpy() == 1)
+
+
+def test_frames_keep_the_colormap_range():
+    rad = np.linspace(0.01, 0.02, 5, dtype=np.float32)
+    columns = {'pos_x': np.zeros(5, dtype=np.float32), 'pos_y': np.zeros(5, dtype=np.float32),
+               'pos_z': np.arange(5, dtype=np.float32), 'rad': rad}
+    sphere = Sphere(columns=columns)
+    value_range = sphere.attribute_range.to_numpy()
+    color = sphere.color.to_numpy()[:5]
+    # the particles shrink, the largest one of the next frame has the size of the middle one of the first
+    sphere.update_frame(dict(columns, rad=rad - 0.005))
+    assert np.array_equal(sphere.attribute_range.to_numpy(), value_range)
+    assert np.array_equal(sphere.color.to_numpy()[4], color[2])
+    sphere.set_colormap('rad', value_range=(0.0, 1.0))
+    assert np.allclose(sphere.attribute_range.to_numpy(), (0.0, 1.0))
+    sphere.update_frame(columns)
+    assert np.allclose(sphere.attribute_range.to_numpy(), (0.0, 1.0))
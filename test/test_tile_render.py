@@ -0,0 +1,70 @@
+import threading
+import numpy as np
+from multiprocessing.connection import Listener, Client
+from camera import Camera
+from sphere import Sphere
+from render import Renderer
+from tile_render import get_scene, new_authkey, start_local_workers, split_tiles, TileScheduler
+
+TILE_SIZE = 8
+SUPERSAMPLE = 64
+
+
+def start_faulty_proxy(address, authkey: bytes):
+    """
+    forward one scheduler connection to the worker at address, answering its first tile with an error
+    :return: address of the proxy
+    """
+    listener = Listener(('localhost', 0), authkey=authkey)
+
+    def forward():
+        with listener, listener.accept() as conn, Client(address, authkey=authkey) as worker:
+            failed = False
+            while True:
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    break
+                if message[0] == 'tile' and not failed:
+                    failed = True
+                    conn.send(('error', message[1], 'injected failure'))
+                    continue
+                worker.send(message)
+                conn.send(worker.recv())
+
+    threading.Thread(target=forward, daemon=True).start()
+    return listener.address
+
+
+def check_image(image, expected):
+    # the samples are jittered differently in every process, the tiles are compared by their mean error
+    assert image.shape == expected.shape
+    for i, j, rows, cols in split_tiles(image.shape[:2], TILE_SIZE):
+        error = np.abs(image[i:i + rows, j:j + cols] - expected[i:i + rows, j:j + cols]).mean()
+        assert error < 0.03, 'tile {}'.format((i, j))
+
+
+def test_tiles_are_retried_and_stitched():
+    camera = Camera(resolution=(24, 40))
+    sphere = Sphere(file_name='missing.csv')
+    expected = np.zeros((24, 40, 3), dtype=np.float32)
+    Renderer(camera=camera, sphere=sphere, framebuffer=False).render_tile(expected, 0, 0, SUPERSAMPLE)
+    scene = get_scene(camera, sphere)
+    authkey = new_authkey()
+    processes, addresses = start_local_workers(2, authkey, threads=1)
+    try:
+        scheduler = TileScheduler([start_faulty_proxy(addresses[0], authkey), addresses[1]], scene, authkey,
+                                  max_retries=1)
+        try:
+            check_image(scheduler.render(TILE_SIZE, SUPERSAMPLE), expected)
+        finally:
+            scheduler.close()
+        # the workers build the scene again for the next scheduler
+        scheduler = TileScheduler(addresses, scene, authkey)
+        try:
+            check_image(scheduler.render(TILE_SIZE, SUPERSAMPLE), expected)
+        finally:
+            scheduler.close(stop_workers=True)
+    finally:
+        for process in processes:
+            process.terminate()
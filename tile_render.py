@@ -0,0 +1,317 @@
+import os
+import time
+import queue
+import secrets
+import argparse
+import threading
+import traceback
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+
+
+def new_authkey() -> bytes:
+    """
+    random key shared by the scheduler and the workers, messages are unpickled so the key must stay secret
+    """
+    return secrets.token_hex(16).encode()
+
+
+def split_tiles(resolution, tile_size):
+    """
+    :param resolution: number of pixels (rows, columns)
+    :param tile_size: edge length of the square tiles, the last row and column of tiles may be smaller
+    :return: list of (row_start, col_start, rows, columns)
+    """
+    return [(i, j, min(tile_size, resolution[0] - i), min(tile_size, resolution[1] - j))
+            for i in range(0, resolution[0], tile_size) for j in range(0, resolution[1], tile_size)]
+
+
+def get_scene(camera, sphere, max_depth=4, use_bvh=True, profile='release', arch='cpu', lights=None,
+              shadow_map_size=0) -> dict:
+    """
+    everything a worker needs to rebuild the renderer, shipped once per worker
+    :param lights: light list or json file, see light_comput.load_lights, a file is read here
+        so that remote workers do not need it, None uses the default lights
+    :param shadow_map_size: see Renderer
+    """
+    if isinstance(lights, str):
+        from light_comput import load_lights
+        lights = load_lights(lights)
+    return {'camera': camera.get_config(),
+            'sphere': sphere.get_arrays(),
+            'max_depth': max_depth,
+            'use_bvh': use_bvh,
+            'profile': profile,
+            'arch': arch,
+            'lights': lights,
+            'shadow_map_size': shadow_map_size}
+
+
+def build_renderer(scene: dict, threads=None):
+    """
+    taichi is initialized again for every scene, which frees the fields of the former one,
+    the offline cache keeps the kernels from being compiled again
+    :param threads: cpu threads of taichi, None uses every core
+    """
+    import taichi as ti
+    import runtime
+    from camera import Camera
+    from sphere import Sphere
+    from render import Renderer
+    options = {} if threads is None else {'cpu_max_num_threads': threads}
+    runtime.init(scene['profile'], arch=ti.cpu if scene['arch'] == 'cpu' else ti.gpu, **options)
+    # workers only render tiles, the full-resolution buffers are not allocated
+    return Renderer(use_bvh=scene['use_bvh'], camera=Camera.from_config(scene['camera']),
+                    sphere=Sphere(arrays=scene['sphere']), max_depth=scene['max_depth'],
+                    lights=scene['lights'], shadow_map_size=scene['shadow_map_size'], framebuffer=False)
+
+
+def serve(address, authkey: bytes, ready=None, threads=None):
+    """
+    worker loop, one scheduler connection at a time
+    messages: ('scene', scene) -> ('ready',) or ('error', None, message)
+              ('tile', tile, supersample) -> ('tile', tile, pixels) or ('error', tile, message)
+              ('stop',)
+    :param address: (host, port) to listen on, port 0 picks a free port
+    :param ready: queue receiving the bound address
+    :param threads: cpu threads of taichi, None uses every core
+    """
+    listener = Listener(address, authkey=authkey)
+    if ready is not None:
+        ready.put(listener.address)
+    renderer = None
+    running = True
+    while running:
+        try:
+            conn = listener.accept()
+        except (AuthenticationError, OSError, EOFError):
+            # a peer without the key is turned away, the worker keeps listening
+            continue
+        with conn:
+            while True:
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    break
+                if message[0] == 'scene':
+                    # the former renderer is released together with its fields
+                    renderer = None
+                    try:
+                        renderer = build_renderer(message[1], threads)
+                        conn.send(('ready',))
+                    except Exception:
+                        # tiles are answered with errors until a valid scene arrives
+                        conn.send(('error', None, traceback.format_exc()))
+                elif message[0] == 'tile':
+                    tile, supersample = message[1], message[2]
+                    try:
+                        pixels = np.zeros((tile[2], tile[3], 3), dtype=np.float32)
+                        renderer.render_tile(pixels, tile[0], tile[1], supersample)
+                        conn.send(('tile', tile, pixels))
+                    except Exception:
+                        conn.send(('error', tile, traceback.format_exc()))
+                elif message[0] == 'stop':
+                    running = False
+                    break
+    listener.close()
+
+
+def start_local_workers(number, authkey: bytes, threads=None):
+    """
+    spawn worker processes listening on localhost
+    :param threads: cpu threads of every worker, None shares the cores among them
+    :return: processes and their addresses
+    """
+    if threads is None:
+        threads = max(mp.cpu_count() // number, 1)
+    context = mp.get_context('spawn')
+    ready = context.Queue()
+    processes = []
+    for _ in range(number):
+        process = context.Process(target=serve, args=(('localhost', 0), authkey, ready, threads),
+                                  daemon=True)
+        process.start()
+        processes.append(process)
+    addresses = [ready.get() for _ in range(number)]
+    return processes, addresses
+
+
+class TileScheduler(object):
+    def __init__(self, addresses, scene: dict, authkey: bytes, max_retries=3):
+        """
+        :param addresses: (host, port) of the workers
+        :param scene: see get_scene, sent once to every worker
+        :param max_retries: a tile failing more often aborts the frame
+        """
+        self.addresses = list(addresses)
+        self.scene = scene
+        self.authkey = authkey
+        self.max_retries = max_retries
+        self.connections = []
+        for address in self.addresses:
+            conn = Client(address, authkey=authkey)
+            conn.send(('scene', scene))
+            self.connections.append(conn)
+        # a worker failing to build the scene is left out of the frame
+        ready = []
+        errors = []
+        for conn in self.connections:
+            reply = conn.recv()
+            if reply[0] == 'ready':
+                ready.append(conn)
+            else:
+                errors.append(reply[2])
+                conn.close()
+        self.connections = ready
+        if not self.connections:
+            raise RuntimeError('no worker could build the scene: {}'.format(errors[0] if errors else 'no workers'))
+
+    def render(self, tile_size=64, supersample=4, verbose=False):
+        """
+        render the whole image, tiles are handed to the first idle worker
+        :return: image (rows, columns, 3)
+        """
+        resolution = self.scene['camera']['resolution']
+        image = np.zeros((resolution[0], resolution[1], 3), dtype=np.float32)
+        pending = queue.Queue()
+        for tile in split_tiles(resolution, tile_size):
+            pending.put((tile, 0))
+        state = {'remaining': pending.qsize(), 'alive': len(self.connections), 'failed': None}
+        lock = threading.Lock()
+        done = threading.Event()
+        if state['remaining'] == 0:
+            done.set()
+
+        def retry(tile, attempt, reason):
+            with lock:
+                if attempt + 1 > self.max_retries:
+                    state['failed'] = 'tile {} failed {} times: {}'.format(tile, attempt + 1, reason)
+                    done.set()
+                    return
+            pending.put((tile, attempt + 1))
+
+        def work(conn):
+            while not done.is_set():
+                try:
+                    tile, attempt = pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                try:
+                    conn.send(('tile', tile, supersample))
+                    reply = conn.recv()
+                except (EOFError, OSError) as e:
+                    # the worker is gone, its tile goes to the others
+                    retry(tile, attempt, repr(e))
+                    with lock:
+                        state['alive'] -= 1
+                        if state['alive'] == 0:
+                            state['failed'] = state['failed'] or 'all workers are gone'
+                            done.set()
+                    return
+                if reply[0] == 'error':
+                    retry(tile, attempt, reply[2])
+                    continue
+                i, j, rows, cols = tile
+                image[i:i + rows, j:j + cols] = reply[2]
+                with lock:
+                    state['remaining'] -= 1
+                    if verbose:
+                        print('{} tiles remaining'.format(state['remaining']))
+                    if state['remaining'] == 0:
+                        done.set()
+
+        threads = [threading.Thread(target=work, args=(conn,), daemon=True) for conn in self.connections]
+        for thread in threads:
+            thread.start()
+        done.wait()
+        for thread in threads:
+            thread.join()
+        if state['failed'] is not None:
+            raise RuntimeError(state['failed'])
+        return image
+
+    def close(self, stop_workers=False):
+        for conn in self.connections:
+            try:
+                if stop_workers:
+                    conn.send(('stop',))
+                conn.close()
+            except OSError:
+                pass
+        self.connections = []
+
+
+def parse_address(text: str):
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='tiled rendering on a pool of worker processes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_worker = subparsers.add_parser('worker', help='serve tiles to a scheduler')
+    parser_worker.add_argument('--host', default='localhost')
+    parser_worker.add_argument('--port', type=int, default=6000)
+    parser_worker.add_argument('--threads', type=int, default=None, help='cpu threads, every core by default')
+    parser_worker.add_argument('--authkey', default=None,
+                               help='shared secret of the scheduler, a random one is printed by default')
+    parser_render = subparsers.add_parser('render', help='render a frame on local and remote workers')
+    parser_render.add_argument('--scene', default='ball_info_0.csv')
+    parser_render.add_argument('--output', default='particleRayTracing.png')
+    parser_render.add_argument('--resolution', type=int, nargs=2, default=(480, 720), metavar=('ROWS', 'COLUMNS'))
+    parser_render.add_argument('--workers', type=int, default=mp.cpu_count(), help='local worker processes')
+    parser_render.add_argument('--remote', nargs='*', default=(), metavar='HOST:PORT', help='running workers')
+    parser_render.add_argument('--tile-size', type=int, default=64)
+    parser_render.add_argument('--samples', type=int, default=4)
+    parser_render.add_argument('--depth', type=int, default=4)
+    parser_render.add_argument('--lights', default=None, help='json light list, the default lights otherwise')
+    parser_render.add_argument('--shadow-map', type=int, default=0,
+                               help='texels along each edge of the directional shadow map, 0 traces the shadow rays')
+    parser_render.add_argument('--retries', type=int, default=3)
+    parser_render.add_argument('--authkey', default=None,
+                               help='shared secret of the remote workers, the local ones get a random one')
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        authkey = new_authkey() if args.authkey is None else args.authkey.encode()
+        if args.authkey is None:
+            print('authkey {}'.format(authkey.decode()), flush=True)
+        serve((args.host, args.port), authkey, threads=args.threads)
+        return
+    if args.remote and args.authkey is None:
+        parser.error('--remote needs the --authkey printed by the workers')
+    if not os.path.isfile(args.scene):
+        parser.error('scene file {} not found'.format(args.scene))
+    authkey = new_authkey() if args.authkey is None else args.authkey.encode()
+
+    import taichi as ti
+    import runtime
+    from camera import Camera
+    from sphere import Sphere
+    from image_io import save_image
+    # the scheduler only loads the scene, the bvh is built by the workers
+    runtime.init('release', arch=ti.cpu)
+    scene = get_scene(Camera(resolution=args.resolution), Sphere(file_name=args.scene), args.depth,
+                      lights=args.lights, shadow_map_size=args.shadow_map)
+
+    time_start = time.perf_counter()
+    processes, addresses = start_local_workers(args.workers, authkey) if args.workers > 0 else ([], [])
+    addresses += [parse_address(address) for address in args.remote]
+    scheduler = TileScheduler(addresses, scene, authkey, args.retries)
+    print('{} workers ready in {:.3f} s'.format(len(addresses), time.perf_counter() - time_start))
+    time_start = time.perf_counter()
+    try:
+        image = scheduler.render(args.tile_size, args.samples)
+    finally:
+        scheduler.close(stop_workers=False)
+        for process in processes:
+            process.terminate()
+    print('rendered in {:.3f} s'.format(time.perf_counter() - time_start))
+    save_image(args.output, image)
+    print('saved {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()